@@ -27,6 +27,11 @@ def getPortPath():
 # Get commandline arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("--source", type=int, help="specifies the camera that is the source of the video feed")
+parser.add_argument("--stats", type=float, help="print the robot's serial I/O statistics every STATS seconds")
+parser.add_argument("--record", help="record everything sent to and received from the robot to this file")
+parser.add_argument("--replay", help="instead of talking to a robot, replay a file made with --record")
+parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than it was recorded to replay (0 for as fast as possible)")
+parser.add_argument("--video", help="read the frames from this video file instead of a camera")
 args = parser.parse_args()
 
 # The camcode tells us what device to use: 0 for the built-in webcam, 1 for the external webcam
@@ -34,15 +39,52 @@ camCode = 0
 if (args.source == 1):
 	camCode = 1
 
-# Get the serial port path/name string
-portPath = getPortPath()
+# Get the serial port path/name string, or the recording to stand in for the robot
+if (args.replay != None):
+	portPath = create.ReplaySerial(args.replay, speed=args.speed)
+else:
+	portPath = getPortPath()
 
-# Initialize the robot
-robot = create.Create(portPath)
+# Initialize the robot; it gets ready in the background while the camera opens below
+robot = create.Create(portPath, record=args.record, connect=False)
+connecting = robot.startConnect()
+
+# The videostream used by OpenCV
+if (args.video != None):
+	cap = cv2.VideoCapture(args.video)
+else:
+	cap = cv2.VideoCapture(camCode)
+
+# Wait for the robot, giving up if it can't be reached
+try:
+	connecting.result()
+except create.CreateConnectionError as e:
+	print("Could not connect to the robot (" + e.stage + "): " + str(e))
+	cap.release()
+	raise SystemExit(1)
+# Have the robot stream its bumpers and odometry every 15 ms, so polling the sensors
+# in the loop below doesn't cost a serial round trip
+robot.startStream([create.LEFT_BUMP, create.RIGHT_BUMP, create.POSE])
+# Send stops ahead of song uploads and sensor queries, so the robot stops right away after a hit
+robot.startScheduler()
+# go() commands that repeat the last one aren't sent again, but refresh the robot once a
+# second anyway in case it stopped by itself
+robot.commandKeepalive = 1.0
+# If the serial link fails, have the robot stopped and the port reopened in the background;
+# the loop below holds off while that happens rather than act on stale sensor values
+robot.superviseLink()
+robot.onLinkChange(lambda state: print("Link to the robot is " + state))
+# Optionally keep an eye on how much time goes into talking to the robot
+if (args.stats != None):
+	robot.instrument(dumpEvery=args.stats)
 
 # The speed at which the robot moves, in centimeters per second
 ROBOT_SPEED = 30
 
+# What the robot does by itself after hitting something: back off 15 cm and turn around.
+# It goes to the robot as one script, so it takes no round trips or sleeps on our side
+BACK_OFF = create.Script().move(-15, ROBOT_SPEED).turn(180, 90)
+
 
 # Define the HSV color ranges for blue, red, and green for color detection
 
@@ -117,14 +159,20 @@ def findContours(image, color, min_area):
 
 	return contours
 
+# The camera's horizontal field of view, in degrees
+CAMERA_FOV = 60.0
+
 # returns a string saying whether the contour is centerd on screen, adjusted by sensitivity
-def contourAlignment(contour, sensitivity, image):
+# rotation is how many degrees the robot has turned (counterclockwise) since the image was
+# captured, which moves the contour to the right of where it is in the image
+def contourAlignment(contour, sensitivity, image, rotation=0.0):
 	# Get the x,y coordinates of the bounding rect, as well as its width and height
 	x,y,w,h = cv2.boundingRect(contour)
-	node_left = x;
-	node_right = x+h;
 	# Get the height and width of the frame
 	img_height, img_width, channels = image.shape
+	shift = rotation * img_width / CAMERA_FOV
+	node_left = x + shift;
+	node_right = x+h + shift;
 				
 	# Calculate any adjustments in the robot's direction by comparing the respective differences between
 	# the left side of the contour bounding rect and the
@@ -140,8 +188,6 @@ def contourAlignment(contour, sensitivity, image):
 enemy_color = Color.Red
 target_color = Color.Blue
 
-# The videostream used by OpenCV
-cap = cv2.VideoCapture(camCode)
 frame_count = 0
 
 SIZE_NODES = 500
@@ -149,9 +195,15 @@ SIZE_ENEMY = 500
 
 # Run the robot's logic loop
 mode = "findNode" #, "findNode", "attack"
+# The Future of the turn (or back-off) in progress, if any
+turning = None
+# The Future of the last back-off, which nothing else may interrupt
+backing_off = None
 loop = True
 while (loop):
-	# Capture frame-by-frame
+	# Capture frame-by-frame, remembering when, so that the robot's turning since
+	# then can be taken into account
+	frame_time = time.monotonic()
 	frame = cap.read()[1]
 	frame_count += 1
 	print("=== FRAME " + str(frame_count) + " ===")
@@ -162,8 +214,28 @@ while (loop):
 	elif(target_color == Color.Red):
 		print("Target Color: Red")
 
+	# While the link is down the sensor values are stale, so wait for it to come back
+	if (robot.linkState() != create.LINK_UP):
+		print("Waiting for the link to the robot...")
+		time.sleep(0.1)
+		# Keep the window responsive, so that 'q' still quits
+		if (cv2.waitKey(1) & 0xFF == ord('q')):
+			loop = False
+		continue
+
+	# The sensors aren't read while the robot backs off, so the bumpers would still
+	# look pressed, and the state must not change until it is done
+	if (backing_off != None and not backing_off.done()):
+		print("Backing off...")
+		# Keep the window responsive, so that 'q' still quits
+		if (cv2.waitKey(1) & 0xFF == ord('q')):
+			loop = False
+		continue
+
 	# Poll sensor values
 	sensors = robot.sensors([create.LEFT_BUMP, create.RIGHT_BUMP])
+	# How far the robot has turned since the frame was captured
+	rotation = robot.getPose()[2] - robot.getPoseAt(frame_time)[2]
 
 	# Very simplistic state machine
 	if (mode == "moveToNode"):
@@ -171,10 +243,9 @@ while (loop):
 		# If either of the bumpers is depressed, the node has been hit
 		if (sensors[create.LEFT_BUMP] == 1 or sensors[create.RIGHT_BUMP] == 1):
 			print("TRIGGERED!!")
-			robot.stop()
-			robot.go(-ROBOT_SPEED,0)
-			time.sleep(0.5)
-			robot.stop()
+			# Back off and turn around while the frames keep being processed; nothing
+			# else happens until this is finished
+			backing_off = turning = robot.startScript(BACK_OFF, timeout=5.0)
 			# Change the color of the target node so it moves to the opposite one
 			if (target_color == Color.Green):
 				target_color = Color.Blue
@@ -191,7 +262,7 @@ while (loop):
 			contours = findContours(frame, target_color, SIZE_NODES)
 			# Detect the node's orientation
 			if (len(contours) > 0):
-				alignment = contourAlignment(contours[0], 100, frame)
+				alignment = contourAlignment(contours[0], 100, frame, rotation)
 				if (alignment == "left"):
 					print("\tSkewed to the left")
 					robot.go(ROBOT_SPEED, 25)
@@ -208,8 +279,11 @@ while (loop):
 			
 	elif (mode == "findNode"):
 		print("Mode: findNode");
-		robot.resetPose()
-		robot.turn(15,720)
+		# Keep turning in 15 degree steps; the turn runs in the background so the
+		# frames keep being processed while the robot turns
+		if (turning == None or turning.done()):
+			robot.resetPose()
+			turning = robot.startTurn(15, 720, timeout=2.0)
 		# Check for enemies
 		enemies = findContours(frame, enemy_color, SIZE_ENEMY)
 		if (len(enemies) > 0):
@@ -239,9 +313,7 @@ while (loop):
 		if (sensors[create.LEFT_BUMP] == 1 or sensors[create.RIGHT_BUMP] == 1):
 			print("TRIGGERED!!")
 			#back up
-			robot.stop()
-			robot.go(-ROBOT_SPEED,0)
-			robot.stop()
+			backing_off = turning = robot.startScript(BACK_OFF, timeout=5.0)
 			# Stop the Jaws song
 			robot.playSong([(0,0)])
 			mode = "findNode"
@@ -250,7 +322,7 @@ while (loop):
 		enemies = findContours(frame, enemy_color, SIZE_ENEMY)
 		if (len(enemies) > 0):
 			print("ENEMY IN SIGHT")
-			alignment = contourAlignment(enemies[0], 100, frame)
+			alignment = contourAlignment(enemies[0], 100, frame, rotation)
 			if (alignment == "left"):
 				print("\tSkewed to the left")
 				robot.go(ROBOT_SPEED, 25)
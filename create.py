@@ -22,10 +22,28 @@
 
 import serial
 import math
+import bisect
+import array
+import collections
+import heapq
+import mmap
+import os
+import selectors
 import time
+import struct
+import contextlib
+import asyncio
+import concurrent.futures
 import _thread
 import threading
 
+# numpy is only needed for integrating odometry, reading logs and
+# decoding sensor packets in bulk
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 
 # Replaces old python chr command, but puts it into a byte string
@@ -63,9 +81,29 @@ PAUSERESUME = _chr(150)       # Create only
 
 SCRIPT = _chr(152)
 ENDSCRIPT = _chr(153)
+WAIT = _chr(155)     # + 1 byte, in tenths of a second
 WAITDIST = _chr(156)
 WAITANGLE = _chr(157)
 
+# opcode -> name, for reporting on the serial traffic
+_OPCODE_NAMES = { 128: 'START', 129: 'BAUD', 130: 'CONTROL', 131: 'SAFE',
+                  132: 'FULL', 133: 'POWER', 134: 'SPOT', 135: 'COVER',
+                  136: 'DEMO', 137: 'DRIVE', 138: 'MOTORS', 139: 'LEDS',
+                  140: 'SONG', 141: 'PLAY', 142: 'SENSORS',
+                  143: 'FORCESEEKINGDOCK', 145: 'DRIVEDIRECT', 148: 'STREAM',
+                  149: 'QUERYLIST', 150: 'PAUSERESUME', 152: 'SCRIPT',
+                  153: 'ENDSCRIPT', 155: 'WAIT', 156: 'WAITDIST',
+                  157: 'WAITANGLE' }
+
+# the commands whose last value is remembered so that repeats can be
+# dropped: opcode -> the actuator it sets
+_ACTUATOR_OPCODES = { 137: 'drive', 145: 'drive', 139: 'leds' }
+
+# commands after which the robot may not be doing what it was last told
+# (mode changes, demos, running a script)
+_RESETTING_OPCODES = frozenset([ 128, 129, 130, 131, 132, 133, 134, 135, 136,
+                                 143, 153 ])
+
 # the four SCI modes
 # the code will try to keep track of which mode the system is in,
 # but this might not be 100% trivial...
@@ -124,6 +162,53 @@ PLAY_BUTTON = 109
 #                    0 1 2 3 4 5 6 7 8 9101112131415161718192021222324252627282930313233343536373839404142
 SENSOR_DATA_WIDTH = [0,0,0,0,0,0,0,1,1,1,1,1,1,1,1,1,1,1,1,2,2,1,2,2,1,2,2,2,2,2,2,2,1,2,1,1,1,1,1,2,2,2,2]
 
+# the sensors that make up each of the group packets 0 - 6
+SENSOR_GROUPS = { 0: list(range(7,27)),
+                  1: list(range(7,17)),
+                  2: list(range(17,21)),
+                  3: list(range(21,27)),
+                  4: list(range(27,35)),
+                  5: list(range(35,43)),
+                  6: list(range(7,43)) }
+
+# the raw sensors that each of the "easy access" values above is read from
+SENSOR_SOURCES = { POSE: [DISTANCE, ANGLE],
+                   LEFT_BUMP: [BUMPS_AND_WHEEL_DROPS],
+                   RIGHT_BUMP: [BUMPS_AND_WHEEL_DROPS],
+                   LEFT_WHEEL_DROP: [BUMPS_AND_WHEEL_DROPS],
+                   RIGHT_WHEEL_DROP: [BUMPS_AND_WHEEL_DROPS],
+                   CENTER_WHEEL_DROP: [BUMPS_AND_WHEEL_DROPS],
+                   LEFT_WHEEL_OVERCURRENT: [LSD_AND_OVERCURRENTS],
+                   RIGHT_WHEEL_OVERCURRENT: [LSD_AND_OVERCURRENTS],
+                   ADVANCE_BUTTON: [BUTTONS],
+                   PLAY_BUTTON: [BUTTONS] }
+
+# the sensors that report on the battery, which changes slowly
+BATTERY_SENSORS = [CHARGING_STATE, VOLTAGE, CURRENT, BATTERY_TEMP,
+                   BATTERY_CHARGE, BATTERY_CAPACITY, CHARGING_SOURCES_AVAILABLE]
+
+# how old (in seconds) a sensor's value may be before sensors() reads
+# it again; sensors that aren't listed are read on every call
+DEFAULT_SENSOR_MAX_AGE = dict([ (s, 1.0) for s in BATTERY_SENSORS ])
+
+# the sensors shown by printSensors
+_PRINTED_SENSORS = [LEFT_BUMP,RIGHT_BUMP,LEFT_WHEEL_DROP,RIGHT_WHEEL_DROP,CENTER_WHEEL_DROP,WALL_IR_SENSOR,CLIFF_LEFT,CLIFF_FRONT_LEFT,CLIFF_FRONT_RIGHT,CLIFF_RIGHT,VIRTUAL_WALL,LEFT_WHEEL_OVERCURRENT,RIGHT_WHEEL_OVERCURRENT,INFRARED_BYTE,PLAY_BUTTON,ADVANCE_BUTTON,POSE,CHARGING_STATE,VOLTAGE,CURRENT,BATTERY_TEMP,BATTERY_CHARGE,BATTERY_CAPACITY,WALL_SIGNAL,CLIFF_LEFT_SIGNAL,CLIFF_FRONT_LEFT_SIGNAL,CLIFF_FRONT_RIGHT_SIGNAL,CLIFF_RIGHT_SIGNAL,OI_MODE,SONG_NUMBER,SONG_PLAYING,CHARGING_SOURCES_AVAILABLE]
+
+# every packet the Create streams back starts with this byte
+STREAM_HEADER = 19
+# and the Create sends one of them every 15 ms
+STREAM_PERIOD = 0.015
+
+# how long (in seconds) a repeated drive or LED command may be held back
+# before it's sent anyway, to keep the robot refreshed (see commandKeepalive)
+COMMAND_KEEPALIVE = 1.0
+
+# the baud rates the Create can use, in the order of their BAUD codes
+BAUD_RATES = [ 300, 600, 1200, 2400, 4800, 9600, 14400, 19200,
+               28800, 38400, 57600, 115200 ]
+# the rate the Create starts up at
+DEFAULT_BAUDRATE = 57600
+
 # for printing the SCI modes
 def modeStr( mode ):
     """ prints a string representing the input SCI mode """
@@ -267,6 +352,8 @@ def _poseDeltaFromVelRadSec( vel_mm_sec, ROC, sec ):
         thr_delta = 0.0
         x_delta = vel_mm_sec * sec   # D = RT in action!
         y_delta = 0.0
+        # nothing more to do for this special case
+        return (x_delta, y_delta, thr_delta)
 
     elif ROC == 1 or ROC == 0:
         # turning in place counterclockwise = positive thr_delta
@@ -274,6 +361,8 @@ def _poseDeltaFromVelRadSec( vel_mm_sec, ROC, sec ):
         y_delta = 0.0
         # to do - check if the sign of vel_mm_sec matters!
         thr_delta = (vel_mm_sec * sec)/float(DELTA)
+        # nothing more to do for this special case
+        return (x_delta, y_delta, thr_delta)
 
     elif ROC == -1:
         # turning in place counterclockwise = positive thr_delta
@@ -281,6 +370,8 @@ def _poseDeltaFromVelRadSec( vel_mm_sec, ROC, sec ):
         y_delta = 0.0
         # to do - check if the sign of vel_mm_sec matters!
         thr_delta = - ( (vel_mm_sec * sec)/float(DELTA) )
+        # nothing more to do for this special case
+        return (x_delta, y_delta, thr_delta)
 
     else:
         # general case
@@ -343,197 +434,1845 @@ def _poseDeltaFromVelRadSec( vel_mm_sec, ROC, sec ):
     return (x_delta, y_delta, thr_delta)
 
 
+def integrateOdometry( distances, rawAngles, startPose=(0.0,0.0,0.0) ):
+    """ integrates whole arrays of odometry readings at once, the
+    way Create._integrateNextOdometricStepCreate does one at a time
+
+    distances are the DISTANCE readings in mm
+    rawAngles are the ANGLE readings in degrees
+    startPose is (x mm, y mm, th radians)
+
+    returns an N x 3 numpy array whose row i is the pose
+    (x mm, y mm, th radians) after reading i; needs numpy
+    """
+    if numpy is None:
+        raise ImportError('integrateOdometry needs numpy')
+    d = numpy.asarray(distances, dtype=numpy.float64)
+    a = numpy.asarray(rawAngles, dtype=numpy.float64)
+    dthr = numpy.radians(a)
+    # the heading before each step, summed in the same order as
+    # the scalar version adds them up
+    th = numpy.cumsum(numpy.concatenate(([startPose[2]], dthr)))
+    before = th[:-1]
+
+    # the arc of each step, in the robot's frame at its start;
+    # steps with no turn go straight and steps with no distance
+    # turn in place
+    arc = (a != 0) & (d != 0)
+    ROC = numpy.divide(d, dthr, out=numpy.zeros_like(d), where=arc)
+    dx = numpy.where(arc, ROC*numpy.sin(dthr), numpy.where(a == 0, d, 0.0))
+    dy = numpy.where(arc, ROC - ROC*numpy.cos(dthr), 0.0)
+
+    # into the global frame
+    dx_global = dx*numpy.cos(before) + dy*numpy.cos(before + math.pi/2.0)
+    dy_global = dx*numpy.sin(before) + dy*numpy.sin(before + math.pi/2.0)
+
+    poses = numpy.empty((len(d), 3))
+    poses[:,0] = numpy.cumsum(numpy.concatenate(([startPose[0]], dx_global)))[1:]
+    poses[:,1] = numpy.cumsum(numpy.concatenate(([startPose[1]], dy_global)))[1:]
+    poses[:,2] = th[1:]
+    return poses
+
+
+#
+# module-level functions that encode the Open Interface commands
+#
+# each of these returns a whole command, opcode and data bytes,
+# as a single byte string, so that every command goes out to the
+# robot in one write (see Create._send)
+#
+_OPCODE_AND_WORD = struct.Struct('>BH')       # WAITDIST, WAITANGLE
+_OPCODE_AND_TWO_WORDS = struct.Struct('>BHH')  # DRIVE, DRIVEDIRECT
+_OPCODE_AND_THREE_BYTES = struct.Struct('>BBBB')  # LEDS
+
+def _u16( value ):
+    """ returns the 16 bits of value (two's complement if negative)
+    as an unsigned int, ready for packing
+    """
+    return int(value) & 0xFFFF
+
+def _byteCommand( opcode, value ):
+    """ encodes a command that takes a single data byte,
+    e.g. PLAY, SENSORS, DEMO, SCRIPT or PAUSERESUME
+    """
+    return opcode + _chr(value)
+
+def _listCommand( opcode, values ):
+    """ encodes a command followed by a count and that many data
+    bytes, e.g. QUERYLIST or STREAM
+    """
+    return opcode + bytes([len(values)] + list(values))
+
+def _driveCommand( roomba_mm_sec, roomba_radius_mm, turn_dir='CCW' ):
+    """ encodes the DRIVE command, capping the inputs the same way
+    Create._drive always has
+    """
+    # first, they should be ints
+    #   in case they're being generated mathematically
+    roomba_mm_sec = int(roomba_mm_sec)
+    roomba_radius_mm = int(roomba_radius_mm)
+
+    # we check that the inputs are within limits
+    # if not, we cap them there
+    if roomba_mm_sec < -500:
+        roomba_mm_sec = -500
+    if roomba_mm_sec > 500:
+        roomba_mm_sec = 500
+
+    # if the radius is beyond the limits, we go straight
+    # it doesn't really seem to go straight, however...
+    if roomba_radius_mm < -2000:
+        roomba_radius_mm = 32768
+    if roomba_radius_mm > 2000:
+        roomba_radius_mm = 32768
+
+    # note the special cases
+    if roomba_radius_mm == 0:
+        if turn_dir == 'CW':
+            roomba_radius_mm = -1
+        else: # default is 'CCW' (turning left)
+            roomba_radius_mm = 1
+
+    return _OPCODE_AND_TWO_WORDS.pack( DRIVE[0], _u16(roomba_mm_sec), _u16(roomba_radius_mm) )
+
+def _goCommand( cm_per_sec=0, deg_per_sec=0 ):
+    """ encodes the DRIVE command that gives the robot a velocity of
+    cm_per_sec centimeters per second and deg_per_sec degrees per
+    second, as in Create.go
+    """
+    # need to convert to the roomba's drive parameters
+    #
+    # for now, just one or the other...
+    if cm_per_sec == 0:
+        # just handle rotation
+        # convert to radians
+        rad_per_sec = math.radians(deg_per_sec)
+        # make sure the direction is correct
+        if rad_per_sec >= 0:  dirstr = 'CCW'
+        else: dirstr = 'CW'
+        # compute the velocity, given that the robot's
+        # radius is 258mm/2.0
+        vel_mm_sec = math.fabs(rad_per_sec) * (258.0/2.0)
+        return _driveCommand( vel_mm_sec, 0, dirstr )
+
+    elif deg_per_sec == 0:
+        # just handle forward/backward translation
+        vel_mm_sec = 10.0*cm_per_sec
+        big_radius = 32767
+        return _driveCommand( vel_mm_sec, big_radius )
+
+    else:
+        # move in the appropriate arc
+        rad_per_sec = math.radians(deg_per_sec)
+        vel_mm_sec = 10.0*cm_per_sec
+        radius_mm = vel_mm_sec / rad_per_sec
+        # check for extremes
+        if radius_mm > 32767: radius_mm = 32767
+        if radius_mm < -32767: radius_mm = -32767
+        return _driveCommand( vel_mm_sec, radius_mm )
+
+def _driveDirectCommand( left_mm_sec, right_mm_sec ):
+    """ encodes the DRIVEDIRECT command (note that the right wheel
+    comes first)
+    """
+    return _OPCODE_AND_TWO_WORDS.pack( DRIVEDIRECT[0], _u16(right_mm_sec), _u16(left_mm_sec) )
+
+def _wheelVelocitiesCommand( left_cm_sec, right_cm_sec ):
+    """ encodes the DRIVEDIRECT command for wheel velocities in
+    cm/sec, capped at +- 50, as in Create.setWheelVelocities
+    """
+    if left_cm_sec < -50: left_cm_sec = -50;
+    if left_cm_sec > 50:  left_cm_sec = 50;
+    if right_cm_sec < -50: right_cm_sec = -50;
+    if right_cm_sec > 50: right_cm_sec = 50;
+    # convert to mm/sec, ensure we have integers
+    return _driveDirectCommand( int(left_cm_sec*10), int(right_cm_sec*10) )
+
+def _ledsCommand( bits, power_color, power_intensity ):
+    """ encodes the LEDS command """
+    return _OPCODE_AND_THREE_BYTES.pack( LEDS[0], bits, power_color, power_intensity )
+
+def _setLEDsCommand( power_color, power_intensity, play, advance ):
+    """ encodes the LEDS command for the inputs of Create.setLEDs,
+    which have to be ints; they are kept within range
+    """
+    if advance != 0: advance = 1
+    if play != 0: play = 1
+    power = min(max(int(power_intensity), 0), 255)
+    powercolor = min(max(int(power_color), 0), 255)
+    return _ledsCommand( (advance << 3) | (play << 1), powercolor, power )
+
+def _songCommand( songNumber, songDataList ):
+    """ encodes the SONG command for up to 16 (note, duration) pairs;
+    anything that isn't a tuple becomes a 1/4 second rest
+    """
+    L = min(len(songDataList), 16)
+    data = [ SONG[0], songNumber, L ]
+    for note in songDataList[:L]:
+        # make sure its a tuple, or else we rest for 1/4 second
+        if type(note) == type( () ):
+            data.append( note[0] )  # note number
+            data.append( note[1] )  # duration
+        else:
+            data.append( 30 )   # a rest note
+            data.append( 16 )   # 1/4 of a second
+    return bytes(data)
+
+def _waitCommand( opcode, value ):
+    """ encodes WAITDIST or WAITANGLE with its signed 16-bit value """
+    return _OPCODE_AND_WORD.pack( opcode[0], _u16(value) )
+
+
+#
+# scripts: commands the robot runs by itself
+#
+# the most bytes of script the Create can hold
+SCRIPT_MAX_BYTES = 100
+
+class Script:
+    """ builds a script, a sequence of commands that the robot runs
+    by itself (see Create.runScript), with no round trips to the
+    host between them, e.g.
+
+        backOff = Script().move(-15, 30).turn(180, 90)
+        robot.runScript(backOff)
+
+    each method adds to the script and returns it, so calls can be
+    chained.  The Create only holds SCRIPT_MAX_BYTES of script, so a
+    longer script is split into segments that are run one after
+    another; a wait always goes in the same segment as the command
+    before it, and a move or turn is never split
+    """
+
+    def __init__(self):
+        # lists of commands that have to go in the same segment
+        self.steps = []
+        # slot -> song, for the songs the script stores
+        self.songs = {}
+
+    def __len__(self):
+        """ the number of bytes of script, over all the segments """
+        return sum([ len(c) for step in self.steps for c in step ])
+
+    def _add(self, *commands):
+        self.steps.append(list(commands))
+        return self
+
+    def _addWait(self, command):
+        if self.steps:
+            self.steps[-1].append(command)
+            return self
+        return self._add(command)
+
+    def go(self, cm_per_sec=0, deg_per_sec=0):
+        """ drives as Create.go does """
+        return self._add( _goCommand(cm_per_sec, deg_per_sec) )
+
+    def stop(self):
+        """ stops the robot """
+        return self.go(0, 0)
+
+    def setWheelVelocities(self, left_cm_sec, right_cm_sec):
+        """ drives as Create.setWheelVelocities does """
+        return self._add( _wheelVelocitiesCommand(left_cm_sec, right_cm_sec) )
+
+    def setLEDs(self, power_color, power_intensity, play, advance):
+        """ sets the LEDs as Create.setLEDs does """
+        return self._add( _setLEDsCommand(power_color, power_intensity, play, advance) )
+
+    def setSong(self, songNumber, songDataList):
+        """ stores a song (up to 16 notes) in slot songNumber, 0 - 15 """
+        songNumber = min(max(songNumber, 0), 15)
+        command = _songCommand( songNumber, songDataList )
+        self.songs[songNumber] = command[2:]
+        return self._add( command )
+
+    def playSongNumber(self, songNumber):
+        """ plays the song in slot songNumber """
+        return self._add( _byteCommand( PLAY, min(max(songNumber, 0), 15) ) )
+
+    def playSong(self, list_of_notes, songNumber=0):
+        """ stores list_of_notes in slot songNumber and plays it """
+        self.setSong(songNumber, list_of_notes)
+        self.steps[-1].append( _byteCommand( PLAY, min(max(songNumber, 0), 15) ) )
+        return self
+
+    def wait(self, seconds):
+        """ waits for seconds, to the nearest tenth """
+        tenths = int(round(seconds * 10))
+        while tenths > 0:
+            self._addWait( _byteCommand( WAIT, min(tenths, 255) ) )
+            tenths -= 255
+        return self
+
+    def waitDistance(self, distance_cm):
+        """ waits for the robot to have moved distance_cm (backwards
+        if negative) since the wait began
+        """
+        return self._addWait( _waitCommand( WAITDIST, distance_cm*10 ) )
+
+    def waitAngle(self, angle_deg):
+        """ waits for the robot to have turned angle_deg
+        (counterclockwise if positive) since the wait began
+        """
+        return self._addWait( _waitCommand( WAITANGLE, angle_deg ) )
+
+    def move(self, distance_cm, cm_per_sec=10):
+        """ moves distance_cm straight ahead (or back) at cm_per_sec
+        and stops, as Create.move does
+        """
+        if distance_cm==0:
+            return self
+        if cm_per_sec==0:
+            cm_per_sec=10
+        if (distance_cm < 0 and cm_per_sec > 0) or (distance_cm > 0 and cm_per_sec < 0):
+            cm_per_sec = 0 - cm_per_sec
+        return self._add( _goCommand(cm_per_sec, 0),
+                          _waitCommand( WAITDIST, distance_cm*10 ),
+                          _goCommand(0, 0) )
+
+    def turn(self, angle_deg, deg_per_sec=20):
+        """ turns angle_deg in place at deg_per_sec and stops, as
+        Create.turn does
+        """
+        if angle_deg==0:
+            return self
+        if deg_per_sec==0:
+            deg_per_sec=20
+        if (angle_deg < 0 and deg_per_sec > 0) or (angle_deg > 0 and deg_per_sec < 0):
+            deg_per_sec = 0 - deg_per_sec
+        return self._add( _goCommand(0, deg_per_sec),
+                          _waitCommand( WAITANGLE, angle_deg ),
+                          _goCommand(0, 0) )
+
+    def segments(self):
+        """ returns the script split into segments that each fit in
+        the robot, as lists of commands; raises ValueError if a
+        command and its waits don't fit in one
+        """
+        segments = []
+        segment = []
+        size = 0
+        for step in self.steps:
+            stepSize = sum([ len(c) for c in step ])
+            if stepSize > SCRIPT_MAX_BYTES:
+                raise ValueError('a script step of %d bytes is longer than the %d the robot holds'
+                                 % (stepSize, SCRIPT_MAX_BYTES))
+            if size + stepSize > SCRIPT_MAX_BYTES:
+                segments.append(segment)
+                segment = []
+                size = 0
+            segment.extend(step)
+            size += stepSize
+        if segment:
+            segments.append(segment)
+        return segments
+
+    def compile(self):
+        """ returns the SCRIPT command that uploads each segment """
+        return [ _listCommand( SCRIPT, b''.join(segment) ) for segment in self.segments() ]
+
+
 #
 # this class represents a snapshot of the robot's data
 #
+def _frameField( name, doc ):
+    """ a SensorFrame field that is the whole of a sensor's value """
+    def get(self):
+        return int(self.record[name])
+    def set(self, value):
+        self.record[name] = value
+    return property(get, set, doc=doc)
+
+def _frameBit( name, bit, doc ):
+    """ a SensorFrame field that is one bit of a sensor's value """
+    def get(self):
+        return (int(self.record[name]) >> bit) & 1
+    def set(self, value):
+        old = int(self.record[name]) & ~(1 << bit)
+        self.record[name] = old | ((value & 1) << bit)
+    return property(get, set, doc=doc)
+
 class SensorFrame:
     """ the sensorFrame class is really a struct whose
     fields are filled in by sensorStatus
+
+    its data is one record of SENSOR_DTYPE (a field per raw sensor,
+    laid out as in group packet 6), and the fields below read and
+    write the values and bits of that record; see decodeSensorPackets
+    for decoding many packets at once
     """
 
-    def __init__(self):
-        """ constructor -- set all fields to 0
-
-        see _interpretSensorString for details
-        on all of these fields
-        """
-        self.casterDrop = 0
-        self.leftWheelDrop = 0
-        self.rightWheelDrop = 0
-        self.leftBump = 0
-        self.rightBump = 0
-        self.wallSensor = 0
-        self.leftCliff = 0
-        self.frontLeftCliff = 0
-        self.frontRightCliff = 0
-        self.rightCliff = 0
-        self.virtualWall = 0
-        self.driveLeft = 0
-        self.driveRight = 0
-        self.mainBrush = 0
-        self.vacuum = 0
-        self.sideBrush = 0
-        self.leftDirt = 0
-        self.rightDirt = 0
-        self.remoteControlCommand = 0
-        self.powerButton = 0
-        self.spotButton = 0
-        self.cleanButton = 0
-        self.maxButton = 0
-        self.distance = 0
-        self.rawAngle = 0
-        self.angleInRadians = 0
-        self.chargingState = 0
-        self.voltage = 0
-        self.current = 0
-        self.temperature = 0
-        self.charge = 0
-        self.capacity = 0
+    __slots__ = ('record',)
+
+    def __init__(self, record=None):
+        """ constructor -- set all fields to 0, or to those in
+        record, a row of the array decodeSensorPackets returns for
+        any of the group packets (the sensors that aren't in that
+        packet are left at 0)
+        """
+        if numpy is None:
+            raise ImportError('SensorFrame needs numpy')
+        self.record = numpy.zeros((), dtype=SENSOR_DTYPE)
+        if record is not None:
+            for name in record.dtype.names:
+                self.record[name] = record[name]
+
+    # packet 7: bumps and wheel drops
+    casterDrop = _frameBit('bumpsAndWheelDrops', 4, 'the caster wheel has dropped')
+    leftWheelDrop = _frameBit('bumpsAndWheelDrops', 3, 'the left wheel has dropped')
+    rightWheelDrop = _frameBit('bumpsAndWheelDrops', 2, 'the right wheel has dropped')
+    leftBump = _frameBit('bumpsAndWheelDrops', 1, 'the left bumper is pressed')
+    rightBump = _frameBit('bumpsAndWheelDrops', 0, 'the right bumper is pressed')
+    # packets 8 - 13: the wall IR (looking to the right), the cliff
+    # sensors and the virtual wall detector (the separate unit)
+    wallSensor = _frameBit('wall', 0, 'the wall IR sees a wall')
+    leftCliff = _frameBit('cliffLeft', 0, 'the left cliff sensor sees a drop')
+    frontLeftCliff = _frameBit('cliffFrontLeft', 0, 'the front left cliff sensor sees a drop')
+    frontRightCliff = _frameBit('cliffFrontRight', 0, 'the front right cliff sensor sees a drop')
+    rightCliff = _frameBit('cliffRight', 0, 'the right cliff sensor sees a drop')
+    virtualWall = _frameBit('virtualWall', 0, 'a virtual wall is in sight')
+    # packet 14: overcurrents (the Roomba's motor names for them)
+    driveLeft = _frameBit('overcurrents', 4, 'the left wheel draws too much current')
+    driveRight = _frameBit('overcurrents', 3, 'the right wheel draws too much current')
+    mainBrush = _frameBit('overcurrents', 2, 'low side driver 2 draws too much current')
+    vacuum = _frameBit('overcurrents', 1, 'low side driver 0 draws too much current')
+    sideBrush = _frameBit('overcurrents', 0, 'low side driver 1 draws too much current')
+    # packets 15 and 16 were the Roomba's dirt detectors; unused on the Create
+    leftDirt = _frameField('unused15', 'unused on the Create (the Roomba\'s left dirt detector)')
+    rightDirt = _frameField('unused16', 'unused on the Create (the Roomba\'s right dirt detector)')
+    # packet 17: the remote control command being seen, 255 for none
+    remoteControlCommand = _frameField('infrared', 'the IR byte being received, 255 for none')
+    # packet 18: buttons (the Create only has advance and play)
+    powerButton = _frameBit('buttons', 3, 'unused on the Create')
+    spotButton = _frameBit('buttons', 2, 'the advance button is pressed')
+    cleanButton = _frameBit('buttons', 1, 'unused on the Create')
+    maxButton = _frameBit('buttons', 0, 'the play button is pressed')
+    advanceButton = spotButton
+    playButton = maxButton
+    # packets 19 and 20: distance (mm) and angle (degrees) since they were last read
+    distance = _frameField('distance', 'mm travelled since the last reading')
+    rawAngle = _frameField('angle', 'degrees turned (counterclockwise) since the last reading')
+    # packets 21 - 26: the battery
+    chargingState = _frameField('chargingState', '0 not charging ... 5 charging error')
+    voltage = _frameField('voltage', 'the battery voltage, in mV')
+    current = _frameField('current', 'the battery current, in mA (negative when discharging)')
+    temperature = _frameField('temperature', 'the battery temperature, in degrees C')
+    charge = _frameField('charge', 'the battery charge, in mAh')
+    capacity = _frameField('capacity', 'the estimated battery capacity, in mAh')
+
+    @property
+    def angleInRadians(self):
+        """ rawAngle in radians (the Create reports the angle in degrees) """
+        return math.radians(self.rawAngle)
 
     def __str__(self):
         """ returns a string with the information
         from this SensorFrame
         """
-        # there's probably a more efficient way to do this...
-        # perhaps just making it all + instead of the separate
-        # += would be more efficient
-        #
-        # actually, we should make a list and call ''.join(list)
-        # not that we will...
-        #
-        s = ''
-        s += 'casterDrop: ' + str(self.casterDrop) + '\n'
-        s += 'leftWheelDrop: ' + str(self.leftWheelDrop) + '\n'
-        s += 'rightWheelDrop: ' + str(self.rightWheelDrop) + '\n'
-        s += 'leftBump: ' + str(self.leftBump) + '\n'
-        s += 'rightBump: ' + str(self.rightBump) + '\n'
-        s += 'wallSensor: ' + str(self.wallSensor) + '\n'
-        s += 'leftCliff: ' + str(self.leftCliff) + '\n'
-        s += 'frontLeftCliff: ' + str(self.frontLeftCliff) + '\n'
-        s += 'frontRightCliff: ' + str(self.frontRightCliff) + '\n'
-        s += 'rightCliff: ' + str(self.rightCliff) + '\n'
-        s += 'virtualWall: ' + str(self.virtualWall) + '\n'
-        s += 'driveLeft: ' + str(self.driveLeft) + '\n'
-        s += 'driveRight: ' + str(self.driveRight) + '\n'
-        s += 'mainBrush: ' + str(self.mainBrush) + '\n'
-        s += 'vacuum: ' + str(self.vacuum) + '\n'
-        s += 'sideBrush: ' + str(self.sideBrush) + '\n'
-        s += 'leftDirt: ' + str(self.leftDirt) + '\n'
-        s += 'rightDirt: ' + str(self.rightDirt) + '\n'
-        s += 'remoteControlCommand: ' + str(self.remoteControlCommand) + '\n'
-        s += 'powerButton: ' + str(self.powerButton) + '\n'
-        s += 'spotButton: ' + str(self.spotButton) + '\n'
-        s += 'cleanButton: ' + str(self.cleanButton) + '\n'
-        s += 'maxButton: ' + str(self.maxButton) + '\n'
-        s += 'distance: ' + str(self.distance) + '\n'
-        s += 'rawAngle: ' + str(self.rawAngle) + '\n'
-        s += 'angleInRadians: ' + str(self.angleInRadians) + '\n'
+        names = ['casterDrop', 'leftWheelDrop', 'rightWheelDrop', 'leftBump',
+                 'rightBump', 'wallSensor', 'leftCliff', 'frontLeftCliff',
+                 'frontRightCliff', 'rightCliff', 'virtualWall', 'driveLeft',
+                 'driveRight', 'mainBrush', 'vacuum', 'sideBrush', 'leftDirt',
+                 'rightDirt', 'remoteControlCommand', 'powerButton', 'spotButton',
+                 'cleanButton', 'maxButton', 'distance', 'rawAngle', 'angleInRadians']
+        lines = [ name + ': ' + str(getattr(self, name)) for name in names ]
         # no data member needed for this next line
-        s += 'angleInDegrees: ' + str(math.degrees(self.angleInRadians)) + '\n'
-        s += 'chargingState: ' + str(self.chargingState) + '\n'
-        s += 'voltage: ' + str(self.voltage) + '\n'
-        s += 'current: ' + str(self.current) + '\n'
-        s += 'temperature: ' + str(self.temperature) + '\n'
-        s += 'charge: ' + str(self.charge) + '\n'
-        s += 'capacity: ' + str(self.capacity) + '\n'
-        return s
+        lines.append('angleInDegrees: ' + str(math.degrees(self.angleInRadians)))
+        for name in ['chargingState', 'voltage', 'current', 'temperature',
+                     'charge', 'capacity']:
+            lines.append(name + ': ' + str(getattr(self, name)))
+        return '\n'.join(lines) + '\n'
+
+    def _toBinaryString(self, packetnumber=0):
+        """ this converts the calling SensorFrame into the bytes
+        the Create sends back for group packet packetnumber
+        (26 bytes for the default, group 0)
+        """
+        return _selectSensorFields(self.record, SENSOR_GROUPS[packetnumber]).tobytes()
+
+
+
+def _rawSensorList( list_of_sensors ):
+    """ returns a new list of the raw sensor numbers that have to be
+    read from the Create to fill in list_of_sensors, which may
+    contain the "easy access" values such as POSE or LEFT_BUMP
+    """
+    rawSensors = []
+    for sensorNum in list_of_sensors:
+        for rawNum in SENSOR_SOURCES.get(sensorNum, [sensorNum]):
+            if rawNum not in rawSensors:
+                rawSensors.append(rawNum)
+    return rawSensors
+
 
-    def _toBinaryString(self):
-        """ this converts the calling SensorFrame into a 26-byte
-        string of the format the roomba sends back
+#
+# decoding sensor data
+#
+# each raw sensor is read with one struct format code...
+_SENSOR_FORMAT = [ None, None, None, None, None, None, None, # 0 - 6 are groups
+                   'B', # 7 BUMPS_AND_WHEEL_DROPS
+                   'B', 'B', 'B', 'B', 'B', 'B', # 8 WALL_IR_SENSOR - 13 VIRTUAL_WALL
+                   'B', # 14 LSD_AND_OVERCURRENTS
+                   'B', 'B', # 15, 16 unused
+                   'B', # 17 INFRARED_BYTE
+                   'B', # 18 BUTTONS
+                   'h', 'h', # 19 DISTANCE, 20 ANGLE
+                   'B', # 21 CHARGING_STATE
+                   'H', # 22 VOLTAGE
+                   'h', # 23 CURRENT
+                   'b', # 24 BATTERY_TEMP
+                   'H', 'H', # 25 BATTERY_CHARGE, 26 BATTERY_CAPACITY
+                   'H', 'H', 'H', 'H', 'H', # 27 WALL_SIGNAL - 31 CLIFF_RIGHT_SIGNAL
+                   'B', # 32 CARGO_BAY_DIGITAL_INPUTS
+                   'H', # 33 CARGO_BAY_ANALOG_SIGNAL
+                   'B', 'B', 'B', 'B', 'B', # 34 CHARGING_SOURCES_AVAILABLE - 38 NUM_STREAM_PACKETS
+                   'h', 'h', 'h', 'h' ] # 39 REQUESTED_VELOCITY - 42 REQUESTED_LEFT_VELOCITY
+
+# ...and the bitfield and on/off sensors are then looked up in one of
+# these tables, indexed by the byte's value; the bitfields are shared
+# tuples, so each reading gets its own list of them
+_LOWER_5_BITS = [ ((b>>4)&1, (b>>3)&1, (b>>2)&1, (b>>1)&1, b&1) for b in range(256) ]
+_BUTTON_BITS = [ ((b>>2)&1, b&1) for b in range(256) ]
+_ONE_BIT = [ 1 if b == 1 else 0 for b in range(256) ]
+
+# sensor: (lookup table, the "easy access" values filled in from its bits)
+_SENSOR_TABLES = { BUMPS_AND_WHEEL_DROPS: (_LOWER_5_BITS, (CENTER_WHEEL_DROP,
+                                                           LEFT_WHEEL_DROP,
+                                                           RIGHT_WHEEL_DROP,
+                                                           LEFT_BUMP,
+                                                           RIGHT_BUMP)),
+                   WALL_IR_SENSOR: (_ONE_BIT, ()),
+                   CLIFF_LEFT: (_ONE_BIT, ()),
+                   CLIFF_FRONT_LEFT: (_ONE_BIT, ()),
+                   CLIFF_FRONT_RIGHT: (_ONE_BIT, ()),
+                   CLIFF_RIGHT: (_ONE_BIT, ()),
+                   VIRTUAL_WALL: (_ONE_BIT, ()),
+                   LSD_AND_OVERCURRENTS: (_LOWER_5_BITS, (LEFT_WHEEL_OVERCURRENT,
+                                                          RIGHT_WHEEL_OVERCURRENT)),
+                   15: (_ONE_BIT, ()),
+                   16: (_ONE_BIT, ()),
+                   BUTTONS: (_BUTTON_BITS, (ADVANCE_BUTTON, PLAY_BUTTON)),
+                   CARGO_BAY_DIGITAL_INPUTS: (_LOWER_5_BITS, ()) }
+
+class _SensorDecoder:
+    """ turns the reply to a request for a particular list of
+    sensors into sensor values, with one struct unpack for the
+    whole reply followed by table lookups for the bitfields
+    """
+
+    def __init__(self, sensorList):
+        self.sensorList = tuple(sensorList)
+        self.struct = struct.Struct('>' + ''.join([ _SENSOR_FORMAT[s] for s in self.sensorList ]))
+        self.size = self.struct.size
+        # (position in the reply, sensor, table, easy access values)
+        self.lookups = [ (i, s) + _SENSOR_TABLES[s]
+                         for i, s in enumerate(self.sensorList) if s in _SENSOR_TABLES ]
+        self.distanceAt = self._positionOf(DISTANCE)
+        self.angleAt = self._positionOf(ANGLE)
+
+    def _positionOf(self, sensor):
+        """ where sensor's value is in the reply, or None """
+        if sensor in self.sensorList:
+            return self.sensorList.index(sensor)
+        return None
+
+    def sensorsInBytes(self, size):
+        """ returns the leading sensors whose data fits in size bytes """
+        used = 0
+        for i, s in enumerate(self.sensorList):
+            used += SENSOR_DATA_WIDTH[s]
+            if used > size:
+                return self.sensorList[:i]
+        return self.sensorList
+
+    def decodeInto(self, d, r):
+        """ decodes the reply r (bytes, a bytearray, a memoryview or a
+        list of ints) into the sensor dictionary d, and returns the
+        (distance, angle) it contained -- 0 for any not requested
         """
-        # todo: handle the different subsets (frames) of sensor data
+        if type(r) == type([]):
+            r = bytes(r)
+        values = self.struct.unpack_from(r)
+        d.update(zip(self.sensorList, values))
+        for i, s, table, parts in self.lookups:
+            bits = table[values[i]]
+            if type(bits) is tuple:
+                d[s] = list(bits)
+            else:
+                d[s] = bits
+            if parts:
+                for part, bit in zip(parts, bits):
+                    d[part] = bit
+        distance = 0
+        angle = 0
+        if self.distanceAt is not None:
+            distance = values[self.distanceAt]
+        if self.angleAt is not None:
+            angle = values[self.angleAt]
+        return (distance, angle)
+
+# compiled decoders, keyed by the tuple of sensors
+_sensorDecoders = {}
+# a bound on the number of decoders (and query plans) kept, in case
+# of callers that ask for a different set of sensors every time
+_MAX_SENSOR_PLANS = 256
+
+def _sensorDecoder( sensorList ):
+    """ returns the (cached) _SensorDecoder for sensorList """
+    key = tuple(sensorList)
+    decoder = _sensorDecoders.get(key)
+    if decoder is None:
+        if len(_sensorDecoders) >= _MAX_SENSOR_PLANS:
+            _sensorDecoders.clear()
+        decoder = _SensorDecoder(key)
+        _sensorDecoders[key] = decoder
+    return decoder
 
-        # here are the 26 bytes in list form
-        slist = [0]*26
 
-        # First Frame
+#
+# decoding sensor data in bulk
+#
+# the name of each raw sensor's field in the numpy records...
+_SENSOR_FIELDS = [ None, None, None, None, None, None, None, # 0 - 6 are groups
+                   'bumpsAndWheelDrops', 'wall', 'cliffLeft', 'cliffFrontLeft',
+                   'cliffFrontRight', 'cliffRight', 'virtualWall', 'overcurrents',
+                   'unused15', 'unused16', 'infrared', 'buttons', 'distance',
+                   'angle', 'chargingState', 'voltage', 'current', 'temperature',
+                   'charge', 'capacity', 'wallSignal', 'cliffLeftSignal',
+                   'cliffFrontLeftSignal', 'cliffFrontRightSignal',
+                   'cliffRightSignal', 'cargoBayDigitalInputs',
+                   'cargoBayAnalogSignal', 'chargingSources', 'oiMode',
+                   'songNumber', 'songPlaying', 'numStreamPackets',
+                   'requestedVelocity', 'requestedRadius',
+                   'requestedRightVelocity', 'requestedLeftVelocity' ]
+
+# ...and the numpy type for each struct format code in _SENSOR_FORMAT
+_NUMPY_FORMAT = { 'B': 'u1', 'b': 'i1', 'H': '>u2', 'h': '>i2' }
+
+def sensorDtype( sensorList ):
+    """ returns the numpy dtype of the reply to a request for the raw
+    sensors in sensorList: packed, big-endian and with one field per
+    sensor (named as in _SENSOR_FIELDS), so that its itemsize is the
+    size of the reply; needs numpy
+    """
+    if numpy is None:
+        raise ImportError('sensorDtype needs numpy')
+    return numpy.dtype([ (_SENSOR_FIELDS[s], _NUMPY_FORMAT[_SENSOR_FORMAT[s]])
+                         for s in sensorList ])
+
+if numpy is not None:
+    # every raw sensor, as in group packet 6 -- the record behind a SensorFrame
+    SENSOR_DTYPE = sensorDtype(SENSOR_GROUPS[6])
+    # the layout of each of the group packets 0 - 6
+    SENSOR_GROUP_DTYPES = dict([ (g, sensorDtype(SENSOR_GROUPS[g])) for g in SENSOR_GROUPS ])
+
+def decodeSensorPackets( data, packetnumber=6 ):
+    """ decodes data (bytes, a bytearray or a memoryview) holding one
+    or more replies back to back into a numpy array with one record
+    per reply -- thousands of them at once, say from a TelemetryLog --
+    without copying; a partial reply at the end is left out
+
+    packetnumber is the group packet (0 - 6) the replies are, or a
+    list of the raw sensors each one holds, as for a QUERYLIST; needs
+    numpy.  The array shares data's memory, so it is read-only if
+    data is bytes
+    """
+    if numpy is None:
+        raise ImportError('decodeSensorPackets needs numpy')
+    if type(packetnumber) == type(1):
+        dtype = SENSOR_GROUP_DTYPES[packetnumber]
+    else:
+        dtype = sensorDtype(packetnumber)
+    return numpy.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
 
-        # byte 0: bumps and wheeldrops
-        slist[0] = self.casterDrop << 4 | \
-            self.leftWheelDrop << 3 | \
-            self.rightWheelDrop << 2 | \
-            self.leftBump << 1 | \
-            self.rightBump
+def _selectSensorFields( records, sensorList ):
+    """ returns a copy of records (a SENSOR_DTYPE record or array of
+    them) holding only the sensors in sensorList, laid out as the
+    reply to a request for them
+    """
+    out = numpy.zeros(records.shape, dtype=sensorDtype(sensorList))
+    for name in out.dtype.names:
+        out[name] = records[name]
+    return out
 
-        # byte 1: wall data
-        slist[1] = self.wallSensor
 
-        # byte 2: cliff left
-        slist[2] = self.leftCliff
-        # byte 3: cliff front left
-        slist[3] = self.frontLeftCliff
-        # byte 4: cliff front right
-        slist[4] = self.frontRightCliff
-        # byte 5: cliff right
-        slist[5] = self.rightCliff
+#
+# planning sensor queries
+#
+class _SensorPlan:
+    """ a compiled sensor request: the bytes to send, the sensors
+    whose values come back (in order) and the size of the reply
+    """
 
-        # byte 6: virtual wall
-        slist[6] = self.virtualWall
+    def __init__(self, request, sensorList, wanted):
+        self.request = request
+        self.sensorList = sensorList
+        self.decoder = _sensorDecoder(sensorList)
+        self.size = self.decoder.size
+        # the raw sensors that were actually asked for
+        self.wanted = wanted
+
+# compiled plans, keyed by the requested list (as a tuple) or group number
+_sensorPlans = {}
+
+def _planSensorQuery( list_of_sensors ):
+    """ returns the _SensorPlan for the cheapest way of reading
+    list_of_sensors (as in Create.sensors) from the robot
+
+    the cost of a request is the number of bytes that cross the
+    serial link: a QUERYLIST costs its 2 + N request bytes plus the
+    requested data, while a group packet costs 2 request bytes plus
+    the whole group, so a group wins once it is nearly all wanted
+    """
+    if type(list_of_sensors) == type([]) or type(list_of_sensors) == type(()):
+        key = tuple(list_of_sensors)
+    else:
+        key = list_of_sensors
+        if key not in SENSOR_GROUPS:
+            key = 6
+    plan = _sensorPlans.get(key)
+    if plan is not None:
+        return plan
+
+    if type(key) == type(()):
+        rawSensors = _rawSensorList(key)
+        plan = _SensorPlan( _listCommand( QUERYLIST, rawSensors ), rawSensors, rawSensors )
+        bestCost = len(plan.request) + plan.size
+        wanted = set(rawSensors)
+        for groupNumber, members in SENSOR_GROUPS.items():
+            if not wanted.issubset(members) or len(wanted) == 0:
+                continue
+            groupPlan = _SensorPlan( _byteCommand( SENSORS, groupNumber ), members, rawSensors )
+            cost = len(groupPlan.request) + groupPlan.size
+            if cost < bestCost:
+                plan = groupPlan
+                bestCost = cost
+    else:
+        plan = _SensorPlan( _byteCommand( SENSORS, key ), SENSOR_GROUPS[key], SENSOR_GROUPS[key] )
 
-        # byte 7: motor overcurrents
-        slist[7] = self.driveLeft << 4 | \
-            self.driveRight << 3 | \
-            self.mainBrush << 2 | \
-            self.vacuum << 1 | \
-            self.sideBrush
+    if len(_sensorPlans) >= _MAX_SENSOR_PLANS:
+        _sensorPlans.clear()
+    _sensorPlans[key] = plan
+    return plan
 
-        # byte 8: dirt detector left
-        slist[8] = self.leftDirt
-        # byte 9: dirt detector left
-        slist[9] = self.rightDirt
 
-        # Second Frame
+def _streamRequestFor( list_of_sensors ):
+    """ returns the packet ids to ask the Create to stream for
+    list_of_sensors (a list, as for sensors(), or a group packet
+    number) and the list of sensors those packets cover
+    """
+    if type(list_of_sensors) == type([]):
+        request = _rawSensorList(list_of_sensors)
+    else:
+        if list_of_sensors not in SENSOR_GROUPS:
+            list_of_sensors = 6
+        request = [list_of_sensors]
+    covered = []
+    for packetId in request:
+        covered.extend(SENSOR_GROUPS.get(packetId, [packetId]))
+    return (request, covered)
 
-        # byte 10: remote control command
-        slist[10] = self.remoteControlCommand
 
-        # byte 11: buttons
-        slist[11] = self.powerButton << 3 | \
-            self.spotButton << 2 | \
-            self.cleanButton << 1 | \
-            self.maxButton
+#
+# this class picks the packets out of the Create's sensor stream
+#
+class _StreamParser:
+    """ the _StreamParser collects the bytes sent back after a STREAM
+    command and splits them into packets of the form
 
-        # bytes 12, 13: distance
-        highVal, lowVal = _toTwosComplement2Bytes( self.distance )
-        slist[12] = highVal
-        slist[13] = lowVal
+      [19] [n-bytes] [packet id 1] [data...] [packet id 2] [data...] [checksum]
 
-        # bytes 14, 15: angle
-        highVal, lowVal = _toTwosComplement2Bytes( self.rawAngle )
-        slist[14] = highVal
-        slist[15] = lowVal
+    packets with a bad checksum are dropped and the parser
+    resynchronizes on the next header byte
+    """
 
-        # Third Frame
+    def __init__(self):
+        self.buffer = bytearray()
+        self.goodPackets = 0
+        self.badPackets = 0
 
-        # byte 16: charging state
-        slist[16] = self.chargingState
+    def reset(self):
+        """ forgets any partially received packet """
+        del self.buffer[:]
 
-        # bytes 17, 18: voltage
-        slist[17] = (self.voltage >> 8) & 0xFF
-        slist[18] = self.voltage & 0xFF
+    def feed(self, data):
+        """ adds the bytes in data to the buffer and returns a list
+        of (sensor list, data bytes) pairs, one per complete packet
+        """
+        buf = self.buffer
+        buf.extend(data)
+        packets = []
+        while True:
+            # skip to the next header byte
+            start = buf.find(STREAM_HEADER)
+            if start < 0:
+                del buf[:]
+                break
+            if start > 0:
+                del buf[:start]
+            if len(buf) < 2:
+                break
+            n = buf[1]
+            # header, n-bytes, the n bytes and the checksum
+            if len(buf) < n + 3:
+                break
+            if sum(buf[:n+3]) & 0xFF != 0:
+                # not really a header, try the next one
+                self.badPackets += 1
+                del buf[:1]
+                continue
+            packet = self._splitPayload(bytes(buf[2:n+2]))
+            del buf[:n+3]
+            if packet is None:
+                self.badPackets += 1
+                continue
+            self.goodPackets += 1
+            packets.append(packet)
+        return packets
+
+    def _splitPayload(self, payload):
+        """ turns the [id][data...] pairs of a packet's payload into
+        the list of sensors and the bytes of their values
+        """
+        sensorList = []
+        data = bytearray()
+        i = 0
+        while i < len(payload):
+            packetId = payload[i]
+            if packetId in SENSOR_GROUPS:
+                members = SENSOR_GROUPS[packetId]
+            elif 7 <= packetId < len(SENSOR_DATA_WIDTH):
+                members = [packetId]
+            else:
+                return None
+            width = sum([ SENSOR_DATA_WIDTH[m] for m in members ])
+            if i + 1 + width > len(payload):
+                return None
+            sensorList.extend(members)
+            data.extend(payload[i+1:i+1+width])
+            i += 1 + width
+        return (sensorList, bytes(data))
 
-        # bytes 19, 20: current
-        highVal, lowVal = _toTwosComplement2Bytes( self.current )
-        slist[19] = highVal
-        slist[20] = lowVal
 
-        # byte 21: temperature
-        slist[21] = self.temperature
 
-        # bytes 22, 23: charge
-        slist[22] = (self.charge >> 8) & 0xFF
-        slist[23] = self.charge & 0xFF
+#
+# waiting for something to happen to the sensors
+#
+class SensorWatch:
+    """ a SensorWatch is returned by Create.watch and fires when the
+    sensor data matches its predicate: its event is set, its callback
+    (if any) is called and sensord holds a copy of the sensor
+    dictionary it fired on
+    """
 
-        # bytes 24, 25: capacity
-        slist[24] = (self.capacity >> 8) & 0xFF
-        slist[25] = self.capacity & 0xFF
+    def __init__(self, robot, predicate, sensors, callback, once):
+        self.robot = robot
+        self.predicate = predicate
+        self.sensors = sensors
+        self.callback = callback
+        self.once = once
+        self.event = threading.Event()
+        self.sensord = None
+        self.fired = 0
+        # an exception raised by the predicate, which also fires the watch
+        self.error = None
+
+    def _fire(self, sensord):
+        """ called by the robot, without its sensor lock held, so the
+        callback may use the robot
+        """
+        self.sensord = sensord
+        self.fired += 1
+        self.event.set()
+        if self.callback is not None and self.error is None:
+            self.callback(sensord)
+
+    def cancel(self):
+        """ stops watching """
+        with self.robot._sensorLock:
+            if self in self.robot._watches:
+                self.robot._watches.remove(self)
+
+    def isSet(self):
+        """ returns True once the watch has fired """
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """ waits until the watch fires, for at most timeout seconds
+        (forever if None), and returns True if it did
+
+        when the robot isn't streaming, this polls the watched sensors
+        as fast as the serial link allows -- or every STREAM_PERIOD,
+        while sensors() answers from memory (during a motion, or when
+        the sensors were read less than their max age ago)
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not self.event.is_set():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            if self.robot.isStreaming() or len(self.sensors) == 0:
+                self.event.wait(remaining)
+            else:
+                sent = self.robot._queriesSent
+                self.robot.sensors(self.sensors)
+                if self.robot._queriesSent == sent:
+                    # nothing new was read, and nothing will be for a while
+                    if remaining is None or remaining > STREAM_PERIOD:
+                        remaining = STREAM_PERIOD
+                    self.event.wait(remaining)
+        return self.event.is_set()
+
+# some predicates for Create.watch
+def bumped( d ):
+    """ true when either bumper is pressed """
+    return d.get(LEFT_BUMP) == 1 or d.get(RIGHT_BUMP) == 1
+
+def cliffDetected( d ):
+    """ true when any of the four cliff sensors sees a cliff """
+    return ( d.get(CLIFF_LEFT) == 1 or d.get(CLIFF_FRONT_LEFT) == 1 or
+             d.get(CLIFF_FRONT_RIGHT) == 1 or d.get(CLIFF_RIGHT) == 1 )
+
+def travelled( distance_cm, fromPose ):
+    """ returns a predicate that is true once the POSE in the sensor
+    dictionary is more than distance_cm away from fromPose (as
+    returned by getPose), e.g.
+
+      robot.watch(create.travelled(50, robot.getPose()), [create.POSE])
+    """
+    def f( d ):
+        pose = d.get(POSE, fromPose)
+        return math.hypot(pose[0] - fromPose[0], pose[1] - fromPose[1]) > distance_cm
+    return f
 
-        # convert to a string
-        s = ''.join([ _chr(x) for x in slist ])
 
-        return s
+#
+# sending commands in order of importance
+#
+
+# the priority classes of CommandScheduler, most important first
+PRIORITY_SAFETY = 0    # stopping, mode changes, stream control
+PRIORITY_DRIVE = 1     # driving, scripts
+PRIORITY_SENSORS = 2   # sensor queries
+PRIORITY_OTHER = 3     # LEDs, songs and everything else
+
+# opcode -> priority class, for the opcodes that aren't PRIORITY_OTHER
+_OPCODE_PRIORITIES = { 128: PRIORITY_SAFETY, 129: PRIORITY_SAFETY, 130: PRIORITY_SAFETY,
+                       131: PRIORITY_SAFETY, 132: PRIORITY_SAFETY, 133: PRIORITY_SAFETY,
+                       150: PRIORITY_SAFETY,
+                       137: PRIORITY_DRIVE, 145: PRIORITY_DRIVE, 152: PRIORITY_DRIVE,
+                       153: PRIORITY_DRIVE, 156: PRIORITY_DRIVE, 157: PRIORITY_DRIVE,
+                       142: PRIORITY_SENSORS, 148: PRIORITY_SENSORS, 149: PRIORITY_SENSORS }
+
+# the safety opcodes (besides a stopping DRIVE or DRIVEDIRECT) that
+# make driving frames still waiting to be written out of date
+_STOPPING_OPCODES = frozenset([128, 130, 131, 132, 133])
+
+def _isDrive( frame ):
+    """ True if frame is just a DRIVE or DRIVEDIRECT command, one a
+    stop makes out of date (unlike a script, whose caller waits for
+    it to run)
+    """
+    return len(frame) == 5 and frame[0] in (137, 145)
+
+def _stopsDriving( frame ):
+    """ True if frame, a safety frame, should cancel the driving
+    frames queued before it: a stop or a mode change
+    """
+    return frame[0] in _STOPPING_OPCODES or frame[0] in (137, 145)
+
+def _framePriority( frame ):
+    """ returns the priority class of a frame of bytes about to be
+    written, going by the command it starts with; a DRIVE or
+    DRIVEDIRECT that stops the wheels is a safety command
+    """
+    opcode = frame[0]
+    if opcode == 137 and frame[1:3] == b'\0\0':
+        return PRIORITY_SAFETY
+    if opcode == 145 and frame[1:5] == b'\0\0\0\0':
+        return PRIORITY_SAFETY
+    return _OPCODE_PRIORITIES.get(opcode, PRIORITY_OTHER)
+
+class CommandScheduler:
+    """ stands between a Create and its serial port (see
+    Create.startScheduler) and writes the frames it is handed in
+    order of priority, no more than budget bytes every tick seconds
+
+    the budget defaults to what the link can carry in a tick at
+    baudrate (10 bits per byte), so the bytes written don't pile up
+    in the port's buffers where they can't be overtaken any more;
+    reserve bytes of each tick's budget are kept for safety frames,
+    which are written straight away
+
+    other frames wait in submit while more than maxQueued bytes (by
+    default, a second's worth) are queued, so that callers can't get
+    ahead of the link by more than that
+
+    a stop or a mode change throws away the DRIVE and DRIVEDIRECT
+    frames still waiting, so that none of them can go out after it and start
+    the robot moving again
+    """
+
+    def __init__(self, write, baudrate=57600, tick=0.015, budget=None, reserve=5,
+                 maxQueued=None):
+        self._writeFrame = write
+        self.baudrate = baudrate
+        self.tick = tick
+        self._defaultBudget = budget is None
+        if budget is None:
+            budget = max(1, int(tick / self.wireTime(1)))
+        self.budget = budget
+        self.reserve = min(reserve, budget - 1)
+        if maxQueued is None:
+            maxQueued = int(baudrate / 10)
+        self.maxQueued = maxQueued
+        self._queue = []            # (priority, sequence number, frame)
+        self._queued = 0            # bytes in the queue
+        self._sequence = 0
+        self._lock = threading.Condition()
+        self._writeLock = threading.Lock()
+        self._tickStart = time.monotonic()
+        self._used = 0              # bytes written in the current tick
+        self._stops = 0             # stops and mode changes submitted
+        self._thread = None
+        # how many frames and bytes went out in each priority class
+        self.frames = [0, 0, 0, 0]
+        self.bytes = [0, 0, 0, 0]
+
+    def wireTime(self, nbytes):
+        """ returns the time (in seconds) it takes to send nbytes """
+        return nbytes * 10.0 / self.baudrate
+
+    def setBaudRate(self, baudrate):
+        """ for when the link changes speed """
+        with self._lock:
+            self.baudrate = baudrate
+            if self._defaultBudget:
+                self.budget = max(1, int(self.tick / self.wireTime(1)))
+                self.reserve = min(self.reserve, self.budget - 1)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ writes whatever is still queued and stops """
+        thread = self._thread
+        if thread is None:
+            return
+        with self._lock:
+            self._thread = None
+            self._lock.notify_all()
+        thread.join()
+
+    def submit(self, frame, block=True):
+        """ hands over a frame of bytes to be written; with block
+        False, it is queued even if that goes over maxQueued
+        """
+        priority = _framePriority(frame)
+        if priority == PRIORITY_SAFETY:
+            with self._lock:
+                self._account(len(frame))
+                if _stopsDriving(frame):
+                    self._dropDriving()
+            self._send(priority, frame)
+            return
+        with self._lock:
+            if block:
+                self._waitForRoom()
+            heapq.heappush(self._queue, (priority, self._sequence, frame))
+            self._sequence += 1
+            self._queued += len(frame)
+            self._lock.notify_all()
+
+    def waitForRoom(self, frame):
+        """ waits until submit would queue frame without blocking """
+        if _framePriority(frame) != PRIORITY_SAFETY:
+            with self._lock:
+                self._waitForRoom()
+
+    def _waitForRoom(self):
+        self._lock.wait_for(lambda: self._queued < self.maxQueued or self._thread is None)
+
+    def pending(self):
+        """ returns the number of frames waiting to be written """
+        return len(self._queue)
+
+    def flush(self, timeout=None):
+        """ waits until every frame handed over has been written;
+        returns False if that took longer than timeout seconds
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._queue, timeout)
+
+    def _dropDriving(self):
+        """ throws away the driving frames queued, and any the writer
+        thread has taken off the queue but not yet written (it holds
+        the lock)
+        """
+        self._stops += 1
+        kept = [ entry for entry in self._queue if not _isDrive(entry[2]) ]
+        if len(kept) != len(self._queue):
+            heapq.heapify(kept)
+            self._queue = kept
+            self._queued = sum( len(entry[2]) for entry in kept )
+            self._lock.notify_all()
+
+    def _account(self, nbytes):
+        """ counts nbytes against the current tick's budget """
+        now = time.monotonic()
+        if now - self._tickStart >= self.tick:
+            self._tickStart = now
+            self._used = 0
+        self._used += nbytes
+
+    def _send(self, priority, frame, stops=None):
+        with self._writeLock:
+            # a driving frame taken off the queue before a stop came in
+            if stops is not None and stops != self._stops:
+                return
+            self._writeFrame(frame)
+        self.frames[priority] += 1
+        self.bytes[priority] += len(frame)
+
+    def _run(self):
+        me = threading.current_thread()
+        while True:
+            with self._lock:
+                while not self._queue and self._thread is me:
+                    self._lock.wait()
+                if not self._queue:
+                    return
+                self._account(0)
+                available = self.budget - self.reserve - self._used
+                priority, sequence, frame = self._queue[0]
+                # a frame bigger than a whole tick's budget goes out
+                # on its own, at the start of a tick
+                if len(frame) <= available or (self._used == 0 and len(frame) > self.budget - self.reserve):
+                    heapq.heappop(self._queue)
+                    self._used += len(frame)
+                    self._queued -= len(frame)
+                    self._lock.notify_all()
+                    stops = self._stops if _isDrive(frame) else None
+                else:
+                    frame = None
+                    wait = self.tick - (time.monotonic() - self._tickStart)
+            if frame is not None:
+                self._send(priority, frame, stops)
+            elif wait > 0:
+                time.sleep(wait)
+
+
+#
+# keeping track of the serial traffic
+#
+
+# upper edges of the sensors() latency histogram buckets, in ms
+# (the last bucket holds everything slower)
+_LATENCY_BUCKETS_MS = [ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000 ]
+
+class IOStats:
+    """ counters for a Create's serial traffic, collected once
+    Create.instrument has been called; updating them is just a few
+    integer additions per call, so they can be left on
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ sets all the counters back to 0 """
+        self.started = time.monotonic()
+        self.commands = [0] * 256      # commands sent, by opcode
+        self.writes = 0
+        self.bytesOut = 0
+        self.reads = 0
+        self.bytesIn = 0
+        self.readTimeouts = 0          # replies that came up short
+        self.incompletePackets = 0     # "Incomplete Sensor Packet"
+        self.sensorQueries = 0         # sensors() calls that asked the robot
+        self.sensorCacheHits = 0       # sensors() calls that didn't
+        self.suppressed = [0] * 256    # repeated commands not sent, by opcode
+        self.latency = [0] * (len(_LATENCY_BUCKETS_MS) + 1)
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+
+    def _sensorQuery(self, seconds):
+        """ records the round trip time of one sensors() query """
+        self.sensorQueries += 1
+        self.latency[bisect.bisect_left(_LATENCY_BUCKETS_MS, seconds * 1000.0)] += 1
+        self.latencyTotal += seconds
+        if seconds > self.latencyMax:
+            self.latencyMax = seconds
+
+    def snapshot(self):
+        """ returns a dictionary with a copy of the counters """
+        commands = {}
+        suppressed = {}
+        for opcode in range(256):
+            if self.commands[opcode] > 0:
+                commands[_OPCODE_NAMES.get(opcode, opcode)] = self.commands[opcode]
+            if self.suppressed[opcode] > 0:
+                suppressed[_OPCODE_NAMES.get(opcode, opcode)] = self.suppressed[opcode]
+        edges = _LATENCY_BUCKETS_MS + [ float('inf') ]
+        mean = 0.0
+        if self.sensorQueries > 0:
+            mean = 1000.0 * self.latencyTotal / self.sensorQueries
+        return { 'seconds': time.monotonic() - self.started,
+                 'commands': commands,
+                 'suppressed': suppressed,
+                 'writes': self.writes,
+                 'bytesOut': self.bytesOut,
+                 'reads': self.reads,
+                 'bytesIn': self.bytesIn,
+                 'readTimeouts': self.readTimeouts,
+                 'incompletePackets': self.incompletePackets,
+                 'sensorQueries': self.sensorQueries,
+                 'sensorCacheHits': self.sensorCacheHits,
+                 'sensorLatencyMs': { 'buckets': list(zip(edges, self.latency)),
+                                      'mean': mean,
+                                      'max': 1000.0 * self.latencyMax } }
+
+    def report(self):
+        """ returns the counters as a few lines of text """
+        d = self.snapshot()
+        lines = [ 'serial I/O over %.1f s: %d writes, %d bytes out, %d reads, %d bytes in'
+                  % (d['seconds'], d['writes'], d['bytesOut'], d['reads'], d['bytesIn']),
+                  '  read timeouts %d, incomplete sensor packets %d'
+                  % (d['readTimeouts'], d['incompletePackets']),
+                  '  commands: ' + ', '.join([ '%s %d' % (name, n) for name, n
+                                               in sorted(d['commands'].items(), key=str) ]),
+                  '  repeats not sent: ' + ', '.join([ '%s %d' % (name, n) for name, n
+                                                       in sorted(d['suppressed'].items(), key=str) ]),
+                  '  sensors(): %d queries, %d answered without I/O, mean %.2f ms, max %.2f ms'
+                  % (d['sensorQueries'], d['sensorCacheHits'],
+                     d['sensorLatencyMs']['mean'], d['sensorLatencyMs']['max']) ]
+        buckets = [ '<=%g ms: %d' % (edge, n) for edge, n in d['sensorLatencyMs']['buckets']
+                    if n > 0 ]
+        if buckets:
+            lines.append('  latency ' + ', '.join(buckets))
+        return '\n'.join(lines)
+
+
+#
+# keeping track of the songs stored on the robot
+#
+class SongSlots:
+    """ remembers which song is in each of the robot's 16 song slots,
+    so that a song that is already there only needs a PLAY; songs
+    are keyed by their encoded notes (the SONG command's data bytes)
+    """
+
+    def __init__(self):
+        # slot -> song, least recently used first
+        self.slots = collections.OrderedDict()
+        # song -> slot
+        self.songs = {}
+        self.hits = 0       # songs played without sending them again
+        self.uploads = 0    # songs sent to the robot
+
+    def find(self, song):
+        """ returns the slot holding song, marking it as just used, or
+        None if it isn't on the robot
+        """
+        slot = self.songs.get(song)
+        if slot is not None:
+            self.slots.move_to_end(slot)
+            self.hits += 1
+        return slot
+
+    def choose(self):
+        """ returns the slot to store a new song in: an empty one if
+        there is one, or else the least recently used one
+        """
+        for slot in range(16):
+            if slot not in self.slots:
+                return slot
+        return next(iter(self.slots))
+
+    def stored(self, slot, song):
+        """ notes that song has been sent to slot """
+        old = self.slots.pop(slot, None)
+        if self.songs.get(old) == slot:
+            del self.songs[old]
+        self.slots[slot] = song
+        self.songs[song] = slot
+        self.uploads += 1
+
+    def clear(self):
+        """ forgets everything, e.g. after the robot has been reset """
+        self.slots.clear()
+        self.songs.clear()
+
+
+#
+# remembering where the robot has been
+#
+class PoseHistory:
+    """ a ring buffer of the last size poses (x mm, y mm, th radians),
+    each with the time.monotonic() time at which it was estimated
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.times = array.array('d', [0.0] * size)
+        self.xs = array.array('d', [0.0] * size)
+        self.ys = array.array('d', [0.0] * size)
+        self.ths = array.array('d', [0.0] * size)
+        self.first = 0     # where the oldest pose is
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, x, y, th):
+        """ adds the pose at time t, which may not be earlier than the
+        last one, overwriting the oldest pose once the buffer is full
+        """
+        if self.count < self.size:
+            i = (self.first + self.count) % self.size
+            self.count += 1
+        else:
+            i = self.first
+            self.first = (self.first + 1) % self.size
+        self.times[i] = t
+        self.xs[i] = x
+        self.ys[i] = y
+        self.ths[i] = th
+
+    def clear(self):
+        self.first = 0
+        self.count = 0
+
+    def poseAt(self, t):
+        """ returns the pose at time t, interpolated between the
+        poses on either side of it (or the oldest or newest pose, if t
+        is outside the history), or None if the history is empty
+        """
+        if self.count == 0:
+            return None
+        size = self.size; first = self.first; times = self.times
+        # binary search for the first pose later than t
+        lo = 0; hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(first + mid) % size] <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            i = first
+            return (self.xs[i], self.ys[i], self.ths[i])
+        before = (first + lo - 1) % size
+        if lo == self.count:
+            return (self.xs[before], self.ys[before], self.ths[before])
+        after = (first + lo) % size
+        f = (t - times[before]) / (times[after] - times[before])
+        return ( self.xs[before] + f * (self.xs[after] - self.xs[before]),
+                 self.ys[before] + f * (self.ys[after] - self.ys[before]),
+                 self.ths[before] + f * (self.ths[after] - self.ths[before]) )
+
+    def rebase(self, old, new):
+        """ moves all the poses into new coordinates, in which the
+        pose old (in the current ones) is called new, as when the
+        robot's pose is set
+        """
+        dth = new[2] - old[2]
+        c = math.cos(dth); s = math.sin(dth)
+        for k in range(self.count):
+            i = (self.first + k) % self.size
+            x = self.xs[i] - old[0]; y = self.ys[i] - old[1]
+            self.xs[i] = new[0] + c*x - s*y
+            self.ys[i] = new[1] + s*x + c*y
+            self.ths[i] += dth
+
+
+#
+# recording the serial traffic
+#
+# a log is a header (magic, then the wall clock and time.monotonic()
+# times it was started at) followed by one record per read or write:
+#
+#   t (seconds since the start, double), kind (1 byte), length (2 bytes), the bytes
+#
+# and its index, in the file of the same name plus '.idx', holds the
+# offset, t and number of every LOG_INDEX_EVERY'th record
+#
+LOG_MAGIC = b'CRLOG\x00\x01\x00'
+LOG_WRITTEN = 0    # bytes written to the robot
+LOG_READ = 1       # bytes read from the robot (possibly none, if the read timed out)
+LOG_INDEX_EVERY = 1024
+
+_LOG_HEADER = struct.Struct('<8sdd')
+_LOG_RECORD = struct.Struct('<dBH')
+_LOG_INDEX = struct.Struct('<QdQ')
+
+if numpy is not None:
+    # the records' headers, as read by TelemetryLog.chunks
+    LOG_RECORD_DTYPE = numpy.dtype([ ('t', '<f8'), ('kind', 'u1'),
+                                     ('offset', '<u8'), ('length', '<u2') ])
+    # how many runs of records TelemetryLog.chunks walks at a time
+    _LOG_RUNS_PER_WALK = 1024
+    # a record's header as it is in the file
+    _LOG_RECORD_PACKED = numpy.dtype([ ('t', '<f8'), ('kind', 'u1'), ('length', '<u2') ])
+
+class TelemetryRecorder:
+    """ appends the bytes written to and read from a robot to a log
+    file (see Create.record); writes are buffered, so recording
+    costs little more than a struct.pack per read or write
+    """
+
+    def __init__(self, path, bufferSize=1 << 16):
+        self.path = path
+        self.origin = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb', buffering=bufferSize)
+        self._index = open(path + '.idx', 'wb')
+        self._file.write(_LOG_HEADER.pack(LOG_MAGIC, time.time(), self.origin))
+        self.offset = _LOG_HEADER.size
+        self.records = 0
+
+    def record(self, kind, data):
+        """ appends one record of kind LOG_WRITTEN or LOG_READ """
+        t = time.monotonic() - self.origin
+        with self._lock:
+            if self._file is None:
+                return
+            # longer reads and writes become several records
+            start = 0
+            while True:
+                piece = data[start:start + 0xFFFF]
+                if self.records % LOG_INDEX_EVERY == 0:
+                    self._index.write(_LOG_INDEX.pack(self.offset, t, self.records))
+                self._file.write(_LOG_RECORD.pack(t, kind, len(piece)))
+                self._file.write(piece)
+                self.offset += _LOG_RECORD.size + len(piece)
+                self.records += 1
+                start += 0xFFFF
+                if start >= len(data):
+                    break
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._index.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._index.close()
+                self._file = None
+
+
+class TelemetryLog:
+    """ reads a log written by TelemetryRecorder, memory-mapping it
+    rather than reading it in
 
+    e.g. log = TelemetryLog('patrol.log')
+         for t, kind, data in log.records():
+             ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size < _LOG_HEADER.size:
+            raise ValueError('%s is not a Create log' % path)
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.wallTime, self.origin = _LOG_HEADER.unpack_from(self.data, 0)
+        if magic != LOG_MAGIC:
+            raise ValueError('%s is not a Create log' % path)
+        # (offset, t, record number) of every LOG_INDEX_EVERY'th record
+        self.index = []
+        try:
+            with open(path + '.idx', 'rb') as f:
+                raw = f.read()
+            whole = len(raw) - len(raw) % _LOG_INDEX.size
+            self.index = list(_LOG_INDEX.iter_unpack(raw[:whole]))
+        except IOError:
+            pass
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+    def _offsetAt(self, t):
+        """ returns the offset of an indexed record no later than t """
+        i = bisect.bisect_right([ entry[1] for entry in self.index ], t) - 1
+        if i < 0:
+            return _LOG_HEADER.size
+        return self.index[i][0]
+
+    def records(self, start=None, end=None):
+        """ yields (t, kind, data) for each record with start <= t <
+        end (either may be None), with data a memoryview into the
+        mapped file
+        """
+        offset = _LOG_HEADER.size
+        if start is not None:
+            offset = self._offsetAt(start)
+        data = self.data; view = memoryview(data); size = self.size
+        unpack = _LOG_RECORD.unpack_from; header = _LOG_RECORD.size
+        while offset + header <= size:
+            t, kind, length = unpack(data, offset)
+            offset += header
+            if offset + length > size:
+                # the recording was cut off in the middle of a record
+                break
+            if end is not None and t >= end:
+                break
+            if start is None or t >= start:
+                yield (t, kind, view[offset:offset + length])
+            offset += length
+
+    def chunks(self, n=65536, start=None, end=None):
+        """ yields numpy structured arrays (of LOG_RECORD_DTYPE) of the
+        headers of up to n records at a time with start <= t < end
+        (either may be None); a record's bytes are
+        log.data[offset:offset+length]
+
+        the records an index entry points at split the log into runs
+        of LOG_INDEX_EVERY records, which are walked side by side with
+        numpy, so a scan costs a few array operations per run rather
+        than a struct.unpack per record (only what comes after the
+        last index entry, or a run that doesn't agree with the index,
+        is walked one record at a time)
+        """
+        if numpy is None:
+            raise ImportError('TelemetryLog.chunks needs numpy')
+        offset = _LOG_HEADER.size
+        if start is not None:
+            offset = self._offsetAt(start)
+        header = _LOG_RECORD.size
+        starts = [offset] + [ entry[0] for entry in self.index
+                              if offset < entry[0] and entry[0] + header <= self.size ]
+        u8 = numpy.frombuffer(self.data, numpy.uint8)
+        columns = numpy.arange(header)
+        # enough runs at a time that numpy, not Python, does the work
+        perBatch = max(_LOG_RUNS_PER_WALK, n // LOG_INDEX_EVERY)
+        for i in range(0, len(starts), perBatch):
+            bounds = starts[i:i + perBatch + 1]
+            offsets = self._walkRuns(u8, bounds)
+            if len(bounds) <= perBatch:
+                # the last batch goes on to the end of the log
+                offsets = numpy.concatenate([ offsets, self._walkRecords(bounds[-1], self.size) ])
+            raw = u8[offsets[:, None] + columns]
+            headers = raw.view(_LOG_RECORD_PACKED).reshape(-1)
+            chunk = numpy.empty(len(offsets), dtype=LOG_RECORD_DTYPE)
+            chunk['t'] = headers['t']
+            chunk['kind'] = headers['kind']
+            chunk['offset'] = offsets + header
+            chunk['length'] = headers['length']
+            done = False
+            if end is not None:
+                late = numpy.flatnonzero(chunk['t'] >= end)
+                if len(late) > 0:
+                    chunk = chunk[:late[0]]
+                    done = True
+            if start is not None:
+                chunk = chunk[chunk['t'] >= start]
+            for k in range(0, len(chunk), n):
+                yield chunk[k:k + n]
+            if done:
+                return
+
+    def _walkRuns(self, u8, bounds):
+        """ returns the offsets of the records from bounds[0] up to
+        bounds[-1], where bounds are the offsets of records, walking
+        from each of them to the next in step
+        """
+        if len(bounds) < 2:
+            return numpy.zeros(0, numpy.int64)
+        header = _LOG_RECORD.size
+        position = numpy.array(bounds[:-1], numpy.int64)
+        limit = numpy.array(bounds[1:], numpy.int64)
+        steps = []
+        active = position < limit
+        while active.any():
+            steps.append(numpy.where(active, position, -1))
+            at = position[active]
+            length = u8[at + 9].astype(numpy.int64) | (u8[at + 10].astype(numpy.int64) << 8)
+            position[active] = at + header + length
+            active = position < limit
+        if (position != limit).any():
+            # the index doesn't match the log
+            return self._walkRecords(bounds[0], bounds[-1])
+        # run by run, in the order they are in the log
+        offsets = numpy.stack(steps, axis=1).reshape(-1)
+        return offsets[offsets >= 0]
+
+    def _walkRecords(self, offset, stop):
+        """ returns the offsets of the whole records from offset up to
+        stop, one record at a time
+        """
+        data = self.data; size = self.size; header = _LOG_RECORD.size
+        offsets = []
+        while offset < stop and offset + header <= size:
+            length = data[offset + 9] | data[offset + 10] << 8
+            if offset + header + length > size:
+                # the recording was cut off in the middle of a record
+                break
+            offsets.append(offset)
+            offset += header + length
+        return numpy.array(offsets, numpy.int64)
+
+
+class ReplaySerial:
+    """ stands in for a serial.Serial, answering reads with what was
+    read in a recorded session (see Create.record), in the same order
+    and with the same timing divided by speed; with speed 0 (or None)
+    reads are answered as soon as the writes that came before them in
+    the recording have been made (or after timeout seconds)
+
+    writes go nowhere; with checkWrites, each is compared with the
+    next one recorded, and those that differ are counted in
+    mismatches, with the first few kept in firstMismatches as
+    (record number, written, recorded)
+
+    e.g. robot = create.Create(create.ReplaySerial('patrol.log', speed=4))
+    """
+
+    def __init__(self, path, speed=1.0, checkWrites=True, timeout=0.5):
+        self.log = TelemetryLog(path)
+        self.speed = speed
+        self.checkWrites = checkWrites
+        self.timeout = timeout
+        self.baudrate = DEFAULT_BAUDRATE
+        self.port = path
+        self._reads = self._readRecords()
+        self._writes = ( (t, data) for t, kind, data in self.log.records() if kind == LOG_WRITTEN )
+        self._next = None       # the next read, or what's left of it
+        self._start = time.monotonic()
+        self._open = True
+        self._written = threading.Condition()
+        self.readsLeft = True
+        self.writes = 0
+        self.writesChecked = 0
+        self.mismatches = 0
+        self.firstMismatches = []
+
+    def _readRecords(self):
+        """ yields (t, data, number of writes recorded before it) """
+        writes = 0
+        for t, kind, data in self.log.records():
+            if kind == LOG_WRITTEN:
+                writes += 1
+            else:
+                yield (t, data, writes)
+
+    def _due(self, t):
+        """ returns how long until the recorded time t comes round """
+        if not self.speed:
+            return 0.0
+        return t / self.speed - (time.monotonic() - self._start)
+
+    def _peek(self):
+        if self._next is None:
+            self._next = next(self._reads, None)
+            if self._next is None:
+                self.readsLeft = False
+        return self._next
+
+    def read(self, size=1):
+        record = self._peek()
+        if record is None:
+            # the recording is over: every read times out
+            time.sleep(min(self.timeout or 0.0, 0.05))
+            return b''
+        t, data, writes = record
+        wait = self._due(t)
+        if wait > 0:
+            time.sleep(wait)
+        # the robot can't answer what it hasn't been asked yet
+        with self._written:
+            if not self._written.wait_for(lambda: self.writes >= writes, self.timeout):
+                return b''
+        if size is not None and len(data) > size:
+            self._next = (t, data[size:], writes)
+            return bytes(data[:size])
+        self._next = None
+        return bytes(data)
+
+    def inWaiting(self):
+        record = self._peek()
+        if record is None or self._due(record[0]) > 0 or self.writes < record[2]:
+            return 0
+        return len(record[1])
+
+    in_waiting = property(inWaiting)
+
+    def write(self, data):
+        if self.checkWrites:
+            recorded = next(self._writes, None)
+            if recorded is None or bytes(recorded[1]) != bytes(data):
+                self.mismatches += 1
+                if len(self.firstMismatches) < 10:
+                    self.firstMismatches.append(( self.writesChecked, bytes(data),
+                                                  recorded and bytes(recorded[1]) ))
+            self.writesChecked += 1
+        with self._written:
+            self.writes += 1
+            self._written.notify_all()
+        return len(data)
+
+    def flushInput(self):
+        # what was thrown away was never read, so never recorded
+        return
+
+    def flush(self):
+        return
+
+    def isOpen(self):
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def fileno(self):
+        raise IOError('a ReplaySerial has no file descriptor')
+
+
+#
+# watching over the serial link
+#
+# the states a Create's link can be in (see Create.superviseLink)
+LINK_UP = 'up'
+LINK_DEGRADED = 'degraded'
+
+class LinkWatchdog:
+    """ watches a Create's serial link for reads that come up short
+    or fail; after maxFaults in a row (or one failure of the port
+    itself) it marks the link degraded, stops the robot if it still
+    can, and reopens the port and gets the robot back to its mode and
+    stream, waiting backoff seconds after the first failed attempt and
+    twice as long after each one after that, up to maxBackoff
+
+    the callbacks are called with the new state (LINK_UP or
+    LINK_DEGRADED) from the watchdog's thread
+    """
+
+    def __init__(self, robot, maxFaults=3, backoff=0.1, maxBackoff=5.0):
+        self.robot = robot
+        self.maxFaults = maxFaults
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.state = LINK_UP
+        self.faults = 0          # short reads in a row
+        self.outages = 0         # times the link went degraded
+        self.failedAttempts = 0  # reconnects that didn't work
+        self.callbacks = []
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, wanted, got):
+        """ notes a read of got bytes out of wanted """
+        if wanted is None or wanted <= 0:
+            return
+        if got >= wanted:
+            self.faults = 0
+        else:
+            self._fault()
+
+    def _fault(self, hard=False):
+        """ notes a short read, or with hard a failure of the port """
+        with self._changed:
+            if self.state != LINK_UP:
+                # the watchdog is already on it
+                return
+            self.faults += 1
+            if not hard and self.faults < self.maxFaults:
+                return
+            self.state = LINK_DEGRADED
+            self.outages += 1
+            self._changed.notify_all()
+
+    def _announce(self, state):
+        for callback in list(self.callbacks):
+            callback(state)
+
+    def stop(self):
+        """ stops watching; waits for a reconnect in progress """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        """ the body of the watchdog thread """
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._stopped or self.state != LINK_UP)
+                if self._stopped:
+                    return
+            self._announce(LINK_DEGRADED)
+            self._recover()
+
+    def _recover(self):
+        """ stops the robot and reconnects, backing off, until it
+        works or the watchdog is stopped
+        """
+        mode, streamed = self.robot._dropLink()
+        delay = self.backoff
+        while True:
+            try:
+                self.robot._reconnect(mode, streamed)
+                break
+            except (CreateConnectionError, serial.SerialException, OSError, ValueError):
+                self.failedAttempts += 1
+            with self._changed:
+                if self._changed.wait_for(lambda: self._stopped, delay):
+                    return
+            delay = min(delay * 2, self.maxBackoff)
+        with self._changed:
+            self.faults = 0
+            self.state = LINK_UP
+        self._announce(LINK_UP)
+
+
+#
+# connecting to the robot
+#
+class CreateConnectionError(IOError):
+    """ raised when a Create can't be connected to; port is the port
+    that was tried and stage says how far things got:
+        'open'    the serial port didn't open
+        'answer'  nothing on the port answered as a Create would
+        'mode'    the robot answered, but didn't go into the mode
+                  it was asked to
+    """
+
+    def __init__(self, message, port=None, stage=None):
+        IOError.__init__(self, message)
+        self.port = port
+        self.stage = stage
+
+# how long (in seconds) to wait for each answer while connecting, and
+# how long connecting may take in all
+PROBE_INTERVAL = 0.05
+CONNECT_TIMEOUT = 3.0
+
+# the command that takes the OI to each mode
+_MODE_COMMANDS = { PASSIVE_MODE: START, SAFE_MODE: SAFE, FULL_MODE: FULL }
+
+# what Create._handshakeSteps yields to have the OI mode read
+_PROBE = object()
 
 
 #
@@ -549,9 +2288,25 @@ class Create:
     if it's not attached!
     """
     # to do: check if we can start in other modes...
-    def __init__(self, PORT, startingMode=SAFE_MODE):
+    def __init__(self, PORT, startingMode=SAFE_MODE, baudrate=DEFAULT_BAUDRATE, record=None,
+                 connect=True):
         """ the constructor which tries to open the
         connection to the robot at port PORT
+
+        PORT may also be an object that works like a serial.Serial,
+        such as a ReplaySerial
+
+        if record is a file name, everything sent to and received from
+        the robot is recorded there, from the start (see record)
+
+        the robot starts up at DEFAULT_BAUDRATE; for any other
+        baudrate, the link is switched over once it is up (see
+        setBaudRate)
+
+        with connect=False only the port is opened, and the robot is
+        got ready by connect() or, in the background, startConnect();
+        raises CreateConnectionError if the port doesn't open or the
+        robot can't be got ready
         """
         _debug = False
         # to do: find the shortest safe serial timeout value...
@@ -563,32 +2318,193 @@ class Create:
 
         # if PORT is the string 'simulated' (or any string for the moment)
         # we use our SRSerial class
+        self._openPort(PORT, 0.5)
+        self._port = PORT
+        self.startingMode = startingMode
+        self._startingBaudrate = baudrate
+        self._initState()
+        if record is not None:
+            self.record(record)
+
+        if connect:
+            try:
+                self.connect()
+            except CreateConnectionError:
+                # don't leave the port (or the emulator) open behind us
+                self._release()
+                raise
+
+    def _openPort(self, PORT, timeout):
+        """ opens PORT (see __init__) as self.ser, with reads timing out
+        after timeout seconds
+        """
         print('PORT is', PORT)
-        if type(PORT) == type('string'):
-            if PORT == 'sim':
-                print('In simulated mode...')
-                self.ser = 'sim'; # SRSerial('mapSquare.txt')
+        try:
+            if type(PORT) == type('string'):
+                if PORT == 'sim':
+                    print('In simulated mode...')
+                    # an emulated Create behind a pseudo-terminal, see createsim.py
+                    import createsim
+                    self._simulator = createsim.PtyEmulator().start()
+                    self.ser = serial.Serial(self._simulator.portName, baudrate=DEFAULT_BAUDRATE, timeout=timeout)
+                else:
+                    # for Mac/Linux - use whole port name
+                    # print 'In Mac/Linux mode...'
+                    self.ser = serial.Serial(PORT, baudrate=DEFAULT_BAUDRATE, timeout=timeout)
+            # something that already acts like a serial port, e.g. a ReplaySerial
+            elif hasattr(PORT, 'read') and hasattr(PORT, 'write'):
+                self.ser = PORT
+            # otherwise, we try to open the numeric serial port...
             else:
-                # for Mac/Linux - use whole port name
-                # print 'In Mac/Linux mode...'
-                self.ser = serial.Serial(PORT, baudrate=57600, timeout=0.5)
-        # otherwise, we try to open the numeric serial port...
-        else:
-            # print 'In Windows mode...'
-            self.ser = serial.Serial(PORT-1, baudrate=57600, timeout=0.5)
+                # print 'In Windows mode...'
+                self.ser = serial.Serial(PORT-1, baudrate=DEFAULT_BAUDRATE, timeout=timeout)
+        except serial.SerialException as e:
+            if getattr(self, '_simulator', None) is not None:
+                self._simulator.stop()
+            raise CreateConnectionError('Serial port %s did not open: %s' % (PORT, e), PORT, 'open')
 
         # did the serial port actually open?
-        if self.ser != 'sim' and self.ser.isOpen():
-            print('Serial port did open, presumably to a roomba...')
-        else:
-            print('Serial port did NOT open, check the')
-            print('  - port number')
-            print('  - physical connection')
-            print('  - baud rate of the roomba (it\'s _possible_, if unlikely,')
-            print('              that it might be set to 19200 instead')
-            print('              of the default 57600 - removing and')
-            print('              reinstalling the battery should reset it.')
+        if not self.ser.isOpen():
+            raise CreateConnectionError('Serial port %s did NOT open, check the port number'
+                                        ' and the physical connection' % (PORT,), PORT, 'open')
+        print('Serial port did open, presumably to a roomba...')
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """ gets the robot ready, without the fixed waits: asks it for
+        its OI mode until it answers (starting the OI if need be), makes
+        just the mode changes needed to get to startingMode, clears its
+        odometry and switches the link to the baudrate asked for
+
+        raises CreateConnectionError if that takes more than timeout
+        seconds
+        """
+        with self._ioLock:
+            self._handshake(self.startingMode, timeout)
+
+            # We need to read the angle and distance sensors so that
+            # their values clear out!
+            self._getRawSensorDataAsList( [DISTANCE, ANGLE] )
+            self.setPose(0,0,0)
+
+            if self._startingBaudrate != self.ser.baudrate:
+                print('Switching the link to', self._startingBaudrate, 'baud...')
+                self.setBaudRate(self._startingBaudrate)
+
+    def _handshake(self, target, timeout):
+        """ the part of connect that gets the robot answering and into
+        the mode target
+        """
+        oldTimeout = self.ser.timeout
+        self.ser.timeout = PROBE_INTERVAL
+        try:
+            steps = self._handshakeSteps(target, time.monotonic() + timeout)
+            answer = None
+            while True:
+                try:
+                    step = steps.send(answer)
+                except StopIteration:
+                    break
+                answer = None
+                if step is _PROBE:
+                    answer = self._probeMode()
+                elif type(step) == float:
+                    time.sleep(step)
+                else:
+                    self._sendNow(step)
+        finally:
+            self.ser.timeout = oldTimeout
+
+    def _handshakeSteps(self, target, deadline):
+        """ the handshake, without the I/O, so that Create and
+        AsyncCreate can share it: yields the commands to send, the
+        pauses to make (as floats, in seconds) and _PROBE, which is
+        to be answered (with send) by the robot's OI mode or None
+        """
+        if target not in _MODE_COMMANDS:
+            target = PASSIVE_MODE
+        # a stream left running by the last program to use the
+        # robot would get in the way of the answers
+        yield _byteCommand( PAUSERESUME, 0 )
+        mode = yield _PROBE
+        while mode is None:
+            if time.monotonic() >= deadline:
+                raise CreateConnectionError('The robot on %s did not answer' % (self._port,),
+                                            self._port, 'answer')
+            # the OI may not have been started
+            yield START
+            mode = yield _PROBE
+        if mode in (SAFE_MODE, FULL_MODE):
+            # it may still be doing what it was last told
+            yield _goCommand(0, 0)
+        if mode != target:
+            print('Putting the robot into', modeStr(target).lower().replace('_', ' ') + '...')
+        while mode != target:
+            if time.monotonic() >= deadline:
+                raise CreateConnectionError('The robot on %s stayed in %s' % (self._port, modeStr(mode)),
+                                            self._port, 'mode')
+            yield _MODE_COMMANDS[target]
+            # they recommend 20 ms between mode-changing commands
+            yield 0.02
+            mode = yield _PROBE
+        self.sciMode = mode
+        self._reportedMode = mode
+        self._actuators.clear()
+        # the robot may have been switched off and on since we last
+        # talked to it, which empties its song slots
+        self.songSlots.clear()
+
+    def _dropLink(self):
+        """ tries to stop the robot, straight through a port that may
+        not work, and stops the stream reader; returns the mode and
+        stream to get back to with _reconnect (for the LinkWatchdog)
+        """
+        self._actuators.clear()
+        try:
+            self.ser.write( _goCommand(0, 0) )
+        except (serial.SerialException, OSError, ValueError):
+            pass
+        streamed = None
+        thread = self._streamThread
+        if thread is not None:
+            streamed = self._streamRequest
+            self._streamThread = None
+            if self._fleet is not None:
+                self._fleet._unwatch(self)
+            elif thread is not threading.current_thread():
+                thread.join()
+        return self.sciMode, streamed
+
+    def _reconnect(self, mode, streamed, timeout=CONNECT_TIMEOUT):
+        """ reopens the port and gets the robot back to mode and the
+        stream streamed, keeping the pose
+        """
+        with self._ioLock:
+            try:
+                self._closeSer()
+            except (serial.SerialException, OSError):
+                pass
+            self._openSer()
+            self._handshake(mode, timeout)
+            self._resumeStream(streamed)
+
+    def startConnect(self, timeout=CONNECT_TIMEOUT):
+        """ starts connect() and returns right away with a
+        concurrent.futures.Future, whose result() raises the
+        CreateConnectionError if connecting fails, e.g.
+
+            robot = Create(port, connect=False)
+            connecting = robot.startConnect()
+            ... open the camera ...
+            connecting.result()
+        """
+        return self._startMotion(self.connect, timeout)
+
+    _debug = False
 
+    def _initState(self):
+        """ sets up everything the constructor sets up apart from the
+        serial port itself
+        """
         # our OI mode
         self.sciMode = OFF_MODE
 
@@ -603,47 +2519,319 @@ class Create:
         self.yPose =   0.0
         self.thrPose = 0.0
 
-        time.sleep(0.3)
-        self._start()  # go to passive mode - want to do this
-        # regardless of the final mode we'd like to be in...
-        time.sleep(0.3)
-
-        if (startingMode == SAFE_MODE):
-            print('Putting the robot into safe mode...')
-            self.toSafeMode()
-
-        if (startingMode == FULL_MODE):
-            print('Putting the robot into full mode...')
-            self.toSafeMode()
-            time.sleep(0.3)
-            self.toFullMode()
-
-        # We need to read the angle and distance sensors so that
-        # their values clear out!
-        time.sleep(0.25)
-        #self.sensors(6) # read all sensors to establish the sensord dictionary
-        self.setPose(0,0,0)
-
-    _debug = False
+        # the sensor dictionary and the pose are shared with the
+        # stream reader thread (see startStream), so they are
+        # only changed while holding this lock
+        self._sensorLock = threading.RLock()
+        self._streamUpdate = threading.Condition(self._sensorLock)
+        # the port is shared by every thread that uses the robot: a
+        # query and its reply (and the decoding of the reply), starting
+        # or stopping the stream, a script and a change of baud rate
+        # each happen while holding _ioLock; deciding whether to send a
+        # command and sending it, while holding _sendLock; and each
+        # write to the port, while holding _portLock.  When more than
+        # one is needed, they are taken in that order, before _sensorLock
+        self._ioLock = threading.RLock()
+        self._sendLock = threading.RLock()
+        self._portLock = threading.Lock()
+        self._streamThread = None
+        self._streamRequest = []
+        self._streamSensors = []
+        self._lastStreamPacket = []
+        self._streamParser = _StreamParser()
+        self.streamPackets = 0
+
+        # commands held back by batch(), one list per thread
+        self._batchLocal = threading.local()
+
+        # when each raw sensor was last read, and how long its value
+        # stays good for (see setSensorMaxAge)
+        self._sensorTime = {}
+        self.sensorMaxAge = dict(DEFAULT_SENSOR_MAX_AGE)
+
+        # where the robot has been lately (see getPoseAt)
+        self.poseHistory = PoseHistory()
+
+        # the last DRIVE/DRIVEDIRECT and LEDS commands sent, and when:
+        # actuator -> (command, time.monotonic())
+        self._actuators = {}
+        # whether to drop commands that repeat the last one sent
+        self.suppressRepeats = True
+        # repeats are still sent when the last one is this many
+        # seconds old, to keep the robot refreshed; None never sends them
+        self.commandKeepalive = COMMAND_KEEPALIVE
+        # the OI mode the robot last told us it was in
+        self._reportedMode = None
+        # how many commands have been dropped as repeats
+        self.suppressedCommands = 0
+
+        # what we've put in the robot's song slots (see playSong)
+        self.songSlots = SongSlots()
+
+        # the SensorWatch objects waiting for sensor data (see watch)
+        self._watches = []
+        # (watch, sensor dictionary) for the watches that have fired,
+        # but whose callbacks have yet to be called (see _fireWatches)
+        self._firedWatches = []
+        # True while the stream reader is calling watches' callbacks
+        self._streamFiring = False
+
+        # the CommandScheduler, if startScheduler has been called
+        self._scheduler = None
+
+        # the Fleet this robot belongs to, if any
+        self._fleet = None
+
+        # the TelemetryRecorder, if record has been called
+        self._recorder = None
+
+        # the IOStats, if instrument has been called
+        self._stats = None
+        self._statsDumper = None
+
+        # the LinkWatchdog, if superviseLink has been called
+        self._watchdog = None
+
+        # how many queries have been sent (see SensorWatch.wait)
+        self._queriesSent = 0
+        # bytes still owed by the robot for a motion script that timed out
+        self._strayBytes = 0
+        self._strayReply = b''
+        # True while turn() or move() waits for the robot to finish
+        self._inMotion = False
+        # runs the motions started by startTurn and startMove
+        self._motionExecutor = None
 
     def _read(self, size=None):
     	val = None
-    	if (size == None):
-    		val = self.ser.read(size=None)
-    	elif (size < 0):
-    		val = self.ser.read(size=None)
-    	else:
-    		val = self.ser.read(size)
+    	try:
+    		if (size == None):
+    			val = self.ser.read(size=None)
+    		elif (size < 0):
+    			val = self.ser.read(size=None)
+    		else:
+    			val = self.ser.read(size)
+    	except (serial.SerialException, OSError):
+    		if (self._watchdog is None):
+    			raise
+    		# the port went away, the watchdog will reopen it
+    		self._watchdog._fault(hard=True)
+    		return b''
+    	if (self._watchdog is not None and not self._inMotion):
+    		# (scripts keep the robot from answering for a while)
+    		self._watchdog._read(size, len(val))
+    	if (self._stats is not None):
+    		self._stats.reads += 1
+    		self._stats.bytesIn += len(val)
+    	if (self._recorder is not None):
+    		self._recorder.record(LOG_READ, val)
     	if (self._debug == True):
     		print(val)
     		print(type(val))
     	return val
 
 
-    def _write(self, byte):
+    def _write(self, data, block=True):
+        """ writes the bytes in data to the port in a single call (see
+        CommandScheduler.submit for block)
+        """
         if self._debug==True:
-            print(ord(byte))
-        self.ser.write(byte)
+            print(list(data))
+        if self._stats is not None:
+            self._stats.writes += 1
+            self._stats.bytesOut += len(data)
+        if self._scheduler is not None:
+            self._scheduler.submit(data, block)
+        else:
+            self._writePort(data)
+
+    def _writePort(self, data):
+        """ where the bytes actually go out, with or without a scheduler """
+        try:
+            with self._portLock:
+                if self._recorder is not None:
+                    self._recorder.record(LOG_WRITTEN, data)
+                self.ser.write(data)
+        except (serial.SerialException, OSError):
+            if self._watchdog is None:
+                raise
+            # the command is lost; the watchdog reopens the port
+            self._watchdog._fault(hard=True)
+
+    def record(self, path):
+        """ starts recording every byte written to and read from the
+        robot, with the time, to the log file path (see
+        TelemetryRecorder and TelemetryLog)
+        """
+        self.stopRecording()
+        self._recorder = TelemetryRecorder(path)
+        return self._recorder
+
+    def stopRecording(self):
+        recorder = self._recorder
+        if recorder is not None:
+            self._recorder = None
+            recorder.close()
+
+    def startScheduler(self, tick=0.015, budget=None):
+        """ puts a CommandScheduler between the robot and the port, so
+        that stops and mode changes go out ahead of anything waiting,
+        then driving, then sensor queries, then LEDs and songs, and
+        no more than budget bytes are written per tick seconds (by
+        default, what the link carries in a tick)
+        """
+        if self._scheduler is None:
+            self._scheduler = CommandScheduler(self._writePort, self.ser.baudrate,
+                                               tick, budget).start()
+        return self._scheduler
+
+    def stopScheduler(self):
+        """ writes whatever the scheduler still holds and goes back to
+        writing straight to the port
+        """
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler.stop()
+            self._scheduler = None
+
+    def _send(self, command):
+        """ sends one encoded command, or holds on to it if this
+        thread is inside a batch() block
+
+        a DRIVE, DRIVEDIRECT or LEDS command that would just repeat the
+        last one sent is dropped (see suppressRepeats)
+        """
+        opcode = command[0]
+        # the bytes still to come of a script this thread is uploading
+        scriptBytes = getattr(self._batchLocal, 'scriptBytes', 0)
+        scheduler = self._scheduler
+        if scheduler is not None and getattr(self._batchLocal, 'commands', None) is None:
+            # waiting for the queue to drain must not hold _sendLock,
+            # or a stop from another thread would wait too
+            scheduler.waitForRoom(command)
+        with self._sendLock:
+            if scriptBytes > 0:
+                # part of a script being uploaded, not run right away
+                self._batchLocal.scriptBytes = scriptBytes - len(command)
+            elif opcode in _ACTUATOR_OPCODES:
+                if self._repeated(_ACTUATOR_OPCODES[opcode], command):
+                    return
+            elif opcode in _RESETTING_OPCODES:
+                # the robot may not be driving or lit as it was
+                self._actuators.clear()
+            if self._stats is not None:
+                self._stats.commands[opcode] += 1
+            pending = getattr(self._batchLocal, 'commands', None)
+            if pending is not None:
+                pending.append(command)
+            else:
+                self._write(command, block=False)
+
+    def _repeated(self, actuator, command):
+        """ returns True if command just repeats what actuator was
+        last told, recently enough (see commandKeepalive) that it
+        needn't be sent; otherwise remembers command as sent
+        """
+        now = time.monotonic()
+        last = self._actuators.get(actuator)
+        if ( self.suppressRepeats and last is not None and last[0] == command and
+             (self.commandKeepalive is None or now - last[1] < self.commandKeepalive) ):
+            self.suppressedCommands += 1
+            if self._stats is not None:
+                self._stats.suppressed[command[0]] += 1
+            return True
+        self._actuators[actuator] = (command, now)
+        return False
+
+    def _sendNow(self, command):
+        """ writes command right away, together with any batched
+        commands ahead of it
+        """
+        if self._stats is not None:
+            self._stats.commands[command[0]] += 1
+        pending = getattr(self._batchLocal, 'commands', None)
+        if pending:
+            command = b''.join(pending) + command
+            del pending[:]
+        self._write(command)
+
+    def _query(self, command, size):
+        """ sends a command that the robot answers, together with any
+        batched commands ahead of it, and reads size bytes of reply
+        """
+        with self._ioLock:
+            if not self._takeStray():
+                # the robot is still running a motion script that timed
+                # out, and wouldn't read the command until it's done
+                return b''
+            self._queriesSent += 1
+            self._sendNow(command)
+            r = self._read(size=size)
+            if len(r) < size and self._stats is not None:
+                self._stats.readTimeouts += 1
+            return r
+
+    def _takeStray(self):
+        """ takes whatever has arrived of the replies still owed for
+        motion scripts that timed out (see _dropStray), without
+        waiting; returns True once nothing more is owed
+        """
+        with self._ioLock:
+            if self._strayBytes > 0:
+                waiting = self.ser.inWaiting()
+                if waiting > 0:
+                    self._dropStray( self._read(size=min(waiting, self._strayBytes)) )
+            return self._strayBytes == 0
+
+    def _dropStray(self, r):
+        """ takes what is left of the replies to motion scripts that
+        timed out off the front of r, and returns the rest of r
+        """
+        stray = min(self._strayBytes, len(r))
+        self._strayBytes -= stray
+        self._strayReply += r[:stray]
+        if self._strayBytes == 0 and self._strayReply:
+            # they still tell us how far the robot went
+            plan = _planSensorQuery([POSE])
+            for k in range(0, len(self._strayReply), plan.size):
+                self._readSensorList(plan.sensorList, self._strayReply[k:k + plan.size], plan.decoder)
+            self._strayReply = b''
+        return r[stray:]
+
+    def _readUntil(self, size, timeout=-1.0):
+        """ reads size bytes, for as long as it takes if timeout is
+        negative, or until timeout seconds have gone by; returns what
+        arrived
+        """
+        deadline = time.monotonic() + timeout
+        r = b''
+        while len(r) < size:
+            r += self._read(size=size - len(r))
+            if timeout >= 0.0 and time.monotonic() >= deadline:
+                break
+        return r
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ collects the commands sent in a with-block and sends
+        them to the robot all at once when the block ends
+
+        e.g. with robot.batch():
+                 robot.go(20)
+                 robot.setLEDs(0, 255, 1, 1)
+        """
+        if getattr(self._batchLocal, 'commands', None) is not None:
+            # already batching, the outer block will send everything
+            yield
+            return
+        self._batchLocal.commands = []
+        try:
+            yield
+        finally:
+            commands = self._batchLocal.commands
+            self._batchLocal.commands = None
+            if commands:
+                self._write(b''.join(commands))
 
     def getPose(self, dist='cm', angle='deg'):
         """ getPose returns the current estimate of the
@@ -651,20 +2839,41 @@ class Create:
         dist may be 'cm' or 'mm'
         angle may be 'deg' or 'rad'
         """
-        x = 0; y = 0; th = 0
+        with self._sensorLock:
+            x, y, th = self.xPose, self.yPose, self.thrPose
         if dist == 'cm':
-            x = self.xPose/10.0; y = self.yPose/10.0
-        else:
-            x = self.xPose; y = self.yPose
+            x = x/10.0; y = y/10.0
 
         if angle == 'deg':
-            th = math.degrees(self.thrPose)
-        else:
-            th = self.thrPose
+            th = math.degrees(th)
 
         return (x,y,th)
 
 
+    def getPoseAt(self, timestamp, dist='cm', angle='deg'):
+        """ returns the estimate of the robot's pose at timestamp, a
+        time.monotonic() value from the last few seconds, as getPose
+        does for now; e.g. to find out how far the robot has turned
+        since a camera frame was captured:
+
+            capture = time.monotonic()
+            frame = cap.read()[1]
+            ...
+            turned = robot.getPose()[2] - robot.getPoseAt(capture)[2]
+
+        returns the current pose if there is no history yet
+        """
+        with self._sensorLock:
+            pose = self.poseHistory.poseAt(timestamp)
+            if pose is None:
+                pose = (self.xPose, self.yPose, self.thrPose)
+        x, y, th = pose
+        if dist == 'cm':
+            x = x/10.0; y = y/10.0
+        if angle == 'deg':
+            th = math.degrees(th)
+        return (x,y,th)
+
     def setPose(self, x, y, th, dist='cm', angle='deg'):
         """ setPose sets the internal odometry to the input values
         x: global x in mm
@@ -673,15 +2882,20 @@ class Create:
         dist: 'cm' or 'mm' for x and y
         angle: 'deg' or 'rad' for th
         """
-        if dist == 'cm':
-            self.xPose = x*10.0; self.yPose = y*10.0
-        else:
-            self.xPose = x; self.yPose = y
+        with self._sensorLock:
+            old = (self.xPose, self.yPose, self.thrPose)
+            if dist == 'cm':
+                self.xPose = x*10.0; self.yPose = y*10.0
+            else:
+                self.xPose = x; self.yPose = y
 
-        if angle == 'deg':
-            self.thrPose = math.radians(th)
-        else:
-            self.thrPose = th
+            if angle == 'deg':
+                self.thrPose = math.radians(th)
+            else:
+                self.thrPose = th
+
+            # keep the pose history in the same coordinates
+            self.poseHistory.rebase(old, (self.xPose, self.yPose, self.thrPose))
 
 
     def resetPose(self):
@@ -689,6 +2903,20 @@ class Create:
         """
         self.setPose(0.0,0.0,0.0)
 
+    def integrateOdometry(self, distances, rawAngles):
+        """ adds a whole batch of odometry readings (DISTANCE in mm,
+        ANGLE in degrees) to the robot's pose in one go and returns
+        the poses along the way, as the module-level integrateOdometry
+        does; needs numpy
+        """
+        with self._sensorLock:
+            poses = integrateOdometry(distances, rawAngles,
+                                      (self.xPose, self.yPose, self.thrPose))
+            if len(poses) > 0:
+                self.xPose, self.yPose, self.thrPose = [ float(v) for v in poses[-1] ]
+                self.poseHistory.append(time.monotonic(), self.xPose, self.yPose, self.thrPose)
+        return poses
+
     def _integrateNextOdometricStepCreate(self, distance, rawAngle):
         """ integrateNextOdometricStep adds the reported inputs
         distance in mm
@@ -762,19 +2990,7 @@ class Create:
         left_cm_sec:  left  wheel velocity in cm/sec (capped at +- 50)
         right_cm_sec: right wheel velocity in cm/sec (capped at +- 50)
         """
-        if left_cm_sec < -50: left_cm_sec = -50;
-        if left_cm_sec > 50:  left_cm_sec = 50;
-        if right_cm_sec < -50: right_cm_sec = -50;
-        if right_cm_sec > 50: right_cm_sec = 50;
-        # convert to mm/sec, ensure we have integers
-        leftHighVal, leftLowVal = _toTwosComplement2Bytes( int(left_cm_sec*10) )
-        rightHighVal, rightLowVal = _toTwosComplement2Bytes( int(right_cm_sec*10) )
-        # send these bytes and set the stored velocities
-        self._write( DRIVEDIRECT )
-        self._write( _chr(rightHighVal) )
-        self._write( _chr(rightLowVal) )
-        self._write( _chr(leftHighVal) )
-        self._write( _chr(leftLowVal) )
+        self._send( _wheelVelocitiesCommand( left_cm_sec, right_cm_sec ) )
 
     def stop(self):
         """ stop calls go(0,0) """
@@ -788,44 +3004,12 @@ class Create:
         degpsec degrees per second
         go() is equivalent to go(0,0)
         """
-        # need to convert to the roomba's drive parameters
-        #
-        # for now, just one or the other...
-        if cm_per_sec == 0:
-            # just handle rotation
-            # convert to radians
-            rad_per_sec = math.radians(deg_per_sec)
-            # make sure the direction is correct
-            if rad_per_sec >= 0:  dirstr = 'CCW'
-            else: dirstr = 'CW'
-            # compute the velocity, given that the robot's
-            # radius is 258mm/2.0
-            vel_mm_sec = math.fabs(rad_per_sec) * (258.0/2.0)
-            # send it off to the robot
-            self._drive( vel_mm_sec, 0, dirstr )
-
-        elif deg_per_sec == 0:
-            # just handle forward/backward translation
-            vel_mm_sec = 10.0*cm_per_sec
-            big_radius = 32767
-            # send it off to the robot
-            self._drive( vel_mm_sec, big_radius )
-
-        else:
-            # move in the appropriate arc
-            rad_per_sec = math.radians(deg_per_sec)
-            vel_mm_sec = 10.0*cm_per_sec
-            radius_mm = vel_mm_sec / rad_per_sec
-            # check for extremes
-            if radius_mm > 32767: radius_mm = 32767
-            if radius_mm < -32767: radius_mm = -32767
-            self._drive( vel_mm_sec, radius_mm )
-
+        self._send( _goCommand( cm_per_sec, deg_per_sec ) )
         return
 
     def _start(self):
         """ changes from OFF_MODE to PASSIVE_MODE """
-        self._write( START )
+        self._send( START )
         # they recommend 20 ms between mode-changing commands
         time.sleep(0.25)
         # change the mode we think we're in...
@@ -838,15 +3022,35 @@ class Create:
         closing the serial port
         """
         # is there other clean up to be done?
+        self.superviseLink(False)
+        self.instrument(False)
+        self.stopScheduler()
+        if self._motionExecutor is not None:
+            self._motionExecutor.shutdown(wait=True)
+            self._motionExecutor = None
+        self.stopStream()
         # let's get rid of any lingering odometric data
         # we don't call getSensorList, because we don't want to integrate the odometry...
         self._getRawSensorDataAsList( [19,20] )
         time.sleep(0.1)
+        # leave the robot at the rate it starts up at
+        if self.ser.baudrate != DEFAULT_BAUDRATE:
+            self.setBaudRate(DEFAULT_BAUDRATE)
         self._start()       # send Create back to passive mode
         time.sleep(0.1)
-        self.ser.close()
+        self._release()
         return
 
+    def _release(self):
+        """ closes the serial port, the recording and the emulator, if
+        any, without talking to the robot
+        """
+        self.ser.close()
+        self.stopRecording()
+        if getattr(self, '_simulator', None) is not None:
+            self._simulator.stop()
+            self._simulator = None
+
     def _closeSer(self):
         """ just disconnects the serial port """
         self.ser.close()
@@ -865,49 +3069,7 @@ class Create:
         other drive-related calls are available
         """
         #self.sensors([POSE])   # updated by Sean
-
-        # first, they should be ints
-        #   in case they're being generated mathematically
-        if type(roomba_mm_sec) != type(42):
-            roomba_mm_sec = int(roomba_mm_sec)
-        if type(roomba_radius_mm) != type(42):
-            roomba_radius_mm = int(roomba_radius_mm)
-
-        # we check that the inputs are within limits
-        # if not, we cap them there
-        if roomba_mm_sec < -500:
-            roomba_mm_sec = -500
-        if roomba_mm_sec > 500:
-            roomba_mm_sec = 500
-
-        # if the radius is beyond the limits, we go straight
-        # it doesn't really seem to go straight, however...
-        if roomba_radius_mm < -2000:
-            roomba_radius_mm = 32768
-        if roomba_radius_mm > 2000:
-            roomba_radius_mm = 32768
-
-        # get the two bytes from the velocity
-        # these come back as numbers, so we will chr them
-        velHighVal, velLowVal = _toTwosComplement2Bytes( roomba_mm_sec )
-
-        # get the two bytes from the radius in the same way
-        # note the special cases
-        if roomba_radius_mm == 0:
-            if turn_dir == 'CW':
-                roomba_radius_mm = -1
-            else: # default is 'CCW' (turning left)
-                roomba_radius_mm = 1
-        radiusHighVal, radiusLowVal = _toTwosComplement2Bytes( roomba_radius_mm )
-
-        #print 'bytes are', velHighVal, velLowVal, radiusHighVal, radiusLowVal
-
-        # send these bytes and set the stored velocities
-        self._write( DRIVE )
-        self._write( _chr(velHighVal) )
-        self._write( _chr(velLowVal) )
-        self._write( _chr(radiusHighVal) )
-        self._write( _chr(radiusLowVal) )
+        self._send( _driveCommand( roomba_mm_sec, roomba_radius_mm, turn_dir ) )
 
 
     def setLEDs(self, power_color, power_intensity, play, advance ):
@@ -918,9 +3080,6 @@ class Create:
         power_intensity are values from 0 to 255. The other two LED inputs
         should either be 0 (off) or 1 (on).
         """
-        # make sure we're within range...
-        if advance != 0: advance = 1
-        if play != 0: play = 1
         try:
             power = int(power_intensity)
             powercolor = int(power_color)
@@ -929,20 +3088,8 @@ class Create:
             powercolor = 128
             print('Type excpetion caught in setAbsoluteLEDs in roomba.py')
             print('Your power_color or power_intensity was not of type int.')
-        if power < 0: power = 0
-        if power > 255: power = 255
-        if powercolor < 0: powercolor = 0
-        if powercolor > 255: powercolor = 255
-        # create the first byte
-        #firstByteVal = (status << 4) | (spot << 3) | (clean << 2) | (max << 1) | dirtdetect
-        firstByteVal =  (advance << 3) | (play << 1) 
-
-        # send these as bytes
-        # print 'bytes are', firstByteVal, powercolor, power
-        self._write( LEDS )
-        self._write( _chr(firstByteVal) )
-        self._write( _chr(powercolor) )
-        self._write( _chr(power) )
+        # the values are kept within range as they are encoded
+        self._send( _setLEDsCommand( powercolor, power, play, advance ) )
 
         return
 
@@ -964,23 +3111,8 @@ class Create:
         if packetnumber < 0 or packetnumber > 6:
             packetnumber = 6
 
-        self._write( SENSORS )
-        self._write( _chr(packetnumber) )
-
-        if packetnumber == 0:
-            r = self._read(size=26)
-        if packetnumber == 1:
-            r = self._read(size=10)
-        if packetnumber == 2:
-            r = self._read(size=6)
-        if packetnumber == 3:
-            r = self._read(size=10)
-        if packetnumber == 4:
-            r = self._read(size=14)
-        if packetnumber == 5:
-            r = self._read(size=12)
-        if packetnumber == 6:
-            r = self._read(size=52)
+        size = _sensorDecoder( SENSOR_GROUPS[packetnumber] ).size
+        r = self._query( _byteCommand( SENSORS, packetnumber ), size )
 
         r = [ c for c in r ]   # convert to ints
         return r
@@ -991,15 +3123,11 @@ class Create:
         and returns the raw bytes, as a string
         needs to be converted to integers...
         """
-        numberOfSensors = len(listofsensors)
-        self._write( QUERYLIST )
-        self._write( _chr(numberOfSensors) )
         resultLength = 0
         for sensornum in listofsensors:
-            self._write( _chr(sensornum) )
             resultLength += SENSOR_DATA_WIDTH[sensornum]
 
-        r = self._read(size=resultLength)
+        r = self._query( _listCommand( QUERYLIST, listofsensors ), resultLength )
         r = [ c for c in r ]   # convert to ints
         #print 'r is ', r
         return r
@@ -1034,12 +3162,11 @@ class Create:
         if (demoNumber < -1 or demoNumber > 9):
             demoNumber = -1 # stop current demo
 
-        self._write( DEMO )
         if demoNumber < 0 or demoNumber > 9:
             # invalid values are equivalent to stopping
-            self._write( _chr(255) ) # -1
+            self._send( _byteCommand( DEMO, 255 ) ) # -1
         else:
-            self._write( _chr(demoNumber) )
+            self._send( _byteCommand( DEMO, demoNumber ) )
 
 
     def setSong(self, songNumber, songDataList):
@@ -1064,23 +3191,10 @@ class Create:
         if songNumber < 0: songNumber = 0
         if songNumber > 15: songNumber = 15
 
-        # indicate that a song is coming
-        self._write( SONG )
-        self._write( _chr(songNumber) )
-
-        L = min(len(songDataList), 16)
-        self._write( _chr(L) )
-
-        # loop through the notes, up to 16
-        for note in songDataList[:L]:
-            # make sure its a tuple, or else we rest for 1/4 second
-            if type(note) == type( () ):
-                #more error checking here!
-                self._write( _chr(note[0]) )  # note number
-                self._write( _chr(note[1]) )  # duration
-            else:
-                self._write( _chr(30) )   # a rest note
-                self._write( _chr(16) )   # 1/4 of a second
+        # the song and its notes, up to 16, go out together
+        command = _songCommand( songNumber, songDataList )
+        self._send( command )
+        self.songSlots.stored( songNumber, command[2:] )
 
         return
 
@@ -1089,10 +3203,23 @@ class Create:
         """ The input to <tt>playSong</tt> should be specified as a list
         of pairs of [ note_number, note_duration ] format. Thus, 
         r.playSong( [(60,8),(64,8),(67,8),(72,8)] ) plays a quick C chord.
+
+        songs are kept in the robot's 16 song slots (see SongSlots),
+        so a song that was played recently is just played again
+        rather than sent to the robot again
         """
-        # implemented by setting song #1 to the notes and then playing it
-        self.setSong(1, list_of_notes)
-        self.playSongNumber(1)
+        if type(list_of_notes) not in (type([]), type(())) or len(list_of_notes) < 1:
+            # let setSong complain about it
+            self.setSong(1, list_of_notes)
+            self.playSongNumber(1)
+            return
+        song = _songCommand( 0, list_of_notes )[2:]
+        slot = self.songSlots.find( song )
+        with self.batch():
+            if slot is None:
+                slot = self.songSlots.choose()
+                self.setSong(slot, list_of_notes)
+            self.playSongNumber(slot)
 
 
     def playSongNumber(self, songNumber):
@@ -1100,8 +3227,7 @@ class Create:
         if songNumber < 0: songNumber = 0
         if songNumber > 15: songNumber = 15
 
-        self._write( PLAY )
-        self._write( _chr(songNumber) )
+        self._send( _byteCommand( PLAY, songNumber ) )
 
 
     def playNote(self, noteNumber, duration, songNumber=0):
@@ -1114,42 +3240,11 @@ class Create:
         self.playSongNumber(songNumber)
 
 
-    def _getLower5Bits( self, r ):
-        """ r is one byte as an integer """
-        return [ _bitOfByte(4,r), _bitOfByte(3,r), _bitOfByte(2,r), _bitOfByte(1,r), _bitOfByte(0,r) ]
-
-    def _getOneBit( self, r ):
-        """ r is one byte as an integer """
-        if r == 1:  return 1
-        else:       return 0
-
-    def _getOneByteUnsigned( self, r ):
-        """ r is one byte as an integer """
-        return r
-
-    def _getOneByteSigned( self, r ):
-        """ r is one byte as a signed integer """
-        return _twosComplementInt1byte( r )
-
-    def _getTwoBytesSigned( self, r1, r2 ):
-        """ r1, r2 are two bytes as a signed integer """
-        return _twosComplementInt2bytes( r1, r2 )
-
-    def _getTwoBytesUnsigned( self, r1, r2 ):
-        """ r1, r2 are two bytes as an unsigned integer """
-        return r1 << 8 | r2
-
-    def _getButtonBits( self, r ):
-        """ r is one byte as an integer """
-        return [ _bitOfByte(2,r), _bitOfByte(0,r) ]
-
-
     def _setNextDataFrame(self):
         """ This function _asks_ the robot to collect ALL of
         the sensor data into the next packet to send back.
         """
-        self._write( SENSORS )
-        self._write( _chr(6) )
+        self._send( _byteCommand( SENSORS, 6 ) )
 
     def _getNextDataFrame(self):
         """ This function then gets back ALL of
@@ -1161,8 +3256,7 @@ class Create:
         #return self._readSensorList(r)
 
     def _rawSend( self, listofints ):
-        for x in listofints:
-            self._write( _chr(x) )
+        self._write( bytes(listofints) )
 
     def _rawRecv( self ):
         nBytesWaiting = self.ser.inWaiting()
@@ -1178,98 +3272,305 @@ class Create:
         r = self._read(size=nBytesWaiting)
         return r
 
+    def instrument(self, on=True, dumpEvery=None, out=print):
+        """ turns the counting of serial traffic on (or off, with
+        on=False); see IOStats and ioStats
+
+        if dumpEvery is given, a background thread hands
+        IOStats.report() to out every dumpEvery seconds
+
+        e.g. robot.instrument(dumpEvery=10.0)
+        """
+        if self._statsDumper is not None:
+            self._statsDumper.set()
+            self._statsDumper = None
+        if not on:
+            self._stats = None
+            return None
+        if self._stats is None:
+            self._stats = IOStats()
+        if dumpEvery is not None:
+            stopped = threading.Event()
+            def dump():
+                while not stopped.wait(dumpEvery):
+                    out(self._stats.report())
+            thread = threading.Thread(target=dump)
+            thread.daemon = True
+            thread.start()
+            self._statsDumper = stopped
+        return self._stats
+
+    def superviseLink(self, on=True, maxFaults=3, backoff=0.1, maxBackoff=5.0):
+        """ starts (or, with on=False, stops) a LinkWatchdog that stops
+        the robot and reconnects when the serial link fails, and
+        returns it; see onLinkChange and linkState
+
+        e.g. robot.superviseLink()
+             robot.onLinkChange(lambda state: print('link', state))
+        """
+        watchdog = self._watchdog
+        if watchdog is not None:
+            callbacks = watchdog.callbacks
+            self._watchdog = None
+            watchdog.stop()
+        else:
+            callbacks = []
+        if not on:
+            return None
+        self._watchdog = LinkWatchdog(self, maxFaults, backoff, maxBackoff)
+        self._watchdog.callbacks.extend(callbacks)
+        return self._watchdog
+
+    def onLinkChange(self, callback):
+        """ has callback(state) called, from the watchdog's thread, when
+        the link goes degraded (LINK_DEGRADED) and when it is back
+        (LINK_UP); see superviseLink
+        """
+        if self._watchdog is None:
+            self.superviseLink()
+        self._watchdog.callbacks.append(callback)
+
+    def linkState(self):
+        """ LINK_UP, or LINK_DEGRADED while the watchdog reconnects """
+        watchdog = self._watchdog
+        if watchdog is None:
+            return LINK_UP
+        return watchdog.state
+
+    def ioStats(self):
+        """ returns IOStats.snapshot() plus the number of stream
+        packets received, or None if instrument hasn't been called
+        """
+        stats = self._stats
+        if stats is None:
+            return None
+        d = stats.snapshot()
+        d['streamPackets'] = self.streamPackets
+        return d
+
     def sensors( self, list_of_sensors_to_poll=6 ):
         """ this function updates the robot's currently maintained
         state of its robot sensors for those sensors requested
         If none are requested, then all of the sensors are updated
         (which takes a bit more time...)
+
+        list_of_sensors_to_poll is either a list of sensors or the
+        number of a group packet (0 - 6); a list is not changed
         """
-        if type(list_of_sensors_to_poll) == type([]):
-            # first, we change any pieces of sensor values to
-            # the single digit that is required here
-            distangle = 0
-            if POSE in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(POSE)
-                # should check if they're already there
-                list_of_sensors_to_poll.append(DISTANCE)
-                list_of_sensors_to_poll.append(ANGLE)
-
-            if LEFT_BUMP in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(LEFT_BUMP)
-                if BUMPS_AND_WHEEL_DROPS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUMPS_AND_WHEEL_DROPS)
-
-            if RIGHT_BUMP in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(RIGHT_BUMP)
-                if BUMPS_AND_WHEEL_DROPS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUMPS_AND_WHEEL_DROPS)
-
-            if RIGHT_WHEEL_DROP in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(RIGHT_WHEEL_DROP)
-                if BUMPS_AND_WHEEL_DROPS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUMPS_AND_WHEEL_DROPS)
-
-            if LEFT_WHEEL_DROP in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(LEFT_WHEEL_DROP)
-                if BUMPS_AND_WHEEL_DROPS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUMPS_AND_WHEEL_DROPS) 
-
-            if CENTER_WHEEL_DROP in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(CENTER_WHEEL_DROP)
-                if BUMPS_AND_WHEEL_DROPS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUMPS_AND_WHEEL_DROPS)
-
-            if LEFT_WHEEL_OVERCURRENT in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(LEFT_WHEEL_OVERCURRENT)
-                if LSD_AND_OVERCURRENTS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(LSD_AND_OVERCURRENTS)
-
-            if RIGHT_WHEEL_OVERCURRENT in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(RIGHT_WHEEL_OVERCURRENT)
-                if LSD_AND_OVERCURRENTS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(LSD_AND_OVERCURRENTS)
-
-            if ADVANCE_BUTTON in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(ADVANCE_BUTTON)
-                if BUTTONS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUTTONS)
-
-            if PLAY_BUTTON in list_of_sensors_to_poll:
-                list_of_sensors_to_poll.remove(PLAY_BUTTON)
-                if BUTTONS not in list_of_sensors_to_poll:
-                    list_of_sensors_to_poll.append(BUTTONS)
-
-            r = self._getRawSensorDataAsList(list_of_sensors_to_poll)
+        stats = self._stats
+        # when streaming, the reader thread keeps sensord up to date
+        if self._streamThread is not None:
+            if stats is not None:
+                stats.sensorCacheHits += 1
+            return self._streamedSensors(list_of_sensors_to_poll)
+        # the robot doesn't answer while it is running a motion script
+        if self._inMotion:
+            if stats is not None:
+                stats.sensorCacheHits += 1
+            return self.sensord
+
+        # the query, its reply and the odometry in it are dealt with
+        # before any other thread's query
+        with self._ioLock:
+            if self._streamThread is not None or self._inMotion:
+                # that changed while waiting for the lock
+                return self.sensors(list_of_sensors_to_poll)
+            if not self._takeStray():
+                # nor while a motion script that timed out still runs
+                if stats is not None:
+                    stats.sensorCacheHits += 1
+                return self.sensord
+            plan = self._freshPlan(_planSensorQuery(list_of_sensors_to_poll))
+            if plan is None or plan.size == 0:
+                if stats is not None:
+                    stats.sensorCacheHits += 1
+                return self.sensord
+            if stats is not None:
+                start = time.perf_counter()
+                r = self._query(plan.request, plan.size)
+                stats._sensorQuery(time.perf_counter() - start)
+            else:
+                r = self._query(plan.request, plan.size)
+
+            # change our dictionary
+            self._readSensorList(plan.sensorList, r, plan.decoder)
+            return self.sensord
+
+    def _freshPlan(self, plan):
+        """ returns the plan that reads just the sensors of plan whose
+        values are older than their max age, or None if they are
+        all fresh enough
+        """
+        if not self.sensorMaxAge:
+            return plan
+        now = time.monotonic()
+        stale = [ s for s in plan.wanted
+                  if now - self._sensorTime.get(s, -1e9) >= self.sensorMaxAge.get(s, 0.0) ]
+        if len(stale) == len(plan.wanted):
+            return plan
+        if len(stale) == 0:
+            return None
+        # one query for all of the stale ones
+        return _planSensorQuery(stale)
+
+    def setSensorMaxAge(self, sensors, seconds):
+        """ lets sensors() answer from memory for any of the sensors
+        (a sensor or a list of them) read less than seconds ago;
+        0 means they are read every time
+
+        e.g. robot.setSensorMaxAge(create.BATTERY_SENSORS, 5.0)
+             robot.setSensorMaxAge(create.LEFT_BUMP, 0.02)
+        """
+        if type(sensors) != type([]):
+            sensors = [sensors]
+        for s in _rawSensorList(sensors):
+            if seconds > 0:
+                self.sensorMaxAge[s] = seconds
+            else:
+                self.sensorMaxAge.pop(s, None)
 
+    def _streamedSensors(self, list_of_sensors):
+        """ answers a sensors() call from the stream, adding any
+        requested sensors that aren't being streamed yet
+        """
+        if type(list_of_sensors) == type([]):
+            wanted = _rawSensorList(list_of_sensors)
         else:
-            # if it's an integer, its a frame number
-            r = self._getRawSensorFrameAsList( list_of_sensors_to_poll )
-            # now, we set list_of_sensors_to_poll
-            frameNumber = list_of_sensors_to_poll
-            if frameNumber == 0:
-                list_of_sensors_to_poll = list(range(7,27))
-            elif frameNumber == 1:
-                list_of_sensors_to_poll = list(range(7,17))
-            elif frameNumber == 2:
-                list_of_sensors_to_poll = list(range(17,21))
-            elif frameNumber == 3:
-                list_of_sensors_to_poll = list(range(21,27))
-            elif frameNumber == 4:
-                list_of_sensors_to_poll = list(range(27,35))
-            elif frameNumber == 5:
-                list_of_sensors_to_poll = list(range(35,43))
+            wanted = SENSOR_GROUPS.get(list_of_sensors, SENSOR_GROUPS[6])
+        missing = [ s for s in wanted if s not in self._streamSensors ]
+        if len(missing) > 0:
+            self.startStream(self._streamRequest + missing)
+        with self._sensorLock:
+            # (unless this is the reader, in a watch's callback)
+            if len(missing) > 0 and self._streamThread is not threading.current_thread():
+                # wait for the first packet that has the new sensors in it
+                self._streamUpdate.wait_for(
+                    lambda: all([ s in self._lastStreamPacket for s in missing ]),
+                    timeout=self.ser.timeout)
+            return dict(self.sensord)
+
+    def startStream(self, list_of_sensors=6):
+        """ asks the Create to send back the sensors in list_of_sensors
+        (a list, as for sensors(), or a group packet number) every 15 ms
+
+        a reader thread then decodes each packet into sensord and
+        integrates the odometry as it arrives, and sensors() answers
+        straight from sensord without touching the serial port
+
+        calling startStream again while streaming changes the
+        streamed sensors
+        """
+        with self._ioLock:
+            request, covered = _streamRequestFor(list_of_sensors)
+            self._send( _listCommand( STREAM, request ) )
+
+            with self._sensorLock:
+                self._streamRequest = request
+                self._streamSensors = covered
+                if self._streamThread is None:
+                    self._lastStreamPacket = []
+                    self._streamParser.reset()
+                    # the parser skips over anything that isn't a packet
+                    self._strayBytes = 0
+                    self._strayReply = b''
+                    if self._fleet is not None:
+                        # the fleet's I/O thread reads the port for us
+                        self._streamThread = self._fleet._thread
+                        self._fleet._watch(self)
+                    else:
+                        self._streamThread = threading.Thread(target=self._streamLoop)
+                        self._streamThread.daemon = True
+                        self._streamThread.start()
+            return
+
+    def stopStream(self):
+        """ asks the Create to stop streaming and stops the reader thread
+        """
+        with self._ioLock:
+            thread = self._streamThread
+            if thread is None:
+                return
+            self._streamThread = None
+            self._send( _byteCommand( PAUSERESUME, 0 ) )
+            if self._fleet is not None:
+                self._fleet._unwatch(self)
             else:
-                list_of_sensors_to_poll = list(range(7,43))
+                # the reader may be in a watch's callback, which may be
+                # waiting for _ioLock -- but it is done with the port
+                while thread.is_alive() and not self._streamFiring:
+                    thread.join(STREAM_PERIOD)
+            # throw away the rest of any packet that was on its way
+            time.sleep(STREAM_PERIOD)
+            self.ser.flushInput()
+            return
 
-        # change our dictionary
-        self._readSensorList(list_of_sensors_to_poll, r)      
-        return self.sensord
+    def isStreaming(self):
+        """ returns True while the sensors are being streamed """
+        return self._streamThread is not None
+
+    def _pauseStream(self):
+        """ stops the stream so that the port can be used for
+        request/response traffic; returns what to hand to
+        _resumeStream afterwards
+        """
+        if self._streamThread is None:
+            return None
+        request = self._streamRequest
+        self.stopStream()
+        return request
+
+    def _resumeStream(self, request):
+        """ restarts a stream stopped by _pauseStream """
+        if request is not None:
+            self.startStream(request)
+
+    def _streamLoop(self):
+        """ the body of the stream reader thread """
+        me = threading.current_thread()
+        while self._streamThread is me:
+            try:
+                waiting = self.ser.inWaiting()
+                r = self._read(size=max(1, waiting))
+            except (serial.SerialException, OSError, ValueError):
+                # the port went away underneath us
+                break
+            if not r:
+                if self._stats is not None and self._streamThread is me:
+                    self._stats.readTimeouts += 1
+                if self.linkState() != LINK_UP:
+                    # the watchdog restarts the stream once it reconnects
+                    break
+                continue
+            self._feedStream(r)
+
+    def _feedStream(self, r):
+        """ decodes the stream packets completed by the bytes in r;
+        returns how many there were
+        """
+        packets = self._streamParser.feed(r)
+        for sensorList, data in packets:
+            with self._sensorLock:
+                self._decodeSensorList(sensorList, data)
+                self.streamPackets += 1
+                self._lastStreamPacket = sensorList
+                self._streamUpdate.notify_all()
+        if self._firedWatches:
+            self._streamFiring = True
+            try:
+                self._fireWatches()
+            finally:
+                self._streamFiring = False
+        return len(packets)
 
     def printSensors(self):
         """ convenience function to show sensed data in d 
         if d is None, the current self.sensord is used instead
         """
-        self.sensors([LEFT_BUMP,RIGHT_BUMP,LEFT_WHEEL_DROP,RIGHT_WHEEL_DROP,CENTER_WHEEL_DROP,WALL_IR_SENSOR,CLIFF_LEFT,CLIFF_FRONT_LEFT,CLIFF_FRONT_RIGHT,CLIFF_RIGHT,VIRTUAL_WALL,LEFT_WHEEL_OVERCURRENT,RIGHT_WHEEL_OVERCURRENT,INFRARED_BYTE,PLAY_BUTTON,ADVANCE_BUTTON,POSE,CHARGING_STATE,VOLTAGE,CURRENT,BATTERY_TEMP,BATTERY_CHARGE,BATTERY_CAPACITY,WALL_SIGNAL,CLIFF_LEFT_SIGNAL,CLIFF_FRONT_LEFT_SIGNAL,CLIFF_FRONT_RIGHT_SIGNAL,CLIFF_RIGHT_SIGNAL,OI_MODE,SONG_NUMBER,SONG_PLAYING,CHARGING_SOURCES_AVAILABLE])
+        self.sensors(_PRINTED_SENSORS)
+        return self._printSensord()
+
+    def _printSensord(self):
+        """ the printing half of printSensors """
         d = self.sensord
         pose = d[POSE]
 
@@ -1312,128 +3613,56 @@ class Create:
 
 
 
-    def _readSensorList(self, sensor_data_list, r):
+    def _readSensorList(self, sensor_data_list, r, decoder=None):
         """ this returns the latest values from the particular
         sensors requested in the listofvalues
+        decoder is the _SensorDecoder for sensor_data_list, if the
+        caller already has it
+        """
+        # the stream reader thread may be doing the same thing...
+        with self._sensorLock:
+            d = self._decodeSensorList(sensor_data_list, r, decoder)
+        if self._firedWatches:
+            self._fireWatches()
+        return d
+
+    def _decodeSensorList(self, sensor_data_list, r, decoder=None):
+        """ the work of _readSensorList, called with the sensor
+        lock held
         """
 
         if len(sensor_data_list) == 0:
             print('No data was read in _readSensorList.')
             return self.sensord
 
-        sensorDataInterpreter = [ None, # 0
-                                  None, # 1
-                                  None, # 2
-                                  None, # 3
-                                  None, # 4
-                                  None, # 5
-                                  None, # 6
-                                  self._getLower5Bits, # 7 BUMPS_AND_WHEEL_DROPS
-                                  self._getOneBit, # 8 WALL_IR_SENSOR
-                                  self._getOneBit, # 9 CLIFF_LEFT = 9
-                                  self._getOneBit, # 10 CLIFF_FRONT_LEFT = 10
-                                  self._getOneBit, # 11 CLIFF_FRONT_RIGHT = 11
-                                  self._getOneBit, # 12 CLIFF_RIGHT = 12
-                                  self._getOneBit, # 13 VIRTUAL_WALL
-                                  self._getLower5Bits, # 14 LSD_AND_OVERCURRENTS
-                                  self._getOneBit, # 15 unused
-                                  self._getOneBit, # 16 unused
-                                  self._getOneByteUnsigned, # 17 INFRARED_BYTE
-                                  self._getButtonBits, # 18 BUTTONS
-                                  self._getTwoBytesSigned, # 19 DISTANCE
-                                  self._getTwoBytesSigned, # 20 ANGLE
-                                  self._getOneByteUnsigned, # 21 CHARGING_STATE
-                                  self._getTwoBytesUnsigned, # 22 VOLTAGE
-                                  self._getTwoBytesSigned, # 23 CURRENT
-                                  self._getOneByteSigned, # 24 BATTERY_TEMP
-                                  self._getTwoBytesUnsigned, # 25 BATTERY_CHARGE
-                                  self._getTwoBytesUnsigned, # 26 BATTERY_CAPACITY
-                                  self._getTwoBytesUnsigned, # 27 WALL_SIGNAL
-                                  self._getTwoBytesUnsigned, # 28 CLIFF_LEFT_SIGNAL
-                                  self._getTwoBytesUnsigned, # 29 CLIFF_FRONT_LEFT_SIGNAL
-                                  self._getTwoBytesUnsigned, # 30 CLIFF_FRONT_RIGHT_SIGNAL
-                                  self._getTwoBytesUnsigned, # 31 CLIFF_RIGHT_SIGNAL
-                                  self._getLower5Bits, # 32 CARGO_BAY_DIGITAL_INPUTS
-                                  self._getTwoBytesUnsigned, # 33 CARGO_BAY_ANALOG_SIGNAL
-                                  self._getOneByteUnsigned, # 34 CHARGING_SOURCES_AVAILABLE
-                                  self._getOneByteUnsigned, # 35 OI_MODE
-                                  self._getOneByteUnsigned, # 36 SONG_NUMBER
-                                  self._getOneByteUnsigned, # 37 SONG_PLAYING
-                                  self._getOneByteUnsigned, # 38 NUM_STREAM_PACKETS
-                                  self._getTwoBytesSigned, # 39 REQUESTED_VELOCITY
-                                  self._getTwoBytesSigned, # 40 REQUESTED_RADIUS
-                                  self._getTwoBytesSigned, # 41 REQUESTED_RIGHT_VELOCITY
-                                  self._getTwoBytesSigned, # 42 REQUESTED_LEFT_VELOCITY
-                                  None # only 42 as of right now
-                                  ]
-
-        startofdata = 0
-        distance = 0
-        angle = 0
-        for sensorNum in sensor_data_list:
-            width = SENSOR_DATA_WIDTH[sensorNum]
-            dataGetter = sensorDataInterpreter[sensorNum]
-            interpretedData = 0
-
-            if (width == 1):
-                if startofdata >= len(r):
-                    print("Incomplete Sensor Packet")
-                    break
-                else: interpretedData = dataGetter(r[startofdata])
-            if (width == 2):
-                if startofdata >= len(r) - 1:
-                    print("Incomplete Sensor Packet")
-                    break
-                else: interpretedData = dataGetter(r[startofdata], r[startofdata+1] )
-
-            # add to our dictionary
-            self.sensord[sensorNum] = interpretedData
-
-            # POSE = 100 - later
-
-            #LEFT_BUMP = 101
-            #RIGHT_BUMP = 102
-            #LEFT_WHEEL_DROP = 103
-            #RIGHT_WHEEL_DROP = 104
-            #CENTER_WHEEL_DROP = 105
-            if sensorNum == BUMPS_AND_WHEEL_DROPS:
-                self.sensord[CENTER_WHEEL_DROP] = interpretedData[0]
-                self.sensord[LEFT_WHEEL_DROP] = interpretedData[1]
-                self.sensord[RIGHT_WHEEL_DROP] = interpretedData[2]
-                self.sensord[LEFT_BUMP] = interpretedData[3]
-                self.sensord[RIGHT_BUMP] = interpretedData[4]
-
-            #LEFT_WHEEL_OVERCURRENT = 106
-            #RIGHT_WHEEL_OVERCURRENT = 107
-            if sensorNum == LSD_AND_OVERCURRENTS:
-                self.sensord[LEFT_WHEEL_OVERCURRENT] = interpretedData[0]
-                self.sensord[RIGHT_WHEEL_OVERCURRENT] = interpretedData[1]
-
-            #ADVANCE_BUTTON = 108
-            #PLAY_BUTTON = 109
-            if sensorNum == BUTTONS:
-                self.sensord[ADVANCE_BUTTON] = interpretedData[0]
-                self.sensord[PLAY_BUTTON] = interpretedData[1]
-
-            # handle special cases
-            if (sensorNum == DISTANCE):
-                distance = interpretedData
-                if self._debug == True:  # james' change
-                    print(distance)
-            if (sensorNum == ANGLE):
-                angle = interpretedData
-                if self._debug == True:  # james' change
-                    print(angle)
-
-            #resultingValues.append(interpretedData)
-            # update index for next sensor...
-            startofdata = startofdata + width
+        if decoder is None:
+            decoder = _sensorDecoder(sensor_data_list)
+        if len(r) < decoder.size:
+            # decode the sensors that did arrive
+            print("Incomplete Sensor Packet")
+            if self._stats is not None:
+                self._stats.incompletePackets += 1
+            decoder = _sensorDecoder(decoder.sensorsInBytes(len(r)))
+        distance, angle = decoder.decodeInto(self.sensord, r)
+        if OI_MODE in decoder.sensorList:
+            self._modeReported(self.sensord[OI_MODE])
+        now = time.monotonic()
+        self._sensorTime.update(dict.fromkeys(decoder.sensorList, now))
+
+        if self._debug == True:  # james' change
+            print(distance)
+            print(angle)
 
         if (distance != 0 or angle != 0):
             self._integrateNextOdometricStepCreate(distance,angle)
+        if decoder.distanceAt is not None or decoder.angleAt is not None:
+            self.poseHistory.append(now, self.xPose, self.yPose, self.thrPose)
 
         self.sensord[POSE] = self.getPose(dist='cm',angle='deg')
 
+        if self._watches:
+            self._checkWatches()
+
 
 
     def toFullMode(self):
@@ -1443,7 +3672,7 @@ class Create:
         time.sleep(0.03)
         self.toSafeMode()
         time.sleep(0.03)
-        self._write( FULL )
+        self._send( FULL )
         time.sleep(0.03)
         self.sciMode = FULL_MODE
 
@@ -1457,7 +3686,7 @@ class Create:
         self._start()
         time.sleep(0.03)
         # now we're in PASSIVE_MODE, so we repeat the above code...
-        self._write( SAFE )
+        self._send( SAFE )
         # they recommend 20 ms between mode-changing commands
         time.sleep(0.03)
         # change the mode we think we're in...
@@ -1474,165 +3703,120 @@ class Create:
 
 
     def _setBaudRate(self, baudrate=10):
-        """ sets the communications rate to the desired value """
+        """ asks the robot to change its communications rate to the
+        desired value; the port isn't changed (see setBaudRate)
+        returns False if the rate isn't one the robot knows
+        """
         # check for OK value
-        #baudcode = 10  # 57600, the default
-        if baudrate == 300: baudcode = 0
-        elif baudrate == 600: baudcode = 1
-        elif baudrate == 1200: baudcode = 2
-        elif baudrate == 2400: baudcode = 3
-        elif baudrate == 4800: baudcode = 4
-        elif baudrate == 9600: baudcode = 5
-        elif baudrate == 14400: baudcode = 6
-        elif baudrate == 19200: baudcode = 7
-        elif baudrate == 28800: baudcode = 8
-        elif baudrate == 38400: baudcode = 9
-        elif baudrate == 57600: baudcode = 10
-        elif baudrate == 115200: baudcode = 11
-        else:
+        if baudrate not in BAUD_RATES:
             print('The baudrate of', baudrate, 'in _setBaudRate')
             print('was not recognized. Not sending anything.')
-            return
+            return False
+        baudcode = BAUD_RATES.index(baudrate)
         # otherwise, send off the message
-        self._write( START )
-        self._write( _chr(baudcode) )
+        self._sendNow( _byteCommand( BAUD, baudcode ) )
+        # make sure it went out at the old rate
+        self.ser.flush()
         # the recommended pause
         time.sleep(0.1)
-        # change the mode we think we're in...
-        self.sciMode = PASSIVE_MODE
         # no response here, so we don't get any...
-        return
-
+        return True
+
+    def _reopenAt(self, baudrate):
+        """ reopens the port at baudrate """
+        self._closeSer()
+        self.ser.baudrate = baudrate
+        self._openSer()
+        if self._scheduler is not None:
+            self._scheduler.setBaudRate(baudrate)
+
+    def _linkWorks(self):
+        """ returns True if the robot answers a query for its OI mode
+        with something that makes sense
+        """
+        mode = self._probeMode()
+        if mode is None:
+            return False
+        self.sciMode = mode
+        self._modeReported(mode)
+        return True
+
+    def _modeReported(self, mode):
+        """ notes the OI mode the robot says it's in; when that has
+        changed, whoever changed it (the robot drops to passive mode by
+        itself on a cliff or a wheel drop), the drive and LEDs may not
+        be doing what they were last told
+        """
+        if mode != self._reportedMode:
+            self._reportedMode = mode
+            self._actuators.clear()
 
-    def _interpretSensorString( self, r ):
+    def _probeMode(self):
+        """ asks the robot for its OI mode, and returns it, or None if
+        nothing (or nothing that makes sense) came back in time
+        """
+        self.ser.flushInput()
+        self._strayBytes = 0
+        r = self._query( _listCommand( QUERYLIST, [OI_MODE] ), 1 )
+        if len(r) != 1 or r[0] > FULL_MODE:
+            return None
+        return r[0]
+
+    def setBaudRate(self, baudrate):
+        """ switches the robot and the serial port over to baudrate,
+        then checks that the robot still answers; if it doesn't, both
+        go back to the old rate
+
+        returns True if the link now runs at baudrate
+        """
+        with self._ioLock:
+            old = self.ser.baudrate
+            if baudrate == old:
+                return True
+            if baudrate not in BAUD_RATES:
+                print('The baudrate of', baudrate, 'in setBaudRate')
+                print('was not recognized. Staying at', old)
+                return False
+            streamed = self._pauseStream()
+            if self._scheduler is not None:
+                self._scheduler.flush()
+            self._setBaudRate(baudrate)
+            self._reopenAt(baudrate)
+            if self._linkWorks():
+                self._resumeStream(streamed)
+                return True
+
+            print('The robot did not answer at', baudrate, 'baud, going back to', old)
+            # it may have switched over, but the reply got lost...
+            self._setBaudRate(old)
+            self._reopenAt(old)
+            if not self._linkWorks():
+                print('The robot does not answer at', old, 'baud either!')
+            self._resumeStream(streamed)
+            return False
+
+
+    def _interpretSensorString( self, r, packetnumber=None ):
         """ This returns a sensorFrame object with its fields
-        filled in from the raw sensor return string, r, which
-        has to be the full 3-packet (26-byte) string.
+        filled in from the raw sensor return string, r, the
+        reply to [142][packetnumber] -- any of the group packets
+        0 - 6, which is worked out from r's length if not given
+        (a 10-byte r is taken to be packet 1, not 3)
 
         r is obtained by writing [142][0] to the serial port.
         """
-        # check length
-        # we should save a bit of time by handling each sub-string
-        # appropriately, but we don't do this yet...
-        if len(r) != 26:
+        if type(r) == type([]):
+            r = bytes(r)
+        if packetnumber is None:
+            sizes = [ (SENSOR_GROUP_DTYPES[g].itemsize, g) for g in sorted(SENSOR_GROUPS, reverse=True) ]
+            packetnumber = dict(sizes).get(len(r))
+        if packetnumber is None or len(r) != SENSOR_GROUP_DTYPES[packetnumber].itemsize:
             #print 'You have input an incorrectly formatted string to'
-            #print 'sensorStatus. It needs to have 26 bytes (full sensors).'
+            #print 'sensorStatus. It needs to be one whole group packet.'
             #print 'The input is', r
             return
 
-        s = SensorFrame()
-
-        # convert r so that it is a list of 26 ints instead of 26 chrs
-        r = [ ord(c) for c in r ]
-
-        # packet number 1 (10 bytes)
-
-        # byte 0: bumps and wheeldrops
-        s.casterDrop = _bitOfByte( 4, r[0] )
-        s.leftWheelDrop = _bitOfByte( 3, r[0] )
-        s.rightWheelDrop = _bitOfByte( 2, r[0] )
-        s.leftBump = _bitOfByte( 1, r[0] )
-        s.rightBump = _bitOfByte( 0, r[0] )
-
-        # byte 1: wall sensor, the IR looking to the right
-        s.wallSensor = _bitOfByte( 0, r[1] )
-
-        # byte 2: left cliff sensor
-        s.leftCliff = _bitOfByte( 0, r[2] )
-
-        # byte 3: front left cliff sensor
-        s.frontLeftCliff = _bitOfByte( 0, r[3] )
-
-        # byte 4: front right cliff sensor
-        s.frontRightCliff = _bitOfByte( 0, r[4] )
-
-        # byte 5: right cliff sensor
-        s.rightCliff = _bitOfByte( 0, r[5] )
-
-        # byte 6: virtual wall detector (the separate unit)
-        s.virtualWall = _bitOfByte( 0, r[6] )
-
-        # byte 7: motor overcurrents byte
-        s.driveLeft = _bitOfByte( 4, r[7] )
-        s.driveRight = _bitOfByte( 3, r[7] )
-        s.mainBrush = _bitOfByte( 2, r[7] )
-        s.vacuum = _bitOfByte( 1, r[7] )
-        s.sideBrush = _bitOfByte( 0, r[7] )
-
-        # byte 8: dirt detector left
-        # the dirt-detecting sensors are acoustic impact sensors
-        # basically, they hear the dirt (or don't) going by toward the back
-        # this value ranges from 0 (no dirt) to 255 (lots of dirt)
-        s.leftDirt = r[8]
-
-        # byte 9: dirt detector right
-        # some roomba's don't have the right dirt detector
-        # the dirt detectors are metallic disks near the brushes
-        s.rightDirt = r[9]
-
-        # packet number 2 (6 bytes)
-
-        # byte 10: remote control command
-        # this is the value of the remote control command currently
-        # being seen by the roomba, it is 255 if there is no command
-        # not all roombas have a remote control...
-        s.remoteControlCommand = r[10]
-
-        # byte 11: button presses
-        s.powerButton = _bitOfByte( 3, r[11] )
-        s.spotButton = _bitOfByte( 2, r[11] )
-        s.cleanButton = _bitOfByte( 1, r[11] )
-        s.maxButton = _bitOfByte( 0, r[11] )
-
-        # bytes 12 and 13: distance
-        # the distance that roomba has traveled, in mm, since the
-        # last time this data was requested (not from a SensorFrame,
-        # but from the roomba)
-        # It will stay at the max or min (32767 or -32768) if
-        # not polled often enough, i.e., it then means "a long way"
-        # It is the sum of the two drive wheels' distances, divided by 2
-        s.distance = _twosComplementInt2bytes( r[12], r[13] )
-
-        # bytes 14 and 15: angle
-        s.rawAngle = _twosComplementInt2bytes( r[14], r[15] )
-        # the distance between the wheels is 258 mm
-        s.angleInRadians = 2.0 * s.rawAngle / 258.0
-
-        # packet number 3 (10 bytes)
-
-        # byte 16: charging state
-        # 0 == not charging
-        # 1 == charging recovery
-        # 2 == charging
-        # 3 == trickle charging
-        # 4 == waiting
-        # 5 == charging error
-        s.chargingState = r[16]
-
-        # bytes 17 and 18: voltage in millivolts
-        # this is unsigned, so we don't use two's complement
-        s.voltage = r[17] << 8 | r[18]
-        # check this for byte order!!
-
-        # bytes 19 and 20: current in milliamps
-        # this is signed, from -32768 to 32767
-        # negative currents are flowing out of the battery
-        # positive currents are flowing into the battery (charging)
-        s.current = _twosComplementInt2bytes( r[19], r[20] )
-
-        # byte 21: temperature of the battery
-        # this is in degrees celsius
-        s.temperature = _twosComplementInt1byte( r[21] )
-
-        # bytes 22 and 23: charge of the battery in milliamp-hours
-        # this is two unsigned bytes
-        s.charge = r[22] << 8 | r[23]
-
-        # bytes 24 and 25: estimated capacity of the roomba's battery
-        # in units of milliamp-hours
-        # when the charge reaches this value, the battery is
-        # considered fully charged
-        s.capacity = r[24] << 8 | r[25]
+        s = SensorFrame( decodeSensorPackets( r, packetnumber )[0] )
 
         # OK, here we call a function to integrate the odometric
         # step taken here (unless distance and rawAngle are 0)
@@ -1643,74 +3827,134 @@ class Create:
     # Some new stuff added by Sean
 
     def _startScript(self, number_of_bytes):
-        self._write( SCRIPT )
-        self._write( _chr(number_of_bytes) )
+        self._send( _byteCommand( SCRIPT, number_of_bytes ) )
+        # the next number_of_bytes bytes this thread sends are the script
+        self._batchLocal.scriptBytes = number_of_bytes
         return
 
     def _endScript(self, timeout=-1.0):
-        # issue the ENDSCRIPT command to start the script
-        self._write( ENDSCRIPT )
-        interval = 1.0
-        total = 0.0
-
-        # strip out all existing crap
-        while(self._read(8192) != b''):
-            continue
-
-        # poll
-        while(timeout<0.0 or total < timeout):
-            self._write(SENSORS)
-            self._write( _chr(7))  # smallest packet value that I can tell
-            if self._read(1) != b'':
-                break
-            time.sleep(interval - 0.5)
-            total = total + interval
-
-        # strip out again, we buffered up lots of junk
-        while(self._read(8192) != b''):
-            continue
+        """ plays the script and waits for it to finish, for at most
+        timeout seconds unless timeout is negative; returns False if
+        it timed out
+
+        the robot doesn't read its input while it is in a WAIT
+        command, so a query sent right behind PLAY SCRIPT is answered
+        just as the script ends -- and the answer is the distance and
+        angle moved, which keeps the pose up to date
+        """
+        plan = _planSensorQuery([POSE])
+        inMotion = self._inMotion
+        self._inMotion = True
+        try:
+            with self._ioLock:
+                with self.batch():
+                    self._send( ENDSCRIPT )
+                    self._sendNow( plan.request )
+                r = self._dropStray( self._readUntil(self._strayBytes + plan.size, timeout) )
+        finally:
+            self._inMotion = inMotion
+        if len(r) < plan.size:
+            # the reply will still turn up, after the script is done
+            self._strayBytes += plan.size - len(r)
+            self._strayReply += r
+            return False
+        self._readSensorList(plan.sensorList, r, plan.decoder)
+        return True
 
     def _waitForDistance(self, distance_mm):
-        self._write(WAITDIST)
-        leftHighVal, leftLowVal = _toTwosComplement2Bytes( distance_mm )
-        self._write( _chr(leftHighVal) )
-        self._write( _chr(leftLowVal) )
+        self._send( _waitCommand( WAITDIST, distance_mm ) )
         return
 
     def _waitForAngle(self, angle_deg):
-        self._write(WAITANGLE)
-        leftHighVal, leftLowVal = _toTwosComplement2Bytes( angle_deg )
-        self._write( _chr(leftHighVal) )
-        self._write( _chr(leftLowVal) )
+        self._send( _waitCommand( WAITANGLE, angle_deg ) )
         return
 
-    def turn(self, angle_deg, deg_per_sec=20):
-        if angle_deg==0:
-            return
-        if deg_per_sec==0:
-            deg_per_sec=20
-        if (angle_deg < 0 and deg_per_sec > 0) or (angle_deg > 0 and deg_per_sec < 0):
-            deg_per_sec = 0 - deg_per_sec
-        self._startScript(13)
-        self.go(0, deg_per_sec)
-        self._waitForAngle(angle_deg)
-        self.stop()
-        self._endScript()
-        #self.sensors([POSE])   # updated by Sean
+    def turn(self, angle_deg, deg_per_sec=20, timeout=-1.0):
+        """ turns angle_deg degrees in place at deg_per_sec and
+        returns when the robot is done, or after timeout seconds if
+        timeout isn't negative; returns False if it timed out
+        """
+        return self.runScript( Script().turn(angle_deg, deg_per_sec), timeout )
 
-    def move(self, distance_cm, cm_per_sec=10):
-        if distance_cm==0:
-            return
-        if cm_per_sec==0:
-            cm_per_sec=10
-        if (distance_cm < 0 and cm_per_sec > 0) or (distance_cm > 0 and cm_per_sec < 0):
-            cm_per_sec = 0 - cm_per_sec
-        self._startScript(13)
-        self.go(cm_per_sec, 0)
-        self._waitForDistance(distance_cm*10)
-        self.stop()
-        self._endScript()
-        #self.sensors([POSE])   # updated by Sean
+    def move(self, distance_cm, cm_per_sec=10, timeout=-1.0):
+        """ moves distance_cm straight ahead (or back) at cm_per_sec
+        and returns when the robot is done, or after timeout seconds
+        if timeout isn't negative; returns False if it timed out
+        """
+        return self.runScript( Script().move(distance_cm, cm_per_sec), timeout )
+
+    def runScript(self, script, timeout=-1.0):
+        """ has the robot run script (a Script) by itself and returns
+        when it is done, or after timeout seconds if timeout isn't
+        negative; returns False if it timed out
+
+        each segment of the script goes to the robot in one write,
+        and costs one round trip: the robot answers the query sent
+        behind it when the segment is done
+        """
+        if len(script) == 0:
+            return True
+        if not self._takeStray():
+            # the last script that timed out is still running
+            return False
+        deadline = time.monotonic() + timeout
+        # other threads' sensors() calls answer from sensord from now
+        # on, rather than wait for the script to end
+        inMotion = self._inMotion
+        self._inMotion = True
+        try:
+            with self._ioLock:
+                streamed = self._pauseStream()
+                for slot, song in script.songs.items():
+                    self.songSlots.stored( slot, song )
+                done = True
+                for segment in script.segments():
+                    left = timeout
+                    if timeout >= 0:
+                        left = max(0.0, deadline - time.monotonic())
+                    # the whole segment goes to the robot in one write
+                    with self.batch():
+                        self._startScript( sum([ len(c) for c in segment ]) )
+                        for command in segment:
+                            self._send( command )
+                        done = self._endScript(left)
+                    if not done:
+                        break
+                self._resumeStream(streamed)
+        finally:
+            self._inMotion = inMotion
+        return done
+
+    def _startMotion(self, motion, *args):
+        """ runs turn or move in the background, returning a Future """
+        if self._motionExecutor is None:
+            self._motionExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._motionExecutor.submit(motion, *args)
+
+    def startTurn(self, angle_deg, deg_per_sec=20, timeout=-1.0):
+        """ starts turn() and returns right away with a
+        concurrent.futures.Future whose result is turn's
+
+        e.g. f = robot.startTurn(90)
+             while not f.done():
+                 ... process a camera frame ...
+
+        sensors() answers from sensord while the robot is turning,
+        because it doesn't reply to queries until it is done
+        """
+        return self._startMotion(self.turn, angle_deg, deg_per_sec, timeout)
+
+    def startMove(self, distance_cm, cm_per_sec=10, timeout=-1.0):
+        """ starts move() and returns right away with a
+        concurrent.futures.Future whose result is move's
+        """
+        return self._startMotion(self.move, distance_cm, cm_per_sec, timeout)
+
+    def startScript(self, script, timeout=-1.0):
+        """ starts runScript() and returns right away with a
+        concurrent.futures.Future whose result is runScript's
+        """
+        return self._startMotion(self.runScript, script, timeout)
 
     # James' syntactic sugar/kludgebox
 
@@ -1739,6 +3983,695 @@ class Create:
         This will have the robot go until the left bump sensor is pushed.
         """
         while (not comparison(sensorFunc(), value)):
-            time.sleep(0.05)
-            time.sleep(0.05)
+            if self._streamThread is not None:
+                # no need to poll, wake up when the next packet is in
+                with self._sensorLock:
+                    self._streamUpdate.wait(4*STREAM_PERIOD)
+            else:
+                time.sleep(0.05)
+                time.sleep(0.05)
+
+    def watch(self, predicate, sensors=[], callback=None, once=True):
+        """ returns a SensorWatch that fires as soon as sensor data is
+        decoded for which predicate(sensord) is true -- at the very
+        next stream packet when streaming
+
+        sensors lists what predicate looks at; they are added to the
+        stream, or polled by SensorWatch.wait when not streaming
+        callback, if given, is called with the sensor dictionary each
+        time the watch fires (from the stream reader thread when
+        streaming, so it should be quick), without the sensor lock
+        held, so it may use the robot
+        once means that the watch is cancelled after firing
+
+        e.g. w = robot.watch(create.bumped, [create.LEFT_BUMP, create.RIGHT_BUMP])
+             robot.go(20)
+             w.wait(10.0)
+             robot.stop()
+        """
+        w = SensorWatch(self, predicate, list(sensors), callback, once)
+        if self._streamThread is not None and len(sensors) > 0:
+            missing = [ s for s in _rawSensorList(sensors) if s not in self._streamSensors ]
+            if len(missing) > 0:
+                self.startStream(self._streamRequest + missing)
+        with self._sensorLock:
+            self._watches.append(w)
+            # it may be true already
+            self._checkWatches()
+        self._fireWatches()
+        return w
+
+    def _checkWatches(self):
+        """ finds the watches whose predicate is now true, for
+        _fireWatches to fire; called with the sensor lock held, each
+        time sensor data is decoded
+        """
+        for w in list(self._watches):
+            try:
+                fired = w.predicate(self.sensord)
+            except Exception as e:
+                w.error = e
+                fired = True
+            if fired:
+                if w.once:
+                    self._watches.remove(w)
+                self._firedWatches.append( (w, dict(self.sensord)) )
+
+    def _fireWatches(self):
+        """ fires the watches _checkWatches found, once the sensor lock
+        is let go of: the lock comes after the others (see _initState),
+        so a callback that uses the robot must not be called with it
+        held
+        """
+        with self._sensorLock:
+            fired = self._firedWatches
+            self._firedWatches = []
+        for w, sensord in fired:
+            w._fire(sensord)
+
+
+
+#
+# the robot class, for use from asyncio
+#
+class AsyncCreate(Create):
+    """ the AsyncCreate class is a Create for programs built around an
+    asyncio event loop: sensors, go, stop, setWheelVelocities, turn,
+    move, playSong, the mode changes and close are coroutines, and
+    nothing here blocks the loop waiting on the robot
+
+    the serial port is opened as by Create (so PORT may also be 'sim'
+    or an object that works like a serial.Serial), but non-blocking,
+    and watched with the loop's add_reader -- or polled, if it has no
+    file descriptor
+
+    the methods of Create that would block, or need threads of their
+    own, are coroutines here (setBaudRate) or start tasks on the loop
+    (startTurn, startMove, startScript, startConnect); watch,
+    startScheduler and superviseLink raise NotImplementedError
+
+    e.g. robot = create.AsyncCreate('/dev/ttyUSB0')
+         await robot.connect()
+         sensors = await robot.sensors([create.LEFT_BUMP])
+         await robot.turn(90)
+    """
+
+    def __init__(self, PORT, startingMode=SAFE_MODE, loop=None, baudrate=DEFAULT_BAUDRATE,
+                 record=None):
+        """ opens the serial port; the robot itself is got ready by
+        the connect coroutine
+        """
+        Create.__init__(self, PORT, startingMode, baudrate, record, connect=False)
+        self.ser.timeout = 0
+        # how long a reply may take to arrive
+        self.readTimeout = 0.5
+
+        self._loop = loop
+        self._rx = bytearray()
+        self._rxWaiter = None
+        self._queryLock = None
+        self._asyncStreaming = False
+        self._packetWaiter = None
+        # the port's file descriptor, or the task polling it
+        self._portWatch = None
+
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        """ the coroutine version of Create.connect: registers the
+        port with the event loop and gets the robot ready, raising
+        CreateConnectionError if that takes more than timeout seconds
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        if self._queryLock is None:
+            self._queryLock = asyncio.Lock()
+        if self._portWatch is None:
+            self._watchPort()
+        await self._handshakeAsync(self.startingMode, timeout)
+
+        # We need to read the angle and distance sensors so that
+        # their values clear out!
+        await self._asyncQuery( _listCommand( QUERYLIST, [DISTANCE, ANGLE] ), 4 )
+        self.setPose(0,0,0)
+
+        if self._startingBaudrate != self.ser.baudrate:
+            print('Switching the link to', self._startingBaudrate, 'baud...')
+            await self.setBaudRate(self._startingBaudrate)
+
+    async def _handshakeAsync(self, target, timeout):
+        """ the coroutine version of Create._handshake """
+        steps = self._handshakeSteps(target, time.monotonic() + timeout)
+        answer = None
+        while True:
+            try:
+                step = steps.send(answer)
+            except StopIteration:
+                break
+            answer = None
+            if step is _PROBE:
+                answer = await self._probeModeAsync()
+            elif type(step) == float:
+                await asyncio.sleep(step)
+            else:
+                self._sendNow(step)
+
+    async def _probeModeAsync(self):
+        """ the coroutine version of Create._probeMode """
+        self._strayBytes = 0
+        self._strayReply = b''
+        r = await self._asyncQuery( _listCommand( QUERYLIST, [OI_MODE] ), 1, PROBE_INTERVAL )
+        if len(r) != 1 or r[0] > FULL_MODE:
+            return None
+        return r[0]
+
+    def _watchPort(self):
+        """ has the loop call _onReadable when the port has data """
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, IOError, ValueError):
+            fd = None
+        if fd is not None:
+            self._loop.add_reader(fd, self._onReadable)
+            self._portWatch = fd
+        else:
+            # e.g. a ReplaySerial, which has nothing to select on
+            self._portWatch = self._loop.create_task(self._pollPort())
+
+    def _unwatchPort(self):
+        watch = self._portWatch
+        self._portWatch = None
+        if type(watch) == type(0):
+            self._loop.remove_reader(watch)
+        elif watch is not None:
+            watch.cancel()
+
+    async def _pollPort(self):
+        """ stands in for add_reader, for ports without a file descriptor """
+        while True:
+            if self.ser.inWaiting() > 0:
+                self._onReadable()
+            else:
+                await asyncio.sleep(0.001)
+
+    async def setBaudRate(self, baudrate):
+        """ the coroutine version of Create.setBaudRate """
+        old = self.ser.baudrate
+        if baudrate == old:
+            return True
+        if baudrate not in BAUD_RATES:
+            print('The baudrate of', baudrate, 'in setBaudRate')
+            print('was not recognized. Staying at', old)
+            return False
+        streamed = self._asyncStreaming
+        request = self._streamRequest
+        await self.stopStream()
+        for rate in (baudrate, old):
+            self._sendNow( _byteCommand( BAUD, BAUD_RATES.index(rate) ) )
+            # the recommended pause
+            await asyncio.sleep(0.1)
+            self._unwatchPort()
+            self._reopenAt(rate)
+            self._watchPort()
+            mode = await self._probeModeAsync()
+            if mode is not None:
+                self.sciMode = mode
+                self._modeReported(mode)
+                break
+            if rate == baudrate:
+                print('The robot did not answer at', baudrate, 'baud, going back to', old)
+            else:
+                print('The robot does not answer at', old, 'baud either!')
+        if streamed:
+            self.startStream(request)
+        return mode is not None and rate == baudrate
+
+    def startConnect(self, timeout=CONNECT_TIMEOUT):
+        """ starts connect() as a task on the event loop, and returns it """
+        return asyncio.ensure_future(self.connect(timeout))
+
+    def startTurn(self, angle_deg, deg_per_sec=20, timeout=-1.0):
+        """ starts turn() as a task on the event loop, and returns it """
+        return asyncio.ensure_future(self.turn(angle_deg, deg_per_sec, timeout))
+
+    def startMove(self, distance_cm, cm_per_sec=10, timeout=-1.0):
+        """ starts move() as a task on the event loop, and returns it """
+        return asyncio.ensure_future(self.move(distance_cm, cm_per_sec, timeout))
+
+    def startScript(self, script, timeout=-1.0):
+        """ starts runScript() as a task on the event loop, and returns it """
+        return asyncio.ensure_future(self.runScript(script, timeout))
+
+    def watch(self, predicate, sensors=[], callback=None, once=True):
+        raise NotImplementedError('AsyncCreate has no watches: await sensors() in a loop instead')
+
+    def startScheduler(self, tick=0.015, budget=None):
+        raise NotImplementedError('AsyncCreate has no CommandScheduler')
+
+    def superviseLink(self, on=True, maxFaults=3, backoff=0.1, maxBackoff=5.0):
+        if on:
+            raise NotImplementedError('AsyncCreate has no LinkWatchdog')
+
+    async def close(self):
+        """ the coroutine version of Create.close """
+        self.instrument(False)
+        await self.stopStream()
+        await self._asyncQuery( _listCommand( QUERYLIST, [DISTANCE, ANGLE] ), 4 )
+        await asyncio.sleep(0.1)
+        # leave the robot at the rate it starts up at
+        if self.ser.baudrate != DEFAULT_BAUDRATE:
+            await self.setBaudRate(DEFAULT_BAUDRATE)
+        await self.start()
+        await asyncio.sleep(0.1)
+        self._unwatchPort()
+        self._release()
+
+    def _onReadable(self):
+        """ called by the event loop when the port has data """
+        try:
+            data = self.ser.read(max(1, self.ser.inWaiting()))
+        except (serial.SerialException, OSError):
+            return
+        if not data:
+            return
+        if self._stats is not None:
+            self._stats.reads += 1
+            self._stats.bytesIn += len(data)
+        if self._recorder is not None:
+            self._recorder.record(LOG_READ, data)
+        if self._asyncStreaming:
+            for sensorList, packet in self._streamParser.feed(data):
+                self._readSensorList(sensorList, packet)
+                self.streamPackets += 1
+                self._lastStreamPacket = sensorList
+            if self._packetWaiter is not None and not self._packetWaiter.done():
+                self._packetWaiter.set_result(None)
+        else:
+            self._rx.extend(data)
+            if self._rxWaiter is not None and not self._rxWaiter.done():
+                self._rxWaiter.set_result(None)
+
+    async def _readAsync(self, size, timeout=None):
+        """ returns the next size bytes from the robot, or fewer if
+        they don't all arrive within timeout seconds (readTimeout if
+        timeout is None, and as long as it takes if it's negative)
+        """
+        if timeout is None:
+            timeout = self.readTimeout
+        deadline = None
+        if timeout >= 0:
+            deadline = self._loop.time() + timeout
+        while len(self._rx) < size:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+            self._rxWaiter = self._loop.create_future()
+            try:
+                await asyncio.wait_for(self._rxWaiter, remaining)
+            except asyncio.TimeoutError:
+                break
+            finally:
+                self._rxWaiter = None
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    async def _asyncQuery(self, command, size, timeout=None):
+        """ sends command and returns its size byte reply; one query
+        at a time, so that replies can't get mixed up
+        """
+        async with self._queryLock:
+            if not await self._awaitStray(timeout):
+                # the robot is still running the script, and won't
+                # read the command until it's done
+                r = b''
+            else:
+                # anything still lying around belongs to nobody
+                del self._rx[:]
+                self._write(command)
+                r = await self._readAsync(size, timeout)
+            if len(r) < size and self._stats is not None:
+                self._stats.readTimeouts += 1
+            return r
+
+    async def _awaitStray(self, timeout=None):
+        """ waits (as _readAsync does) for what is left of the reply to
+        a motion script that timed out, and folds it into the pose;
+        returns False if it still hasn't all arrived
+        """
+        stray = self._strayBytes
+        if stray > 0:
+            # some of it may be here already
+            self._dropStray( bytes(self._rx[:stray]) )
+            del self._rx[:stray]
+        if self._strayBytes > 0:
+            self._dropStray( await self._readAsync(self._strayBytes, timeout) )
+        return self._strayBytes == 0
+
+    async def sensors(self, list_of_sensors_to_poll=6):
+        """ the coroutine version of Create.sensors """
+        if self._asyncStreaming:
+            return await self._streamedSensorsAsync(list_of_sensors_to_poll)
+
+        stats = self._stats
+        plan = self._freshPlan(_planSensorQuery(list_of_sensors_to_poll))
+        if plan is None or plan.size == 0:
+            if stats is not None:
+                stats.sensorCacheHits += 1
+            return self.sensord
+        start = time.perf_counter()
+        r = await self._asyncQuery(plan.request, plan.size)
+        if stats is not None:
+            stats._sensorQuery(time.perf_counter() - start)
+        self._readSensorList(plan.sensorList, r, plan.decoder)
+        return self.sensord
+
+    async def _streamedSensorsAsync(self, list_of_sensors):
+        """ the coroutine version of Create._streamedSensors """
+        if type(list_of_sensors) == type([]):
+            wanted = _rawSensorList(list_of_sensors)
+        else:
+            wanted = SENSOR_GROUPS.get(list_of_sensors, SENSOR_GROUPS[6])
+        missing = [ s for s in wanted if s not in self._streamSensors ]
+        if len(missing) > 0:
+            self.startStream(self._streamRequest + missing)
+            deadline = self._loop.time() + self.readTimeout
+            while not all([ s in self._lastStreamPacket for s in missing ]):
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                self._packetWaiter = self._loop.create_future()
+                try:
+                    await asyncio.wait_for(self._packetWaiter, remaining)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self._packetWaiter = None
+        return dict(self.sensord)
+
+    def startStream(self, list_of_sensors=6):
+        """ as Create.startStream, but the packets are decoded by the
+        event loop rather than by a thread
+        """
+        request, covered = _streamRequestFor(list_of_sensors)
+        self._send( _listCommand( STREAM, request ) )
+        self._streamRequest = request
+        self._streamSensors = covered
+        if not self._asyncStreaming:
+            self._lastStreamPacket = []
+            self._streamParser.reset()
+            # the parser skips over anything that isn't a packet
+            self._strayBytes = 0
+            self._strayReply = b''
+            self._asyncStreaming = True
+
+    async def stopStream(self):
+        """ the coroutine version of Create.stopStream """
+        if not self._asyncStreaming:
+            return
+        self._send( _byteCommand( PAUSERESUME, 0 ) )
+        # let the rest of any packet that was on its way arrive
+        await asyncio.sleep(STREAM_PERIOD)
+        self._asyncStreaming = False
+        del self._rx[:]
+
+    def isStreaming(self):
+        """ returns True while the sensors are being streamed """
+        return self._asyncStreaming
+
+    async def go(self, cm_per_sec=0, deg_per_sec=0):
+        """ the coroutine version of Create.go """
+        self._send( _goCommand( cm_per_sec, deg_per_sec ) )
+
+    async def stop(self):
+        """ the coroutine version of Create.stop """
+        self._send( _goCommand( 0, 0 ) )
+        # we've gotta update pose information
+        await self.sensors([POSE])
+
+    async def setWheelVelocities(self, left_cm_sec, right_cm_sec):
+        """ the coroutine version of Create.setWheelVelocities """
+        self._send( _wheelVelocitiesCommand( left_cm_sec, right_cm_sec ) )
+
+    async def playSong(self, list_of_notes):
+        """ the coroutine version of Create.playSong """
+        Create.playSong(self, list_of_notes)
+
+    async def start(self):
+        """ changes from OFF_MODE to PASSIVE_MODE """
+        self._send( START )
+        # they recommend 20 ms between mode-changing commands
+        await asyncio.sleep(0.25)
+        self.sciMode = PASSIVE_MODE
+
+    async def toSafeMode(self):
+        """ the coroutine version of Create.toSafeMode """
+        await self.start()
+        self._send( SAFE )
+        await asyncio.sleep(0.03)
+        self.sciMode = SAFE_MODE
+
+    async def toFullMode(self):
+        """ the coroutine version of Create.toFullMode """
+        await self.toSafeMode()
+        self._send( FULL )
+        await asyncio.sleep(0.03)
+        self.sciMode = FULL_MODE
+
+    async def _runMotionScript(self, script, timeout):
+        """ uploads and plays one segment of a script and waits for it to
+        finish; the robot doesn't answer the query sent right after
+        PLAY SCRIPT until the script is done, and the answer is the
+        distance and angle moved, so the pose is up to date too
+        """
+        if not await self._awaitStray(timeout):
+            # the last script that timed out is still running
+            return False
+        streamed = self._asyncStreaming
+        request = self._streamRequest
+        await self.stopStream()
+        plan = _planSensorQuery([POSE])
+        # the script leaves the robot stopped
+        self._actuators.clear()
+        r = await self._asyncQuery(script + ENDSCRIPT + plan.request, plan.size, timeout)
+        finished = len(r) == plan.size
+        if finished:
+            self._readSensorList(plan.sensorList, r, plan.decoder)
+        else:
+            # the reply will still turn up, after the script is done,
+            # and the next query takes it off the front of its own
+            self._strayBytes += plan.size - len(r)
+            self._strayReply += r
+        if streamed:
+            self.startStream(request)
+        return finished
+
+    async def turn(self, angle_deg, deg_per_sec=20, timeout=-1.0):
+        """ the coroutine version of Create.turn, finishing when the
+        robot has turned (or after timeout seconds, if not negative);
+        returns False if it timed out
+        """
+        return await self.runScript( Script().turn(angle_deg, deg_per_sec), timeout )
+
+    async def move(self, distance_cm, cm_per_sec=10, timeout=-1.0):
+        """ the coroutine version of Create.move, finishing when the
+        robot has moved (or after timeout seconds, if not negative);
+        returns False if it timed out
+        """
+        return await self.runScript( Script().move(distance_cm, cm_per_sec), timeout )
+
+    async def runScript(self, script, timeout=-1.0):
+        """ the coroutine version of Create.runScript, finishing when
+        the robot is done (or after timeout seconds, if not negative);
+        returns False if it timed out
+        """
+        deadline = time.monotonic() + timeout
+        for slot, song in script.songs.items():
+            self.songSlots.stored( slot, song )
+        for segment in script.compile():
+            left = timeout
+            if timeout >= 0:
+                left = max(0.0, deadline - time.monotonic())
+            if not await self._runMotionScript(segment, left):
+                return False
+        return True
+
+    async def printSensors(self):
+        """ the coroutine version of Create.printSensors """
+        await self.sensors(_PRINTED_SENSORS)
+        return self._printSensord()
+
+    def senseFunc(self, sensorName):
+        """ as Create.senseFunc, but the function returned is a
+        coroutine function
+        """
+        async def f():
+            return (await self.sensors([sensorName]))[sensorName]
+        return f
+
+    async def sleepTill(self, sensorFunc, comparison, value):
+        """ the coroutine version of Create.sleepTill, for use with
+        the functions returned by senseFunc
+        """
+        while (not comparison(await sensorFunc(), value)):
+            await asyncio.sleep(0.1)
+
+
+#
+# many robots, one I/O thread
+#
+class Fleet:
+    """ runs several Creates from one host: each robot streams
+    sensors back, and a single I/O thread waits on all of their ports
+    at once (with a selector) and decodes whatever arrives into that
+    robot's sensord
+
+    ports is a list of ports as for Create ('sim' for an emulated
+    robot), names a matching list of names (by default 0, 1, 2, ...),
+    and sensors the sensors every robot streams
+
+    each robot is an ordinary Create, so fleet[name].go(20) and so on
+    command one robot, and fleet.each('stop') all of them
+
+    e.g. fleet = create.Fleet(['/dev/ttyUSB0', '/dev/ttyUSB1'])
+         fleet.onSensors(lambda name, robot: ...)
+         fleet[0].go(20)
+         ...
+         fleet.close()
+    """
+
+    def __init__(self, ports, names=None, sensors=[LEFT_BUMP, RIGHT_BUMP, POSE],
+                 startingMode=SAFE_MODE):
+        if names is None:
+            names = list(range(len(ports)))
+        self.sensorList = sensors
+        self.robots = collections.OrderedDict()
+        self._callbacks = []
+        self._selector = selectors.DefaultSelector()
+        # other threads hand the I/O thread work through _requests,
+        # and wake it up by writing to this pipe
+        self._requests = collections.deque()
+        self._wakeRead, self._wakeWrite = os.pipe()
+        self._selector.register(self._wakeRead, selectors.EVENT_READ, None)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        # the robots' start up is mostly waiting, so do it all at once
+        if len(ports) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+                robots = list(pool.map(lambda port: Create(port, startingMode), ports))
+            for name, robot in zip(names, robots):
+                self.add(name, robot)
+
+    def add(self, name, robot):
+        """ adds a connected Create to the fleet and starts its stream """
+        robot.stopStream()
+        robot._fleet = self
+        self.robots[name] = robot
+        robot.startStream(self.sensorList)
+
+    def __getitem__(self, name):
+        return self.robots[name]
+
+    def __len__(self):
+        return len(self.robots)
+
+    def __iter__(self):
+        return iter(self.robots)
+
+    def names(self):
+        return list(self.robots)
+
+    def sensors(self, name):
+        """ returns the sensor dictionary of robot name """
+        return self.robots[name].sensord
+
+    def onSensors(self, callback):
+        """ has the I/O thread call callback(name, robot) whenever a
+        stream packet from robot name has been decoded; it should be
+        quick, as every robot waits on it
+        """
+        self._callbacks.append(callback)
+
+    def each(self, method, *args, **kwargs):
+        """ calls the Create method named method on every robot, and
+        returns a dictionary of the results, by name
+        """
+        results = {}
+        for name, robot in self.robots.items():
+            results[name] = getattr(robot, method)(*args, **kwargs)
+        return results
+
+    def stopAll(self):
+        self.each('stop')
+
+    def close(self):
+        """ closes every robot's connection and stops the I/O thread """
+        for robot in self.robots.values():
+            robot.close()
+            robot._fleet = None
+        self._running = False
+        self._call(None)
+        self._thread.join()
+        self._selector.close()
+        os.close(self._wakeRead)
+        os.close(self._wakeWrite)
+
+    def _call(self, f):
+        """ has the I/O thread call f (if not None) and waits for it """
+        if threading.current_thread() is self._thread:
+            if f is not None:
+                f()
+            return
+        done = threading.Event()
+        self._requests.append((f, done))
+        os.write(self._wakeWrite, b'x')
+        if self._thread.is_alive():
+            done.wait()
+
+    def _watch(self, robot):
+        """ starts reading robot's port """
+        name = self._nameOf(robot)
+        self._call(lambda: self._selector.register(robot.ser.fileno(), selectors.EVENT_READ,
+                                                   (name, robot)))
+
+    def _unwatch(self, robot):
+        """ stops reading robot's port """
+        def unregister():
+            try:
+                self._selector.unregister(robot.ser.fileno())
+            except (KeyError, ValueError):
+                pass
+        self._call(unregister)
+
+    def _run(self):
+        """ the body of the I/O thread """
+        while self._running or self._requests:
+            for key, events in self._selector.select():
+                if key.data is None:
+                    os.read(self._wakeRead, 4096)
+                    while self._requests:
+                        f, done = self._requests.popleft()
+                        if f is not None:
+                            f()
+                        done.set()
+                    continue
+                name, robot = key.data
+                try:
+                    r = robot._read(size=max(1, robot.ser.inWaiting()))
+                except (serial.SerialException, OSError, ValueError):
+                    # the port went away
+                    self._selector.unregister(key.fileobj)
+                    continue
+                if r and robot._feedStream(r) > 0:
+                    for callback in self._callbacks:
+                        callback(name, robot)
+
+    def _nameOf(self, robot):
+        for name, r in self.robots.items():
+            if r is robot:
+                return name
+        return None
 
@@ -0,0 +1,706 @@
+#
+# create_bench.py
+#
+# Microbenchmarks for the protocol code in create.py
+# No robot is needed: everything runs against bytes in memory, apart
+# from --stop-latency, --stress and --fleet, which drive emulated robots
+# (createsim.py)
+#
+#   python create_bench.py [--frames N] [--odometry N] [--stop-latency]
+#                          [--stress N] [--fleet N] [--json FILE] [--compare FILE]
+#
+# --json writes the timings (seconds per call, by name) to FILE, and
+# --compare FILE prints how they changed since FILE was written,
+# e.g. at an earlier commit
+#
+#   python create_bench.py --check
+#
+# runs the checks instead, and exits with 1 if any of them fail
+#
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import create
+import createsim
+
+
+class MemorySerial:
+    """ stands in for a serial port, in memory: what is written goes
+    to an emulated robot (a createsim.OIDevice), or nowhere if there
+    is none, and its replies can be read back right away
+
+    with cache, the robot works out the reply to each different
+    request just once, and after that the reply is played back, so
+    that timings are of create.py alone
+    """
+
+    def __init__(self, device=None, cache=False):
+        self.device = device
+        self.cache = cache
+        self.timeout = 0.5
+        self.baudrate = create.DEFAULT_BAUDRATE
+        self.bytesWritten = 0
+        self._replies = {}
+        self._input = bytearray()
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+        if self.device is None:
+            return len(data)
+        reply = self._replies.get(data) if self.cache else None
+        if reply is None:
+            self.device.receive(data)
+            reply = self.device.output()
+            if self.cache:
+                self._replies[bytes(data)] = reply
+        self._input.extend(reply)
+        return len(data)
+
+    def read(self, size=1):
+        if size is None:
+            size = len(self._input)
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        return data
+
+    def inWaiting(self):
+        return len(self._input)
+
+    @property
+    def in_waiting(self):
+        return len(self._input)
+
+    def flushInput(self):
+        del self._input[:]
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _memoryRobot(device=None, cache=False):
+    """ returns a Create on a MemorySerial, connected if there is a
+    device to connect to
+    """
+    port = MemorySerial(device)
+    with contextlib.redirect_stdout(io.StringIO()):
+        robot = create.Create(port, connect=device is not None)
+    # not before: the handshake's replies change as the mode does
+    port.cache = cache
+    # every sensor is read on every call
+    robot.sensorMaxAge = {}
+    return robot
+
+
+def _perCall(f, number):
+    """ the best time (in seconds) per call of f over 5 runs """
+    return min(timeit.repeat(f, number=number, repeat=5)) / number
+
+
+# the sensor lists benchProtocol times sensors() with
+_SENSOR_SETS = { 'bumpers': [create.LEFT_BUMP, create.RIGHT_BUMP],
+                 'pose': [create.POSE],
+                 'bumpers_pose': [create.LEFT_BUMP, create.RIGHT_BUMP, create.POSE],
+                 'printed': create._PRINTED_SENSORS }
+
+def benchProtocol(number):
+    """ returns the time (in seconds) per call of encoding and sending
+    the common commands, and of sensors() reading the common sensor
+    sets and each of the group packets, through a MemorySerial; keyed
+    by name, e.g. 'encode.go' or 'sensors.group6'
+    """
+    results = {}
+    song = [ (60 + i, 8) for i in range(16) ]
+    robot = _memoryRobot()
+    robot.suppressRepeats = False
+    results['encode.go'] = _perCall(lambda: robot.go(20, 15), number)
+    results['encode._drive'] = _perCall(lambda: robot._drive(200, 500), number)
+    results['encode.setWheelVelocities'] = _perCall(lambda: robot.setWheelVelocities(20, -20), number)
+    results['encode.setLEDs'] = _perCall(lambda: robot.setLEDs(128, 255, 1, 0), number)
+    results['encode.setSong'] = _perCall(lambda: robot.setSong(1, song), number)
+    robot.suppressRepeats = True
+    results['encode.go_repeated'] = _perCall(lambda: robot.go(20, 15), number)
+
+    robot = _memoryRobot(createsim.OIDevice(), cache=True)
+    for name in sorted(_SENSOR_SETS):
+        sensors = _SENSOR_SETS[name]
+        results['sensors.' + name] = _perCall(lambda: robot.sensors(sensors), number)
+    for group in sorted(create.SENSOR_GROUPS):
+        results['sensors.group%d' % group] = _perCall(lambda: robot.sensors(group), number)
+    return results
+
+
+def benchDecode(number):
+    """ returns the time (in seconds) it takes to decode one packet
+    of each of the group packets 0 - 6 into a sensor dictionary,
+    keyed by the group number
+    """
+    rng = random.Random(0)
+    results = {}
+    for group in sorted(create.SENSOR_GROUPS):
+        decoder = create._sensorDecoder(create.SENSOR_GROUPS[group])
+        packet = memoryview(bytes([ rng.randrange(256) for i in range(decoder.size) ]))
+        d = {}
+        best = min(timeit.repeat(lambda: decoder.decodeInto(d, packet),
+                                 number=number, repeat=5))
+        results[group] = best / number
+    return results
+
+
+def benchFrames(frames, number=20):
+    """ returns the time (in seconds) per packet it takes to decode
+    frames group 6 packets, back to back in one buffer, with
+    decodeSensorPackets and with the packet-at-a-time decoder
+    """
+    rng = random.Random(0)
+    decoder = create._sensorDecoder(create.SENSOR_GROUPS[6])
+    data = bytes([ rng.randrange(256) for i in range(decoder.size * frames) ])
+    def oneAtATime():
+        view = memoryview(data)
+        d = {}
+        for k in range(0, len(data), decoder.size):
+            decoder.decodeInto(d, view[k:])
+    batch = min(timeit.repeat(lambda: create.decodeSensorPackets(data)['distance'].sum(),
+                              number=number, repeat=5))
+    single = min(timeit.repeat(oneAtATime, number=1, repeat=3))
+    return single / frames, batch / number / frames
+
+
+def benchOdometry(samples):
+    """ returns the time (in seconds) per reading it takes to integrate
+    samples random odometry readings one at a time, and all at once
+    with integrateOdometry, and the largest difference in the poses
+    """
+    rng = random.Random(0)
+    distances = [ rng.randint(-50, 50) for i in range(samples) ]
+    angles = [ rng.randint(-10, 10) for i in range(samples) ]
+    robot = create.Create.__new__(create.Create)
+    robot._initState()
+    robot.setPose(0, 0, 0)
+
+    start = timeit.default_timer()
+    poses = []
+    for i in range(samples):
+        robot._integrateNextOdometricStepCreate(distances[i], angles[i])
+        poses.append((robot.xPose, robot.yPose, robot.thrPose))
+    scalar = timeit.default_timer() - start
+
+    d = create.numpy.array(distances)
+    a = create.numpy.array(angles)
+    start = timeit.default_timer()
+    batch = create.integrateOdometry(d, a)
+    vector = timeit.default_timer() - start
+
+    difference = abs(create.numpy.array(poses) - batch).max()
+    return scalar / samples, vector / samples, difference
+
+
+def benchStopLatency(scheduled, stops=5):
+    """ returns the worst and the mean time (in seconds) from calling
+    stop() to the emulated robot stopping, while two threads keep the
+    link busy with songs and LEDs; with scheduled, through the
+    robot's CommandScheduler
+    """
+    robot = create.Create('sim')
+    device = robot._simulator.device
+    robot.suppressRepeats = False
+    if scheduled:
+        robot.startScheduler()
+    done = []
+    def flood():
+        k = 0
+        while not done:
+            robot.setSong(k % 16, [(60 + k % 20, 8)] * 16)
+            robot.setLEDs(k % 256, 255, 1, 1)
+            k += 1
+    threads = [ threading.Thread(target=flood) for i in range(2) ]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    for i in range(stops):
+        robot.go(20)
+        time.sleep(0.1)
+        start = time.monotonic()
+        robot.go(0, 0)
+        while device.velocity != 0:
+            time.sleep(0.0005)
+        latencies.append(time.monotonic() - start)
+    done.append(True)
+    for thread in threads:
+        thread.join()
+    robot.close()
+    return max(latencies), sum(latencies) / len(latencies)
+
+
+def benchStress(threads, seconds=3.0, motions=False, scheduled=False):
+    """ has threads threads each drive, set the LEDs and query the
+    sensors of one emulated robot as fast as they can for seconds, and
+    returns (queries, replies that came back wrong, commands sent,
+    how far (mm) and how many degrees the pose ended up from the
+    emulated robot's own)
+
+    with motions, the threads also stop the robot and have it turn,
+    half the time with a timeout short enough that the turn is still
+    going when it runs out; with scheduled, the commands go through
+    the CommandScheduler
+    """
+    robot = _simRobot()
+    device = robot._simulator.device
+    if scheduled:
+        robot.startScheduler()
+    wanted = [create.OI_MODE, create.LEFT_BUMP, create.VOLTAGE, create.POSE,
+              create.BATTERY_CAPACITY]
+    # replies of different sizes and layouts, so that one read as
+    # another's comes out wrong
+    sensorLists = [ wanted, [create.VOLTAGE, create.OI_MODE],
+                    [create.BATTERY_CAPACITY, create.LEFT_BUMP, create.OI_MODE] ]
+    expected = { create.OI_MODE: create.SAFE_MODE, create.VOLTAGE: 16000,
+                 create.BATTERY_CAPACITY: 2700, create.LEFT_BUMP: 0 }
+    robot.sensors(wanted)
+    counts = { 'queries': 0, 'bad': 0, 'commands': 0 }
+    lock = threading.Lock()
+    done = threading.Event()
+    def hammer(k):
+        rng = random.Random(k)
+        queries = bad = commands = 0
+        while not done.is_set():
+            choice = rng.random()
+            if choice < 0.5:
+                query = rng.choice(sensorLists)
+                d = robot.sensors(query)
+                queries += 1
+                if any([ d.get(s) != expected[s] for s in query if s in expected ]):
+                    bad += 1
+            elif motions and choice < 0.55:
+                robot.turn(rng.randint(-30, 30), 90, timeout=rng.choice([0.05, 2.0]))
+                commands += 1
+            elif motions and choice < 0.6:
+                robot.stop()
+                commands += 1
+            elif choice < 0.8:
+                robot.go(rng.randint(-20, 20), rng.randint(-30, 30))
+                commands += 1
+            else:
+                robot.setLEDs(rng.randrange(256), 255, rng.randrange(2), rng.randrange(2))
+                commands += 1
+        with lock:
+            counts['queries'] += queries
+            counts['bad'] += bad
+            counts['commands'] += commands
+    workers = [ threading.Thread(target=hammer, args=(k,)) for k in range(threads) ]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    done.set()
+    for worker in workers:
+        worker.join()
+    robot.stop()
+    # let the last turn that timed out finish and be counted
+    deadline = time.monotonic() + 5.0
+    while robot._strayBytes > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+        robot.sensors([create.POSE])
+    time.sleep(0.1)
+    d = robot.sensors(wanted)
+    if d.get(create.OI_MODE) != create.SAFE_MODE or d.get(create.VOLTAGE) != 16000:
+        counts['bad'] += 1
+    if device.mode != create.SAFE_MODE:
+        # something garbled was taken for a mode change
+        counts['bad'] += 1
+    distance, turn = _poseError(robot, device)
+    robot.close()
+    return counts['queries'], counts['bad'], counts['commands'], distance, turn
+
+
+def _emulators(n):
+    """ starts n emulated robots in another process (so that they
+    don't count against this one) and returns (process, their ports)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, os.path.join(here, 'createsim.py'),
+                                '--robots', str(n)],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    ports = [ process.stdout.readline().split()[-1] for i in range(n) ]
+    return process, ports
+
+
+def benchFleet(n, fleet, seconds=3.0):
+    """ streams bumpers and odometry from n emulated robots for
+    seconds, either through one Fleet or with one stream thread per
+    robot, and returns (packets per robot per second, CPU seconds
+    this process spent per second)
+    """
+    process, ports = _emulators(n)
+    try:
+        # Create says a lot as it connects
+        with contextlib.redirect_stdout(io.StringIO()):
+            if fleet:
+                group = create.Fleet(ports)
+                robots = [ group[name] for name in group ]
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=n) as pool:
+                    robots = list(pool.map(create.Create, ports))
+            for robot in robots:
+                robot.startStream([create.LEFT_BUMP, create.RIGHT_BUMP, create.POSE])
+        time.sleep(0.5)
+        packets = sum([ robot.streamPackets for robot in robots ])
+        start = time.monotonic(); cpu = time.process_time()
+        time.sleep(seconds)
+        cpu = time.process_time() - cpu; elapsed = time.monotonic() - start
+        packets = sum([ robot.streamPackets for robot in robots ]) - packets
+        if fleet:
+            group.close()
+        else:
+            for robot in robots:
+                robot.close()
+    finally:
+        process.terminate()
+        process.wait()
+    return packets / float(n) / elapsed, cpu / elapsed
+
+
+#
+# checks: --check runs each of these against emulated robots, and
+# fails if any of them finds something wrong
+#
+
+def _simRobot():
+    """ returns a Create connected to an emulated robot, quietly """
+    with contextlib.redirect_stdout(io.StringIO()):
+        robot = create.Create('sim')
+    # every sensor is read on every call
+    robot.sensorMaxAge = {}
+    return robot
+
+
+def _poseError(robot, device):
+    """ how far (mm) and how many degrees robot's pose is from the
+    emulated robot's own
+    """
+    distance = math.hypot(robot.xPose - device.x, robot.yPose - device.y)
+    turn = abs(math.degrees(math.atan2(math.sin(robot.thrPose - device.th),
+                                       math.cos(robot.thrPose - device.th))))
+    return distance, turn
+
+
+def _checkReplies(robot, problems, when):
+    """ queries robot a few times and notes any reply that is wrong """
+    for i in range(5):
+        d = robot.sensors([create.OI_MODE, create.VOLTAGE, create.LEFT_BUMP])
+        if (d.get(create.OI_MODE) != create.SAFE_MODE or d.get(create.VOLTAGE) != 16000
+                or d.get(create.LEFT_BUMP) != 0):
+            problems.append('%s: wrong reply %r' % (when, [ d.get(s) for s in
+                            (create.OI_MODE, create.VOLTAGE, create.LEFT_BUMP) ]))
+            return
+
+
+def checkTimedOutScript():
+    """ a turn that times out must leave the replies after it in step,
+    and its distance and angle must still reach the pose
+    """
+    problems = []
+    robot = _simRobot()
+    device = robot._simulator.device
+    try:
+        if robot.turn(90, 45, timeout=0.3):
+            problems.append('the turn did not time out')
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            # while the robot is still turning
+            robot.sensors([create.OI_MODE, create.VOLTAGE])
+            if robot.turn(10, 45, timeout=0.3):
+                problems.append('a turn started while the last one ran')
+        if out.getvalue():
+            problems.append('while turning: %s' % out.getvalue().strip())
+        time.sleep(2.5)
+        _checkReplies(robot, problems, 'after the turn')
+        distance, turn = _poseError(robot, device)
+        if distance > 5 or turn > 2:
+            problems.append('pose off by %.1f mm and %.1f degrees' % (distance, turn))
+    finally:
+        robot.close()
+    return problems
+
+
+def checkSchedulerStops():
+    """ with the scheduler, a stop must win over the DRIVE commands
+    queued before it, but not throw away a script being run
+    """
+    problems = []
+    robot = _simRobot()
+    device = robot._simulator.device
+    robot.startScheduler()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # fill the queue, so that the go waits behind the songs
+            for i in range(8):
+                robot.playSong([ (60 + i, 8) ] * 16)
+            robot.go(20)
+            robot.go(0, 0)
+        robot._scheduler.flush()
+        time.sleep(0.1)
+        if device.velocity != 0:
+            problems.append('still driving after the stop: %d mm/s' % device.velocity)
+
+        turning = robot.startTurn(90, 90, timeout=3.0)
+        robot.go(0, 0)
+        if not turning.result():
+            problems.append('a stop threw away the turn queued before it')
+        _checkReplies(robot, problems, 'after the turn')
+        distance, turn = _poseError(robot, device)
+        if distance > 5 or turn > 2:
+            problems.append('pose off by %.1f mm and %.1f degrees' % (distance, turn))
+    finally:
+        robot.close()
+    return problems
+
+
+def checkModeChange():
+    """ once the robot reports that it has left safe mode by itself, a
+    go() repeating the last one must be sent again, and so must one
+    that has been held back for longer than commandKeepalive
+    """
+    problems = []
+    robot = _simRobot()
+    device = robot._simulator.device
+    try:
+        robot.go(10)
+        device.mode = create.PASSIVE_MODE
+        device.velocity = 0
+        robot.sensors([create.OI_MODE])
+        with contextlib.redirect_stdout(io.StringIO()):
+            robot.toSafeMode()
+        robot.go(10)
+        time.sleep(0.1)
+        if device.velocity != 100:
+            problems.append('the go after the mode change was dropped')
+
+        device.velocity = 0
+        time.sleep(robot.commandKeepalive)
+        robot.go(10)
+        time.sleep(0.1)
+        if device.velocity != 100:
+            problems.append('a go older than commandKeepalive was dropped')
+    finally:
+        robot.close()
+    return problems
+
+
+def checkWatchCallbacks():
+    """ a watch's callback must be able to use the robot, both when
+    polling and when streaming, with the scheduler running
+    """
+    problems = []
+    robot = _simRobot()
+    device = robot._simulator.device
+    robot.startScheduler()
+    try:
+        for streaming in (False, True):
+            if streaming:
+                robot.startStream([create.LEFT_BUMP, create.RIGHT_BUMP])
+            called = []
+            def stopped(d):
+                robot.stop()
+                called.append(robot.sensors([create.OI_MODE]).get(create.OI_MODE))
+            w = robot.watch(create.bumped, [create.LEFT_BUMP, create.RIGHT_BUMP], stopped)
+            robot.go(10)
+            device.setBumps(left=1)
+            waiter = threading.Thread(target=w.wait, args=(2.0,))
+            waiter.daemon = True
+            waiter.start()
+            waiter.join(5.0)
+            # the callback is called once the watch has fired
+            deadline = time.monotonic() + 2.0
+            while not called and time.monotonic() < deadline:
+                time.sleep(0.01)
+            when = streaming and 'streaming' or 'polling'
+            if waiter.is_alive() or not called:
+                problems.append('%s: the callback deadlocked' % when)
+                return problems
+            if called != [create.SAFE_MODE]:
+                problems.append('%s: the callback got %r' % (when, called))
+            if device.velocity != 0:
+                problems.append('%s: the callback did not stop the robot' % when)
+            device.setBumps()
+            robot.sensors([create.LEFT_BUMP, create.RIGHT_BUMP])
+        robot.stopStream()
+    finally:
+        robot.close()
+    return problems
+
+
+def checkStress():
+    """ several threads using one robot at once, with and without the
+    scheduler, stopping it and timing out turns too, must get no
+    wrong replies, and the pose must end up where the robot is
+    """
+    problems = []
+    for scheduled in (False, True):
+        queries, bad, commands, distance, turn = benchStress(6, 3.0, True, scheduled)
+        when = scheduled and 'with the scheduler' or 'without the scheduler'
+        if bad > 0:
+            problems.append('%s: %d of %d replies wrong' % (when, bad, queries))
+        if distance > 10 or turn > 3:
+            problems.append('%s: pose off by %.1f mm and %.1f degrees' % (when, distance, turn))
+    return problems
+
+
+# the checks --check runs
+CHECKS = [ checkTimedOutScript, checkSchedulerStops, checkModeChange, checkWatchCallbacks,
+           checkStress ]
+
+def runChecks():
+    """ runs CHECKS, printing what each found; returns 0 if they all
+    passed and 1 if not
+    """
+    failed = 0
+    for check in CHECKS:
+        problems = check()
+        print('%-28s %s' % (check.__name__, problems and 'FAILED' or 'ok'))
+        for problem in problems:
+            print('    ' + problem)
+        failed += bool(problems)
+    return failed and 1 or 0
+
+
+def _commit():
+    """ the git commit the benchmarked code is at, or None """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                      stderr=subprocess.DEVNULL, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.strip()
+
+
+def writeResults(path, results):
+    """ writes results (name -> seconds per call) to path as JSON,
+    along with the commit and the Python they were measured with
+    """
+    with open(path, 'w') as f:
+        json.dump({ 'commit': _commit(),
+                    'python': sys.version.split()[0],
+                    'unit': 'seconds per call',
+                    'results': results }, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def printComparison(path, results):
+    """ prints how results compare with those written to path """
+    with open(path) as f:
+        old = json.load(f)
+    print('compared with %s (commit %s):' % (path, old.get('commit')))
+    print('%-28s %11s %11s %8s' % ('', 'usec before', 'usec now', 'change'))
+    for name in sorted(results):
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        print('%-28s %11.3f %11.3f %+7.1f%%'
+              % (name, before * 1e6, results[name] * 1e6,
+                 (results[name] - before) / before * 100))
+
+
+def printProtocol(results):
+    """ prints the results of benchProtocol """
+    print('%-28s %11s' % ('', 'usec/call'))
+    for name in sorted(results):
+        print('%-28s %11.3f' % (name, results[name] * 1e6))
+
+
+def printDecode(results):
+    """ prints the results of benchDecode """
+    print('group  bytes  usec/packet')
+    for group in sorted(results):
+        size = create._sensorDecoder(create.SENSOR_GROUPS[group]).size
+        print('%5d  %5d  %11.2f' % (group, size, results[group] * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000,
+                        help="how many times each packet is decoded per timing")
+    parser.add_argument("--frames", type=int, default=0,
+                        help="also time decoding this many group 6 packets in one buffer")
+    parser.add_argument("--odometry", type=int, default=0,
+                        help="also time integrating this many odometry readings")
+    parser.add_argument("--stop-latency", action="store_true",
+                        help="also time stopping the emulated robot on a busy link")
+    parser.add_argument("--stress", type=int, default=0,
+                        help="also use one emulated robot from this many threads at once")
+    parser.add_argument("--fleet", type=int, default=0,
+                        help="also stream from 1, 2, 4, ... up to this many emulated robots")
+    parser.add_argument("--check", action="store_true",
+                        help="only run the checks against emulated robots, and fail if any do")
+    parser.add_argument("--json", help="write the timings to this file, as JSON")
+    parser.add_argument("--compare", help="compare the timings with a file written by --json")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(runChecks())
+
+    # name -> seconds per call, for --json and --compare
+    results = {}
+    decode = benchDecode(args.number)
+    printDecode(decode)
+    for group in decode:
+        results['decoder.group%d' % group] = decode[group]
+    protocol = benchProtocol(args.number // 10)
+    printProtocol(protocol)
+    results.update(protocol)
+    if args.frames > 0:
+        single, batch = benchFrames(args.frames)
+        print('frames: %.3f usec/packet one at a time, %.3f usec/packet in a batch'
+              % (single * 1e6, batch * 1e6))
+        results['frames.single'] = single
+        results['frames.batch'] = batch
+    if args.odometry > 0:
+        scalar, vector, difference = benchOdometry(args.odometry)
+        results['odometry.single'] = scalar
+        results['odometry.batch'] = vector
+        print('odometry: %.3f usec/reading one at a time, %.3f usec/reading in a batch'
+              % (scalar * 1e6, vector * 1e6))
+        print('          largest difference between the two: %g' % difference)
+    if args.stop_latency:
+        for scheduled in (False, True):
+            worst, mean = benchStopLatency(scheduled)
+            print('stop latency %s the scheduler: worst %.1f ms, mean %.1f ms'
+                  % (scheduled and 'with' or 'without', worst * 1e3, mean * 1e3))
+    if args.stress > 0:
+        queries, bad, commands, distance, turn = benchStress(args.stress)
+        print('stress: %d threads, %d queries (%d wrong), %d commands'
+              % (args.stress, queries, bad, commands))
+        print('        pose off by %.1f mm and %.1f degrees' % (distance, turn))
+    if args.fleet > 0:
+        print('         packets/s per robot        CPU used')
+        print('robots   one thread  per robot     one thread  per robot')
+        n = 1
+        while n <= args.fleet:
+            fleetRate, fleetCpu = benchFleet(n, True)
+            threadRate, threadCpu = benchFleet(n, False)
+            print('%6d   %10.1f %10.1f     %9.0f%% %9.0f%%'
+                  % (n, fleetRate, threadRate, fleetCpu * 100, threadCpu * 100))
+            n *= 2
+    if args.compare is not None:
+        printComparison(args.compare, results)
+    if args.json is not None:
+        writeResults(args.json, results)
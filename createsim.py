@@ -0,0 +1,509 @@
+#
+# createsim.py
+#
+# An emulated iRobot Create, speaking the Open Interface byte protocol
+# over a pseudo-terminal, so that create.py can be run without a robot:
+#
+#   python createsim.py --baud 57600 [--robots N]
+#   Emulated Create on /dev/pts/5
+#
+# and then, in another program, create.Create('/dev/pts/5') as usual.
+# Create('sim') starts one of these in the background by itself.
+#
+# The emulated robot drives in an empty world, using the same motion
+# model as create._poseDeltaFromVelRadSec. It handles the mode changes,
+# DRIVE/DRIVEDIRECT, LEDS, SONG/PLAY, SENSORS/QUERYLIST/STREAM/PAUSERESUME
+# and SCRIPT/PLAY SCRIPT with the WAIT commands; anything else is
+# accepted and ignored.
+
+import os
+import sys
+import tty
+import termios
+import math
+import time
+import select
+import struct
+import argparse
+import threading
+
+import create
+
+
+# the number of data bytes that follow each opcode; the opcodes
+# that are followed by a count byte are handled separately
+_COMMAND_LENGTH = { 128: 0,   # START
+                    129: 1,   # BAUD
+                    130: 0,   # CONTROL
+                    131: 0,   # SAFE
+                    132: 0,   # FULL
+                    133: 0,   # POWER
+                    134: 0,   # SPOT
+                    135: 0,   # COVER
+                    136: 1,   # DEMO
+                    137: 4,   # DRIVE
+                    138: 1,   # MOTORS / LOW SIDE DRIVERS
+                    139: 3,   # LEDS
+                    141: 1,   # PLAY
+                    142: 1,   # SENSORS
+                    143: 0,   # COVER AND DOCK
+                    144: 3,   # PWM LOW SIDE DRIVERS
+                    145: 4,   # DRIVEDIRECT
+                    147: 1,   # DIGITAL OUTPUTS
+                    150: 1,   # PAUSERESUME
+                    151: 1,   # SEND IR
+                    153: 0,   # PLAY SCRIPT
+                    154: 0,   # SHOW SCRIPT
+                    155: 1,   # WAIT TIME
+                    156: 2,   # WAITDIST
+                    157: 2,   # WAITANGLE
+                    158: 1 }  # WAIT EVENT
+
+# opcodes followed by a count N and then N bytes
+_COUNTED_COMMANDS = (148, 149, 152)   # STREAM, QUERYLIST, SCRIPT
+
+# the OI baud codes
+_BAUD_RATES = [ 300, 600, 1200, 2400, 4800, 9600, 14400, 19200,
+                28800, 38400, 57600, 115200 ]
+
+# half the distance between the wheels, as in _poseDeltaFromVelRadSec
+_DELTA = 258.0/2.0
+
+
+class OIDevice:
+    """ the OIDevice class is the Open Interface state machine of an
+    emulated Create: receive() feeds it the bytes the host sends,
+    step() moves time along, and output() returns what the robot
+    sends back
+
+    it does no I/O of its own, see serve() for that
+    """
+
+    def __init__(self):
+        self.mode = create.OFF_MODE
+        # the true pose of the robot, in mm, mm and radians
+        self.x = 0.0
+        self.y = 0.0
+        self.th = 0.0
+        # the drive parameters, as in the DRIVE command
+        self.velocity = 0
+        self.radius = 32768
+        self.rightVelocity = 0
+        self.leftVelocity = 0
+        # distance (mm) and angle (degrees) since they were last read
+        self.distance = 0.0
+        self.angle = 0.0
+        # bumpers and wheel drops, set with setBumps
+        self.bumpsAndWheelDrops = 0
+        self.leds = (0, 0, 0)
+        self.songs = {}
+        self.songNumber = 0
+        self.songEnd = 0.0
+        self.script = b''
+        self.baudrate = 57600
+
+        self.time = 0.0
+        self._input = bytearray()
+        self._scriptQueue = bytearray()
+        self._output = bytearray()
+        # the condition of the WAIT being waited on, or None
+        self._wait = None
+        self._streamIds = []
+        self._streamOn = False
+        self._nextStream = 0.0
+        self.streamPackets = 0
+
+    def receive(self, data):
+        """ takes in bytes sent by the host """
+        self._input.extend(data)
+        self._run()
+
+    def output(self):
+        """ returns (and forgets) the bytes the robot has sent """
+        data = bytes(self._output)
+        del self._output[:]
+        return data
+
+    def setBumps(self, left=0, right=0):
+        """ presses (1) or releases (0) the bumpers """
+        self.bumpsAndWheelDrops = (self.bumpsAndWheelDrops & ~3) | (left << 1) | right
+        self._run()
+
+    def step(self, sec):
+        """ moves the robot and the clock along by sec seconds """
+        if sec <= 0:
+            return
+        self.time += sec
+        dx, dy, dth = create._poseDeltaFromVelRadSec( self.velocity, self.radius, sec )
+        # the local motion, in the direction the robot is facing
+        self.x += dx*math.cos(self.th) - dy*math.sin(self.th)
+        self.y += dx*math.sin(self.th) + dy*math.cos(self.th)
+        self.th += dth
+        # the in-place turns don't move the center of the robot
+        moved = 0.0
+        if self.radius not in (1, -1, 0):
+            moved = self.velocity * sec
+        self.distance += moved
+        self.angle += math.degrees(dth)
+        if self._wait is not None:
+            if self._wait[0] == 156:
+                self._wait[2] += moved
+            elif self._wait[0] == 157:
+                self._wait[2] += math.degrees(dth)
+            else:
+                self._wait[2] += sec
+        self._run()
+
+        if self._streamOn and self.time >= self._nextStream:
+            self._nextStream = self.time + create.STREAM_PERIOD
+            self._sendStreamPacket()
+
+    #
+    # the command interpreter
+    #
+    def _run(self):
+        """ executes commands until the input runs out or a WAIT
+        has to wait
+        """
+        while True:
+            if self._wait is not None:
+                if not self._waitIsOver():
+                    return
+                self._wait = None
+            # scripts being played come ahead of the serial input
+            queue = self._scriptQueue if self._scriptQueue else self._input
+            command = self._nextCommand(queue)
+            if command is None:
+                return
+            self._execute(command[0], command[1:])
+
+    def _nextCommand(self, queue):
+        """ removes and returns the next complete command in queue,
+        or None if it isn't all there yet
+        """
+        while len(queue) > 0:
+            opcode = queue[0]
+            if opcode in _COUNTED_COMMANDS:
+                if len(queue) < 2:
+                    return None
+                length = 2 + queue[1]
+            elif opcode == 140:   # SONG: number, count, then note pairs
+                if len(queue) < 3:
+                    return None
+                length = 3 + 2*queue[2]
+            elif opcode in _COMMAND_LENGTH:
+                length = 1 + _COMMAND_LENGTH[opcode]
+            else:
+                # not an opcode, just drop it
+                del queue[:1]
+                continue
+            if len(queue) < length:
+                return None
+            command = bytes(queue[:length])
+            del queue[:length]
+            return command
+        return None
+
+    def _execute(self, opcode, data):
+        """ carries out one command """
+        if opcode == 128:   # START
+            self.mode = create.PASSIVE_MODE
+            self._drive(0, 32768)
+            return
+        if self.mode == create.OFF_MODE:
+            # nothing but START is heard until the OI is started
+            return
+        if opcode == 129:   # BAUD
+            if data[0] < len(_BAUD_RATES):
+                self.baudrate = _BAUD_RATES[data[0]]
+        elif opcode == 130 or opcode == 131:   # CONTROL, SAFE
+            self.mode = create.SAFE_MODE
+        elif opcode == 132:   # FULL
+            self.mode = create.FULL_MODE
+        elif opcode == 137:   # DRIVE
+            velocity, radius = struct.unpack('>hH', data)
+            if radius not in (32767, 32768):
+                radius = struct.unpack('>h', data[2:])[0]
+            self._drive(velocity, radius)
+        elif opcode == 145:   # DRIVEDIRECT
+            right, left = struct.unpack('>hh', data)
+            self._driveDirect(left, right)
+        elif opcode == 139:   # LEDS
+            self.leds = tuple(data)
+        elif opcode == 140:   # SONG
+            self.songs[data[0]] = [ (data[i], data[i+1]) for i in range(2, len(data), 2) ]
+        elif opcode == 141:   # PLAY
+            notes = self.songs.get(data[0], [])
+            self.songNumber = data[0]
+            self.songEnd = self.time + sum([ n[1] for n in notes ])/64.0
+        elif opcode == 142:   # SENSORS
+            self._output.extend(self._sensorData(data))
+        elif opcode == 149:   # QUERYLIST
+            self._output.extend(self._sensorData(data[1:]))
+        elif opcode == 148:   # STREAM
+            self._streamIds = list(data[1:])
+            self._streamOn = len(self._streamIds) > 0
+            self._nextStream = self.time
+        elif opcode == 150:   # PAUSERESUME
+            self._streamOn = data[0] != 0 and len(self._streamIds) > 0
+        elif opcode == 152:   # SCRIPT
+            self.script = bytes(data[1:])
+        elif opcode == 153:   # PLAY SCRIPT
+            self._scriptQueue[0:0] = self.script
+        elif opcode == 154:   # SHOW SCRIPT
+            self._output.extend(bytes([len(self.script)]) + self.script)
+        elif opcode == 155:   # WAIT TIME, in tenths of seconds
+            self._wait = [opcode, data[0]/10.0, 0.0]
+        elif opcode == 156 or opcode == 157:   # WAITDIST, WAITANGLE
+            self._wait = [opcode, struct.unpack('>h', data)[0], 0.0]
+        elif opcode == 158:   # WAIT EVENT
+            self._wait = [opcode, struct.unpack('>b', data)[0], 0.0]
+
+    def _waitIsOver(self):
+        """ checks the condition of the current WAIT """
+        opcode, target, progress = self._wait
+        if opcode == 158:
+            # only the bump events can happen in an empty world
+            event = abs(target)
+            if event == 5:
+                happened = (self.bumpsAndWheelDrops & 3) != 0
+            elif event == 6:
+                happened = (self.bumpsAndWheelDrops & 2) != 0
+            elif event == 7:
+                happened = (self.bumpsAndWheelDrops & 1) != 0
+            else:
+                happened = False
+            return happened == (target > 0)
+        if target >= 0:
+            return progress >= target
+        return progress <= target
+
+    def _drive(self, velocity, radius):
+        """ sets the drive parameters, as DRIVE does """
+        if self.mode not in (create.SAFE_MODE, create.FULL_MODE):
+            velocity = 0
+        if radius == 32767:
+            radius = 32768
+        self.velocity = velocity
+        self.radius = radius
+        if radius == 32768:
+            self.rightVelocity = self.leftVelocity = velocity
+        elif radius in (1, -1, 0):
+            self.rightVelocity = velocity if radius >= 0 else -velocity
+            self.leftVelocity = -self.rightVelocity
+        else:
+            self.rightVelocity = int(velocity * (radius + _DELTA) / radius)
+            self.leftVelocity = int(velocity * (radius - _DELTA) / radius)
+
+    def _driveDirect(self, left, right):
+        """ sets the wheel velocities, as DRIVEDIRECT does, by turning
+        them into the equivalent velocity and radius
+        """
+        if left == right:
+            self._drive(left, 32768)
+        elif left == -right:
+            self._drive(abs(right), 1 if right > 0 else -1)
+        else:
+            radius = _DELTA * (right + left) / float(right - left)
+            self._drive((right + left)/2.0, radius)
+        self.rightVelocity = right
+        self.leftVelocity = left
+
+    #
+    # the sensors
+    #
+    def _sensorValue(self, packetId):
+        """ returns the current value of one raw sensor """
+        if packetId == create.BUMPS_AND_WHEEL_DROPS:
+            return self.bumpsAndWheelDrops
+        if packetId == create.INFRARED_BYTE:
+            return 255
+        if packetId == create.DISTANCE:
+            # reading the distance resets it, keeping what didn't
+            # make a whole millimeter
+            value = int(self.distance)
+            self.distance -= value
+            return max(-32768, min(32767, value))
+        if packetId == create.ANGLE:
+            value = int(self.angle)
+            self.angle -= value
+            return max(-32768, min(32767, value))
+        if packetId == create.VOLTAGE:
+            return 16000
+        if packetId == create.CURRENT:
+            return -150 - abs(self.velocity)
+        if packetId == create.BATTERY_TEMP:
+            return 25
+        if packetId == create.BATTERY_CHARGE:
+            return 2500
+        if packetId == create.BATTERY_CAPACITY:
+            return 2700
+        if packetId == create.OI_MODE:
+            return self.mode
+        if packetId == create.SONG_NUMBER:
+            return self.songNumber
+        if packetId == create.SONG_PLAYING:
+            return 1 if self.time < self.songEnd else 0
+        if packetId == create.NUM_STREAM_PACKETS:
+            return len(self._streamIds)
+        if packetId == create.REQUESTED_VELOCITY:
+            return int(self.velocity)
+        if packetId == create.REQUESTED_RADIUS:
+            return struct.unpack('>h', struct.pack('>H', int(self.radius) & 0xFFFF))[0]
+        if packetId == create.REQUESTED_RIGHT_VELOCITY:
+            return int(self.rightVelocity)
+        if packetId == create.REQUESTED_LEFT_VELOCITY:
+            return int(self.leftVelocity)
+        return 0
+
+    def _sensorData(self, packetIds):
+        """ returns the bytes of the sensors (or group packets) asked
+        for in packetIds
+        """
+        data = bytearray()
+        for packetId in packetIds:
+            for s in create.SENSOR_GROUPS.get(packetId, [packetId]):
+                if 7 <= s < len(create.SENSOR_DATA_WIDTH):
+                    data.extend(struct.pack('>' + create._SENSOR_FORMAT[s], self._sensorValue(s)))
+        return bytes(data)
+
+    def _sendStreamPacket(self):
+        """ sends one packet of the sensor stream """
+        payload = bytearray()
+        for packetId in self._streamIds:
+            payload.append(packetId)
+            payload.extend(self._sensorData([packetId]))
+        packet = bytearray([create.STREAM_HEADER, len(payload)]) + payload
+        packet.append((-sum(packet)) & 0xFF)
+        self._output.extend(packet)
+        self.streamPackets += 1
+
+
+#
+# running an OIDevice behind a pseudo-terminal
+#
+
+# termios speed -> baud rate, for the rates the Create knows
+_TERMIOS_SPEEDS = dict([ (getattr(termios, 'B%d' % rate), rate)
+                         for rate in _BAUD_RATES if hasattr(termios, 'B%d' % rate) ])
+
+class PtyEmulator:
+    """ serves an OIDevice on a new pseudo-terminal, whose name is
+    portName; bytes go in and out no faster than the device's baud
+    rate allows, and not at all while the other end of the
+    pseudo-terminal is set to a different rate (rates that termios
+    has no name for, like 14400, can't be told apart and always work)
+    """
+
+    def __init__(self, device=None, baudrate=57600, tick=0.002):
+        if device is None:
+            device = OIDevice()
+        self.device = device
+        self.device.baudrate = baudrate
+        self.tick = tick
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.portName = os.ttyname(self.slave)
+        self._running = False
+        self._thread = None
+
+    @property
+    def baudrate(self):
+        return self.device.baudrate
+
+    def hostBaudrate(self):
+        """ returns the baud rate the other end has set, or None if it
+        isn't one the Create knows
+        """
+        try:
+            speed = termios.tcgetattr(self.master)[5]
+        except termios.error:
+            return None
+        return _TERMIOS_SPEEDS.get(speed)
+
+    def _rateMatches(self):
+        host = self.hostBaudrate()
+        return host is None or host == self.device.baudrate
+
+    def serve(self):
+        """ runs the emulator until stop() is called """
+        self._running = True
+        pending = bytearray()
+        last = time.monotonic()
+        sendCredit = 0.0
+        receiveCredit = 0.0
+        while self._running:
+            # bytes come in no faster than the baud rate allows either,
+            # the rest wait in the pseudo-terminal as they would in the
+            # serial port's buffers
+            readable = []
+            if receiveCredit >= 1:
+                readable = select.select([self.master], [], [], self.tick)[0]
+            else:
+                time.sleep(self.tick)
+            if readable:
+                try:
+                    data = os.read(self.master, int(receiveCredit))
+                except OSError:
+                    data = b''
+                if data:
+                    receiveCredit -= len(data)
+                    # at the wrong rate, all the robot gets is noise
+                    if self._rateMatches():
+                        self.device.receive(data)
+            now = time.monotonic()
+            self.device.step(now - last)
+            pending.extend(self.device.output())
+            # each byte is 10 bits on the wire: start, 8 data, stop
+            bytesOnWire = (now - last) * self.baudrate / 10.0
+            sendCredit = min(sendCredit + bytesOnWire, 4096)
+            receiveCredit = min(receiveCredit + bytesOnWire, 1 + 2 * self.tick * self.baudrate / 10.0)
+            last = now
+            if pending and not self._rateMatches():
+                # nothing intelligible gets to the other end
+                del pending[:]
+            if pending and sendCredit >= 1:
+                n = min(len(pending), int(sendCredit))
+                try:
+                    written = os.write(self.master, bytes(pending[:n]))
+                except OSError:
+                    written = 0
+                del pending[:written]
+                sendCredit -= written
+            elif not pending:
+                sendCredit = min(sendCredit, 1.0)
+
+    def start(self):
+        """ runs the emulator in a background thread and returns self """
+        self._thread = threading.Thread(target=self.serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ stops the emulator and closes the pseudo-terminal """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baud", type=int, default=57600,
+                        help="the baud rate whose timing the replies follow")
+    parser.add_argument("--robots", type=int, default=1,
+                        help="how many emulated robots to run, each on its own port")
+    args = parser.parse_args()
+
+    emulators = [ PtyEmulator(baudrate=args.baud) for i in range(args.robots) ]
+    for emulator in emulators:
+        print("Emulated Create on " + emulator.portName)
+    sys.stdout.flush()
+    try:
+        for emulator in emulators[1:]:
+            emulator.start()
+        emulators[0].serve()
+    except KeyboardInterrupt:
+        pass